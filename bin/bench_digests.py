@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+"""
+Measures the throughput of the digest algorithms of the ``hash`` check, in
+MB/s, for files of several sizes. Run from the root of the repository, e.g.:
+
+    python bin/bench_digests.py 4K 64K 1M 32M
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from buildcloth.dependency import ALGORITHMS, BLOCK_SIZE, MMAP_THRESHOLD, file_digest
+from buildcloth.executors import parse_size
+
+def bench(path, size, algorithm, block_size, budget):
+    hashed = 0
+    start = time.time()
+
+    while True:
+        file_digest(path, algorithm, block_size)
+        hashed += size
+
+        elapsed = time.time() - start
+        if elapsed >= budget:
+            return hashed / elapsed / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the throughput of the digest algorithms of '--check hash'.")
+    parser.add_argument('sizes', nargs='*', default=['4K', '64K', '1M', '32M'],
+                        help='file sizes to hash, e.g. 64K or 32M.')
+    parser.add_argument('--block-size', type=parse_size, default=BLOCK_SIZE)
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='how long to hash each file with each algorithm.')
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>6} '.format('size', 'mode') + ' '.join('{0:>10}'.format(a) for a in ALGORITHMS))
+
+    for size in [ parse_size(s) for s in args.sizes ]:
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(size))
+
+            results = [ bench(path, size, algorithm, args.block_size, args.seconds)
+                        for algorithm in ALGORITHMS ]
+        finally:
+            os.remove(path)
+
+        mode = 'mmap' if size > 0 and size >= MMAP_THRESHOLD else 'read'
+        print('{0:>10} {1:>6} '.format(size, mode) + ' '.join('{0:>10.1f}'.format(r) for r in results))
+
+    print('(MB/s, files in the page cache)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+"""
+Measures how long :func:`~tsort.tsort()` takes to sort dependency graphs with
+up to a million edges. Run from the root of the repository, e.g.:
+
+    python bin/bench_tsort.py 10000 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from buildcloth.tsort import tsort
+
+def chain(edges, fanout):
+    "One long chain of targets, the worst case for a recursive sort."
+
+    graph = dict(('t{0}'.format(i), ['t{0}'.format(i + 1)]) for i in range(edges))
+    graph['t{0}'.format(edges)] = []
+    return graph
+
+def dag(edges, fanout):
+    "Targets that each depend on ``fanout`` random targets that follow them."
+
+    nodes = max(edges // fanout, 2)
+    names = [ 't{0}'.format(i) for i in range(nodes) ]
+
+    graph = { }
+    for i, name in enumerate(names):
+        if i == nodes - 1:
+            graph[name] = []
+        else:
+            graph[name] = [ names[random.randint(i + 1, nodes - 1)] for j in range(fanout) ]
+
+    return graph
+
+def main():
+    parser = argparse.ArgumentParser(description='Time sorting of large dependency graphs.')
+    parser.add_argument('edges', nargs='*', type=int, default=[10000, 100000, 1000000],
+                        help='number of edges in each graph.')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='dependencies of each target in the random graphs.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>12}'.format('shape', 'nodes', 'edges', 'seconds', 'edges/s'))
+    for edges in args.edges:
+        for build in (chain, dag):
+            graph = build(edges, args.fanout)
+            count = sum(len(deps) for deps in graph.values())
+
+            start = time.time()
+            tsort(graph)
+            elapsed = time.time() - start
+
+            print('{0:>8} {1:>10} {2:>10} {3:>10.3f} {4:>12.0f}'.format(build.__name__, len(graph), count,
+                                                                        elapsed, count / elapsed))
+
+if __name__ == '__main__':
+    main()
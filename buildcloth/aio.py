@@ -0,0 +1,487 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`aio` runs builds on an :mod:`python:asyncio` event loop.
+
+:class:`~aio.AsyncRunner()` starts shell jobs with
+:func:`python:asyncio.create_subprocess_exec`, and waits on every running
+command from a single event loop, rather than from one worker thread or
+process per command. This suits stages with many thousands of small
+commands. Python function jobs still run in a :class:`~executors.WorkerPool()`.
+A semaphore limits the number of jobs that run at once, and one semaphore for
+each named resource pool limits the jobs in that pool. With a ``max_load``,
+jobs also wait while the load average of the system is too high.
+
+Use :meth:`~system.BuildSystem.run_async()` to run a build from a coroutine,
+or the ``buildc --engine asyncio`` option. Requires Python 3.5 or later.
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from multiprocessing import cpu_count
+
+from buildcloth.err import StageRunError
+from buildcloth.executors import WorkerPool, LoadLimit, LOAD_POLL_INTERVAL, is_shell_job, check_result
+from buildcloth.buildlog import record_job
+from buildcloth.stages import BuildSteps, BuildSequence
+
+logger = logging.getLogger(__name__)
+
+class AsyncRunner(object):
+    """
+    :param int workers: Optional. The maximum number of jobs to run at once.
+       Defaults to the number of cores/threads available on your system.
+
+    :param float max_load: Optional. Holds back new jobs while the load
+       average of the system is at or above this value.
+
+    Runs the jobs of :class:`~stages.BuildSteps()` and
+    :class:`~scheduler.BuildGraph()` objects as coroutines. Call
+    :meth:`~aio.AsyncRunner.close()` or :meth:`~aio.AsyncRunner.terminate()`
+    when the build completes.
+    """
+
+    def __init__(self, workers=None, max_load=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.workers = workers
+        "The maximum number of jobs to run at once."
+
+        self.pool = WorkerPool(workers)
+        "The :class:`~executors.WorkerPool` that runs Python function jobs."
+
+        self._semaphore = None
+        "Limits the number of running jobs. Created in the event loop."
+
+        self._pools = {}
+        "Mapping of the names of resource pools to their semaphores."
+
+        self.load = LoadLimit(max_load)
+        "A :class:`~executors.LoadLimit` that decides when new jobs start."
+
+        self.running = 0
+        "The number of jobs that are running."
+
+        self._completion = None
+        "Set when a job completes, to wake jobs that wait on the load average."
+
+    @property
+    def semaphore(self):
+        "A :class:`python:asyncio.Semaphore` sized by ``workers``."
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        return self._semaphore
+
+    def _limit(self, name, depths):
+        """
+        :param string name: The name of a resource pool, or ``None``.
+
+        :param dict depths: A mapping of the names of resource pools to their
+           depths.
+
+        :returns: The :class:`python:asyncio.Semaphore` for the pool, or
+           ``None`` if the pool has no depth.
+        """
+
+        if name is None or name not in depths:
+            return None
+
+        if name not in self._pools:
+            self._pools[name] = asyncio.Semaphore(depths[name])
+
+        return self._pools[name]
+
+    async def _started(self):
+        """
+        Waits until the load average permits another job to start, and counts
+        the job as running. Call :meth:`~aio.AsyncRunner._completed()` once
+        the job completes.
+        """
+
+        while not self.load.available(self.running):
+            if self._completion is None:
+                self._completion = asyncio.Event()
+
+            self._completion.clear()
+
+            try:
+                await asyncio.wait_for(self._completion.wait(), LOAD_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        self.running += 1
+
+    def _completed(self):
+        self.running -= 1
+
+        if self._completion is not None:
+            self._completion.set()
+
+    def close(self):
+        "Stops the worker processes that run Python function jobs."
+        self.pool.close()
+
+    def terminate(self):
+        "Stops the worker processes that run Python function jobs immediately."
+        self.pool.terminate()
+
+    @staticmethod
+    async def _wait(tasks):
+        """
+        :param list tasks: A list of :class:`python:asyncio.Task` objects.
+
+        Waits for every task to complete. If a task raises an exception,
+        cancels the remaining tasks, waits for them to stop, and raises the
+        exception.
+
+        :returns: A list of the results of the tasks, in the same order as
+           ``tasks``.
+        """
+
+        if not tasks:
+            return []
+
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if pending:
+            err = [ task.exception() for task in done
+                    if not task.cancelled() and task.exception() is not None ][0]
+
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            raise err
+
+        return [ task.result() for task in tasks ]
+
+    async def run_command(self, args):
+        """
+        :param args: The arguments of a shell job: a dict of keyword
+           arguments for :func:`python:subprocess.call`, or a tuple with the
+           command as its first item.
+
+        Runs a command as a subprocess of the current process. Kills the
+        command if the coroutine is cancelled.
+
+        :returns: The exit status of the command.
+        """
+
+        if isinstance(args, dict):
+            kwargs = dict(args)
+            cmd = kwargs.pop('args')
+        else:
+            kwargs = {}
+            cmd = args[0]
+
+        async with self.semaphore:
+            await self._started()
+
+            try:
+                if kwargs.pop('shell', False) or not isinstance(cmd, (list, tuple)):
+                    proc = await asyncio.create_subprocess_shell(cmd, **kwargs)
+                else:
+                    proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+
+                try:
+                    return await proc.wait()
+                except asyncio.CancelledError:
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                    raise
+            finally:
+                self._completed()
+
+    async def run_function(self, func, args):
+        """
+        :param callable func: A callable object.
+
+        :param args: A tuple, list, or dict of arguments to pass to ``func``,
+           or ``None``.
+
+        Runs ``func`` in :attr:`~aio.AsyncRunner.pool`.
+
+        :returns: The return value of ``func``.
+        """
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def complete(set_value, value):
+            if not future.done():
+                set_value(value)
+
+        async with self.semaphore:
+            await self._started()
+
+            try:
+                self.pool.apply(func, args,
+                                callback=lambda r: loop.call_soon_threadsafe(complete, future.set_result, r),
+                                error_callback=lambda e: loop.call_soon_threadsafe(complete, future.set_exception, e))
+
+                return await future
+            finally:
+                self._completed()
+
+    async def run_job(self, job):
+        """
+        :param tuple job: A job tuple, with a callable and its arguments.
+
+        Runs the job. Runs the jobs of nested :class:`~stages.BuildSteps`
+        objects, as produced by
+        :meth:`~system.BuildSystemGenerator.generate_sequence()`, in this
+        runner.
+
+        :returns: The return value of the job.
+
+        :raises: :exc:`~err.StageRunError` if a shell job exits with a
+           non-zero status, or the exception that a Python function job
+           raises.
+        """
+
+        func, args = job
+        owner = getattr(func, '__self__', None)
+
+        if isinstance(owner, BuildSteps):
+            return await self.run_steps(owner)
+        elif is_shell_job(func):
+            result = await self.run_command(args)
+            check_result(func, args, result)
+            return result
+        else:
+            return await self.run_function(func, args)
+
+    async def run_pooled(self, job, name=None, depths=None):
+        """
+        :param tuple job: A job tuple, with a callable and its arguments.
+
+        :param string name: Optional. The name of the job's resource pool.
+
+        :param dict depths: Optional. A mapping of the names of resource pools
+           to their depths.
+
+        Runs the job with :meth:`~aio.AsyncRunner.run_job()`, once fewer than
+        the depth of its resource pool are running.
+
+        :returns: The return value of the job.
+        """
+
+        limit = self._limit(name, depths or {})
+
+        if limit is None:
+            return await self.run_job(job)
+
+        async with limit:
+            return await self.run_job(job)
+
+    async def run_steps(self, steps):
+        """
+        :param BuildSteps steps: A :class:`~stages.BuildSteps` object.
+
+        Runs every job in a :class:`~stages.BuildSequence` in order, or every
+        job in any other :class:`~stages.BuildSteps` object concurrently,
+        and records the results in :attr:`~stages.BuildSteps.results`.
+
+        :returns: ``True`` upon completion.
+
+        :raises: The exception of the first job that fails, after cancelling
+           the remaining jobs.
+        """
+
+        steps.results = []
+
+        async def record(idx, job):
+            result = await self.run_pooled(job, steps.job_pools.get(idx), steps.pools)
+            steps.results.append((job, result))
+            return result
+
+        if isinstance(steps, BuildSequence):
+            for idx, job in enumerate(steps.stage):
+                await record(idx, job)
+        else:
+            await self._wait([ asyncio.ensure_future(record(idx, job))
+                               for idx, job in enumerate(steps.stage) ])
+
+        return True
+
+    async def run_graph(self, graph):
+        """
+        :param BuildGraph graph: A :class:`~scheduler.BuildGraph` object.
+
+        Runs every target in the graph. Each target starts as soon as all of
+        its dependencies complete. Records the outcome of every job in the
+        graph's :attr:`~scheduler.BuildGraph.log`. Skips targets whose
+        :attr:`~scheduler.BuildGraph.restat` dependencies did not change, as
+        :meth:`~scheduler.BuildGraph.run()` does.
+
+        :returns: ``True`` upon completion.
+
+        :raises: :exc:`~err.StageRunError` if the graph contains a cycle, or
+           the exception of the first job that fails.
+        """
+
+        remaining, dependents = graph._edges()
+        ready = deque([ target for target in sorted(graph.jobs) if remaining[target] == 0 ])
+        order = []
+
+        while ready:
+            target = ready.popleft()
+            order.append(target)
+
+            for dependent in dependents[target]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) != graph.count():
+            blocked = [ target for target in graph.jobs if remaining[target] > 0 ]
+            logger.critical('targets in a dependency cycle: {0}'.format(', '.join(sorted(blocked))))
+            raise StageRunError('dependency cycle in build graph.')
+
+        changed = set()
+
+        async def build(target, dependencies):
+            if dependencies:
+                await asyncio.gather(*dependencies)
+
+            if not graph._needs_run(target, changed):
+                return None
+
+            if target in graph.restat:
+                before = graph._output_state(target)
+            else:
+                before = None
+
+            logger.info('started {0}'.format(target))
+            start = time.time()
+
+            try:
+                result = await self.run_pooled(graph.jobs[target], graph.job_pools.get(target), graph.pools)
+            except Exception as e:
+                record_job(graph.log, target, graph.jobs[target], start, e)
+                raise
+
+            if graph.stats is not None:
+                graph.stats.invalidate(target)
+
+            record_job(graph.log, target, graph.jobs[target], start, inputs=graph._inputs(target))
+
+            if before is not None and not graph._output_changed(target, before):
+                logger.info('{0} did not change, pruning the targets that depend on it'.format(target))
+            else:
+                changed.add(target)
+
+            logger.info('completed {0}'.format(target))
+
+            return result
+
+        tasks = {}
+        for target in order:
+            dependencies = [ tasks[dep] for dep in set(graph.graph[target])
+                             if dep in tasks and dep != target ]
+            tasks[target] = asyncio.ensure_future(build(target, dependencies))
+
+        await self._wait(list(tasks.values()))
+
+        return True
+
+async def run_system(system, strict=None, mode='stages'):
+    """
+    :param BuildSystem system: A :class:`~system.BuildSystem` object.
+
+    :param bool strict: Defaults to :attr:`~system.BuildSystem.strict`.
+
+    :param string mode: Either ``stages`` or ``dag``. See
+       :meth:`~system.BuildSystem.run()`.
+
+    Implements :meth:`~system.BuildSystem.run_async()`.
+    """
+
+    if strict is None:
+        strict = system.strict
+
+    if mode not in ('stages', 'dag'):
+        return system._error_or_return(msg='{0} is not a valid scheduler mode.'.format(mode),
+                                       exception=StageRunError,
+                                       strict=strict)
+
+    if strict is True and system.open is True:
+        logger.critical('cannot run build systems that are open in strict mode.')
+        raise StageRunError("Build system must be closed before running.")
+
+    if system.cache is not None:
+        logger.warning('the asyncio engine does not use the cache of the build system.')
+
+    if system.mem_ceiling is not None:
+        logger.warning('the asyncio engine does not limit jobs by their memory estimates.')
+
+    runner = AsyncRunner(system.workers, system.max_load)
+    finished = False
+
+    # a cancelled build, or an interrupt, must not leave the worker processes
+    # running: terminate the pool upon any exception, and close it otherwise.
+    try:
+        try:
+            if mode == 'dag' and system.graph is not None:
+                logger.info('running build graph with {0} targets'.format(system.graph.count()))
+
+                if system.log is not None:
+                    system.graph.log = system.log
+
+                system.graph.stats = system.stats
+                system.graph.inputs = system.inputs
+                system.graph.digest = system.digest
+
+                await runner.run_graph(system.graph)
+
+            for name in system._stages:
+                if mode == 'dag' and system.graph is not None and name in system.graph:
+                    continue
+
+                logger.info('running build stage {0}'.format(name))
+
+                try:
+                    await runner.run_steps(system.stages[name])
+                except Exception as e:
+                    system._record_stage(name, e)
+                    raise
+
+                system._record_stage(name, 0)
+                logger.info('completed build stage {0}'.format(name))
+        except Exception as e:
+            msg = 'build failed, stopping and returning False: {0}'.format(e)
+            logger.critical(msg)
+            return system._error_or_return(msg=msg, exception=StageRunError, strict=strict)
+
+        finished = True
+    finally:
+        if finished is True:
+            runner.close()
+        else:
+            runner.terminate()
+
+    return True
@@ -2,9 +2,16 @@ from __future__ import absolute_import
 
 from multiprocessing import cpu_count
 from buildcloth.makefile import MakefileCloth
-from buildcloth.system import BuildSystemGenerator, is_function, narrow_buildsystem
+from buildcloth.system import BuildSystemGenerator, is_function
+from buildcloth.buildlog import BuildLog
+from buildcloth.dependency import DigestCache, ALGORITHMS
+from buildcloth.cache import ActionCache, SharedCache, parse_age
+from buildcloth.executors import parse_size
+from buildcloth.remote import RemoteExecutor, RemoteWorker, DEFAULT_ADDRESS, parse_address
+from buildcloth.err import StageRunError
 
 import sys
+import functools
 import argparse
 import os
 import logging
@@ -34,12 +41,44 @@ def _import_strings():
 
 ############### function to generate and run buildsystem ###############
 
-def stages(jobs, stages, file, check):
+def stages(jobs, stages, file, check, scheduler='stages', engine='pool', build_log=None, max_load=None,
+           mem_ceiling=None, executor=None, cache=None, digest_cache=None, hash_algorithm='md5',
+           hash_block_size=None):
     """
     Main public function to generate and run a
-    :class:`~system.BuildSystemGenerator()` build system.
+    :class:`~system.BuildSystemGenerator()` build system. If ``stages`` is
+    not empty, builds only the named targets and stages, and the targets
+    that they depend upon. ``scheduler`` is
+    either ``stages`` or ``dag``, and selects the mode for
+    :meth:`~system.BuildSystem.run()`. ``engine`` is either ``pool`` or
+    ``asyncio``, which runs the build with
+    :meth:`~system.BuildSystem.run_async()`. ``build_log`` is the path of a
+    :class:`~buildlog.BuildLog` to read and update, or ``None``. ``max_load``
+    holds back new jobs while the load average is at or above the limit.
+    ``mem_ceiling`` limits the sum of the memory estimates of running jobs,
+    and does not work with the ``asyncio`` engine.
+    ``executor`` replaces the :attr:`~system.BuildSystem.executor` of the
+    build system, e.g. with a :class:`~remote.RemoteExecutor`. ``cache`` is
+    an :class:`~cache.ActionCache` for the build, or ``None``, and does not
+    work with the ``asyncio`` engine.
+    ``digest_cache`` is the path of a :class:`~dependency.DigestCache` for the
+    ``hash`` check, or ``None``. ``hash_algorithm`` and ``hash_block_size``
+    select the digest algorithm of the ``hash`` check and the size of its
+    reads.
     """
 
+    if executor is not None and engine == 'asyncio':
+        logger.critical('the asyncio engine cannot run jobs on remote workers.')
+        raise StageRunError('cannot use asyncio engine with an executor.')
+
+    if cache is not None and engine == 'asyncio':
+        logger.critical('the asyncio engine does not restore or store outputs in a cache.')
+        raise StageRunError('cannot use asyncio engine with a cache.')
+
+    if mem_ceiling is not None and engine == 'asyncio':
+        logger.critical('the asyncio engine does not limit jobs by their memory estimates.')
+        raise StageRunError('cannot use asyncio engine with a memory ceiling.')
+
     if os.path.isdir('buildc') or os.path.exists('buildc.py'):
         try:
             from buildc import functions
@@ -54,6 +93,27 @@ def stages(jobs, stages, file, check):
     bsg = BuildSystemGenerator(functions)
     bsg.check_method = check
 
+    if build_log:
+        log = BuildLog(build_log)
+        log.load()
+    else:
+        log = None
+
+    bsg.check.log = log
+
+    if hash_block_size:
+        bsg.check.block_size = hash_block_size
+
+    bsg.check.algorithm = hash_algorithm
+
+    if digest_cache:
+        digests = DigestCache(digest_cache, bsg.check.stats, bsg.check.algorithm,
+                              bsg.check.block_size)
+        digests.load()
+        bsg.check.digests = digests
+    else:
+        digests = None
+
     if functions is None:
         logger.info('no python functions pre-loaded')
 
@@ -65,15 +125,37 @@ def stages(jobs, stages, file, check):
         else:
             logger.warning('format of {0} is unclear, not parsing'.format(fn))
 
-    bsg.finalize()
-    bsg.system.workers(jobs)
+    bsg.finalize(stages or None)
+    bsg.system.workers = jobs
 
-    if not stages:
-        bsg.system.run()
-    else:
-        bsg = narrow_buildsystem(stages, bsg.system)
-        bsg.system.workers(jobs)
-        bsg.run()
+    bsg.system.log = log
+    bsg.system.max_load = max_load
+    bsg.system.mem_ceiling = mem_ceiling
+
+    if executor is not None:
+        bsg.system.executor = executor
+
+    if cache is not None:
+        # share digests, and the digest algorithm, with the dependency check.
+        cache.digest = bsg.check._digest
+        bsg.system.cache = cache
+
+    try:
+        if engine == 'asyncio':
+            import asyncio
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(bsg.system.run_async(mode=scheduler))
+            finally:
+                loop.close()
+        else:
+            bsg.system.run(mode=scheduler)
+    finally:
+        if log is not None:
+            log.close()
+
+        if digests is not None:
+            digests.close()
 
 
 ############### functions to generate makefiles ###############
@@ -217,16 +299,78 @@ def cli_ui():
 
     parser.add_argument('--log', '-l', action='store', default=False)
     parser.add_argument('--debug', action='store_true', default=False)
-    parser.add_argument('--jobs', '-j', action='store', type=int, default=cpu_count)
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=cpu_count())
     parser.add_argument('--tool', '-t', action='store', default='buildc',
                         choices=['buildc', 'make', 'makefile', 'ninja', 'ninjabuild', 'ninja.build'],
                         help="Sets which build tool to use. By default buildc uses, \
                              buildcloth's own build runners. Specify another build tool \
                              to use buildc as a metabuild tool.")
+    parser.add_argument('--mode', '-m', action='store', default='build',
+                        choices=['build', 'coordinator', 'worker', 'cache-gc'],
+                        help="'build' runs the build. 'coordinator' runs the build on the \
+                             workers that connect to --address, and 'worker' runs jobs \
+                             for a coordinator. 'cache-gc' trims the --cache or \
+                             --shared-cache directory, and builds nothing.")
+    parser.add_argument('--scheduler', '-s', action='store', default='stages',
+                        choices=['stages', 'dag'],
+                        help="for buildcloth runners, specifies how to order jobs. 'stages' \
+                             runs groups of jobs one after another, 'dag' starts each \
+                             target as soon as its dependencies complete.")
+    parser.add_argument('--engine', '-e', action='store', default='pool',
+                        choices=['pool', 'asyncio'],
+                        help="for buildcloth runners, specifies how to run jobs. 'pool' \
+                             uses worker pools, 'asyncio' waits on every command from \
+                             one event loop, which suits stages with many small commands.")
+    parser.add_argument('--build-log', action='store', default='.buildc_log',
+                        help="for buildcloth runners, the file that records the outcome \
+                             of every target between builds. Pass an empty string to \
+                             disable the build log.")
+    parser.add_argument('--digest-cache', action='store', default='.buildc_digests',
+                        help="for buildcloth runners, the file that stores the digests \
+                             of files between builds, so that '--check hash' only reads \
+                             files that changed. Pass an empty string to disable it.")
+    parser.add_argument('--hash-algorithm', action='store', default='md5',
+                        choices=list(ALGORITHMS),
+                        help="for buildcloth runners, the digest algorithm of '--check \
+                             hash' and '--check mtime+hash'. Changing the algorithm rebuilds every target once.")
+    parser.add_argument('--hash-block-size', action='store', type=parse_size, default=None,
+                        help="for buildcloth runners, the size of the reads that hash \
+                             files for '--check hash', e.g. 1M.")
+    parser.add_argument('--max-load', action='store', type=float, default=None,
+                        help="for buildcloth runners, do not start new jobs while the \
+                             load average is at or above this value, unless no other \
+                             jobs are running.")
+    parser.add_argument('--mem-ceiling', action='store', type=parse_size, default=None,
+                        help="for buildcloth runners, the most memory that the 'mem' \
+                             estimates of running jobs may add up to, e.g. 16G.")
+    parser.add_argument('--cache', action='store', default=None,
+                        help="for buildcloth runners, a directory that stores the \
+                             outputs of targets, and restores them when a target's \
+                             job and dependencies match an earlier build.")
+    parser.add_argument('--cache-size', action='store', type=parse_size, default=None,
+                        help="for buildcloth runners, the most that the --cache directory \
+                             holds before it evicts the least recently used outputs, \
+                             e.g. 10G. Defaults to 1G. For '--mode cache-gc', the size \
+                             budget of the cache.")
+    parser.add_argument('--shared-cache', action='store', default=None,
+                        help="for buildcloth runners, like --cache, for a directory that \
+                             many hosts share, e.g. on NFS. Builds never evict outputs \
+                             from a shared cache: run '--mode cache-gc' instead.")
+    parser.add_argument('--cache-age', action='store', type=parse_age, default=None,
+                        help="for '--mode cache-gc', remove outputs that no build used \
+                             in this long, e.g. 7d.")
+    parser.add_argument('--address', action='store', type=parse_address,
+                        default=DEFAULT_ADDRESS,
+                        help="for '--mode coordinator' and '--mode worker', the \
+                             host:port that the coordinator listens on.")
+    parser.add_argument('--authkey', action='store',
+                        default=os.environ.get('BUILDC_AUTHKEY'),
+                        help="for '--mode coordinator' and '--mode worker', the \
+                             shared secret. Defaults to BUILDC_AUTHKEY in the environment.")
     parser.add_argument('--file', '-f', action='append',
                         default=list())
-    parser.add_argument('--check', '-c', action='append',
-                        default='mtime', choices=['mtime', 'force', 'ignore'],
+    parser.add_argument('--check', '-c', action='store',
+                        default='mtime', choices=['mtime', 'hash', 'mtime+hash', 'force', 'ignore'],
                         help='for buildcloth runners, specifies which to use for testing dependency rebuilds.')
 
     parser.add_argument('--path', '-p', action='append',
@@ -257,11 +401,41 @@ def cli_ui():
 
     return args
 
+def _cache(ui):
+    """
+    :returns: The :class:`~cache.ActionCache` that the ``--cache`` or
+       ``--shared-cache`` options describe, or ``None``.
+    """
+
+    if ui.shared_cache:
+        return SharedCache(ui.shared_cache, ui.cache_size)
+    elif ui.cache:
+        return ActionCache(ui.cache, ui.cache_size)
+    else:
+        return None
+
 def main():
     ui = cli_ui()
 
-    if ui.tool == 'buildc':
-        stages(ui.jobs, ui.stages, ui.file, ui.check)
+    if ui.mode == 'cache-gc':
+        cache = _cache(ui)
+
+        if cache is None:
+            logger.critical("'buildc --mode cache-gc' needs --cache or --shared-cache.")
+            sys.exit(1)
+
+        cache.gc(ui.cache_size, ui.cache_age)
+    elif ui.mode == 'worker':
+        RemoteWorker(ui.address, ui.authkey, ui.jobs, ui.max_load).run()
+    elif ui.mode == 'coordinator':
+        executor = functools.partial(RemoteExecutor, address=ui.address, authkey=ui.authkey)
+        stages(ui.jobs, ui.stages, ui.file, ui.check, ui.scheduler, ui.engine, ui.build_log,
+               None, ui.mem_ceiling, executor, _cache(ui), ui.digest_cache, ui.hash_algorithm,
+               ui.hash_block_size)
+    elif ui.tool == 'buildc':
+        stages(ui.jobs, ui.stages, ui.file, ui.check, ui.scheduler, ui.engine, ui.build_log,
+               ui.max_load, ui.mem_ceiling, None, _cache(ui), ui.digest_cache, ui.hash_algorithm,
+               ui.hash_block_size)
     elif ui.tool.startswith('make'):
         make(ui.file, ui.stages)
     elif ui.too.startswith('ninja'):
@@ -0,0 +1,440 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`buildlog` records the outcome of every target that buildcloth builds,
+so that later builds can use the results of earlier builds.
+
+:class:`~buildlog.BuildLog()` stores, for each target, the start and end time
+of the most recent job that built the target, the exit status, a fingerprint
+of the job, a signature of the output file, the peak memory use of the
+job, when known, and a digest of the dependencies of targets built with the
+``hash`` check. The log is a text file with one
+tab-separated record per line. Builds only append to the file, and
+:meth:`~buildlog.BuildLog.load()` rewrites the file without superseded
+records once they outnumber the current records.
+
+:class:`~scheduler.BuildGraph()` uses the recorded durations to decide which
+targets to start first, and :class:`~dependency.DependencyChecks()` rebuilds
+targets that failed or whose jobs changed since the last build, and, with the
+``hash`` check, targets whose dependencies changed since the last build. Recorded
+peak memory use replaces the ``mem`` estimate of a job spec in later builds.
+"""
+
+import os
+import time
+import hashlib
+import inspect
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+LOG_HEADER = '# buildcloth log v3\n'
+
+LOG_HEADER_V1 = '# buildcloth log v1\n'
+"The header of logs without peak memory use, which :meth:`~buildlog.BuildLog.load()` upgrades."
+
+LOG_HEADER_V2 = '# buildcloth log v2\n'
+"The header of logs without dependency digests, which :meth:`~buildlog.BuildLog.load()` upgrades."
+
+COMPACT_MIN_RECORDS = 100
+"Do not compact logs with fewer records than this."
+
+COMPACT_RATIO = 3
+"Compact the log when it has more than this many records per target."
+
+_SCALARS = (str, bytes, int, float, complex, bool, type(None))
+
+def _stable(value):
+    """
+    :returns: ``value``, with every set sorted, every dict ordered by key, and
+       functions and classes replaced by their module and name, so that its
+       ``repr()`` is the same in every process.
+
+    :raises: :exc:`python:TypeError` if ``value`` holds an object whose
+       ``repr()`` may differ between processes, e.g. one that includes a
+       memory address.
+    """
+
+    if type(value) in _SCALARS:
+        return value
+    elif isinstance(value, list):
+        return [ _stable(item) for item in value ]
+    elif isinstance(value, tuple):
+        return tuple(_stable(item) for item in value)
+    elif isinstance(value, dict):
+        return dict(sorted(((_stable(key), _stable(item)) for key, item in value.items()),
+                           key=lambda pair: repr(pair[0])))
+    elif isinstance(value, (set, frozenset)):
+        return sorted((_stable(item) for item in value), key=repr)
+    elif inspect.isfunction(value) or inspect.isbuiltin(value) or inspect.isclass(value):
+        return (value.__module__, value.__qualname__)
+    else:
+        raise TypeError('{0} objects have no stable representation'.format(type(value).__name__))
+
+def job_fingerprint(job):
+    """
+    :param tuple job: A job tuple, with a callable and its arguments.
+
+    :returns: A hex digest that identifies the callable and arguments of
+       ``job``. For jobs that run the jobs of another
+       :class:`~stages.BuildSteps` object, covers all of the nested jobs.
+       When an argument has no stable representation, e.g. an object without
+       a ``__repr__()`` of its own, covers only the module and name of the
+       callable, so that the fingerprint does not change on every run.
+    """
+
+    func, args = job
+    owner = getattr(func, '__self__', None)
+
+    if owner is not None and hasattr(owner, 'stage'):
+        desc = [ job_fingerprint(nested) for nested in owner.stage ]
+    else:
+        desc = [ getattr(func, '__module__', None), getattr(func, '__name__', repr(func)) ]
+
+        try:
+            if isinstance(args, dict):
+                desc.append(sorted(_stable(args).items()))
+            else:
+                desc.append(_stable(args))
+        except TypeError as e:
+            logger.debug('fingerprinting {0} without its arguments: {1}'.format(desc[1], e))
+
+    return hashlib.md5(repr(desc).encode('utf-8')).hexdigest()
+
+def output_signature(path):
+    """
+    :param path path: The path of a file.
+
+    :returns: A string derived from the modification time and size of
+       ``path``, or ``-`` if ``path`` does not exist.
+    """
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '-'
+
+    return '{0:x}-{1:x}'.format(int(st.st_mtime * 1e9), st.st_size)
+
+class BuildLogEntry(namedtuple('BuildLogEntry', ['target', 'start', 'end', 'status',
+                                                 'fingerprint', 'signature', 'peak', 'inputs'])):
+    """
+    A record of the most recent job that built a target. ``start`` and
+    ``end`` are times in seconds since the epoch, or ``None`` for jobs that
+    only ran within a stage, ``status`` is ``0`` for
+    jobs that succeeded, ``peak`` is the peak resident set size of the
+    job in bytes, or ``None`` if unknown, and ``inputs`` is the
+    :func:`~dependency.inputs_digest()` of the dependencies of the target
+    when the job succeeded, or ``None``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        "The number of seconds the job took to run, or ``None`` if unknown."
+
+        if self.start is None or self.end is None:
+            return None
+
+        return self.end - self.start
+
+    def format(self):
+        ":returns: The entry as a line in the log file."
+
+        start = '-' if self.start is None else int(self.start * 1000)
+        end = '-' if self.end is None else int(self.end * 1000)
+
+        return '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n'.format(start,
+                                                                 end,
+                                                                 self.status,
+                                                                 '-' if self.peak is None else self.peak,
+                                                                 self.fingerprint,
+                                                                 self.signature,
+                                                                 '-' if self.inputs is None else self.inputs,
+                                                                 self.target)
+
+    @classmethod
+    def parse(cls, line, header=LOG_HEADER):
+        """
+        :param string line: A line from a log file.
+
+        :param string header: Optional. The header of the log file, which
+           identifies the format of ``line``.
+
+        :returns: A :class:`~buildlog.BuildLogEntry`.
+
+        :raises: :exc:`python:ValueError` if ``line`` is malformed.
+        """
+
+        inputs = '-'
+
+        if header == LOG_HEADER_V1:
+            start, end, status, fingerprint, signature, target = line.rstrip('\n').split('\t', 5)
+            peak = '-'
+        elif header == LOG_HEADER_V2:
+            start, end, status, peak, fingerprint, signature, target = line.rstrip('\n').split('\t', 6)
+        else:
+            start, end, status, peak, fingerprint, signature, inputs, target = line.rstrip('\n').split('\t', 7)
+
+        return cls(target,
+                   None if start == '-' else int(start) / 1000.0,
+                   None if end == '-' else int(end) / 1000.0,
+                   int(status), fingerprint, signature,
+                   None if peak == '-' else int(peak),
+                   None if inputs == '-' else inputs)
+
+BuildLogEntry.__new__.__defaults__ = (None, None)
+
+class BuildLog(object):
+    """
+    :param path path: Optional. The path of the log file. Defaults to
+       ``.buildc_log`` in the current directory.
+
+    Call :meth:`~buildlog.BuildLog.load()` to read the existing records
+    before recording new ones, and :meth:`~buildlog.BuildLog.close()` when
+    the build completes. Use :class:`~buildlog.BuildLog()` as a context
+    manager to close the log automatically.
+    """
+
+    def __init__(self, path='.buildc_log'):
+        self.path = path
+        "The path of the log file."
+
+        self.entries = {}
+        "Mapping of targets to their most recent :class:`~buildlog.BuildLogEntry`."
+
+        self._records = 0
+        "The number of records in the log file, including superseded records."
+
+        self._file = None
+        "The log file, open for appending, once a record has been written."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, target):
+        return target in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, target):
+        """
+        :returns: The most recent :class:`~buildlog.BuildLogEntry` for
+           ``target``, or ``None``.
+        """
+
+        return self.entries.get(target)
+
+    def load(self):
+        """
+        Reads the records in the log file into
+        :attr:`~buildlog.BuildLog.entries`, where later records for a target
+        replace earlier records. Ignores malformed records, and logs from
+        other versions of buildcloth. Compacts the log file if needed.
+
+        :returns: :attr:`~buildlog.BuildLog.entries`
+        """
+
+        self.entries = {}
+        self._records = 0
+
+        upgrade = False
+
+        try:
+            with open(self.path, 'r') as f:
+                header = f.readline()
+
+                if header in (LOG_HEADER_V1, LOG_HEADER_V2):
+                    upgrade = True
+                elif header != LOG_HEADER:
+                    logger.warning('{0} is not a current buildcloth log, starting a new log.'.format(self.path))
+                    self._records = None
+
+                for line in f:
+                    if self._records is None:
+                        break
+
+                    try:
+                        entry = BuildLogEntry.parse(line, header)
+                    except ValueError:
+                        logger.warning('skipping malformed record in {0}'.format(self.path))
+                        continue
+
+                    self.entries[entry.target] = entry
+                    self._records += 1
+        except IOError:
+            logger.debug('no build log at {0}'.format(self.path))
+            return self.entries
+
+        if self._records is None or upgrade is True:
+            self.compact()
+            return self.entries
+
+        logger.debug('loaded {0} targets from {1}'.format(len(self.entries), self.path))
+
+        if self._records > COMPACT_MIN_RECORDS and self._records > COMPACT_RATIO * len(self.entries):
+            self.compact()
+
+        return self.entries
+
+    def record(self, target, start, end, status=0, fingerprint='-', signature=None, peak=None,
+               inputs=None):
+        """
+        :param string target: The name of the target.
+
+        :param float start: The time the job started, or ``None`` if the
+           job did not run on its own.
+
+        :param float end: The time the job completed, or ``None``. If
+           ``start`` or ``end`` is ``None``, keeps the times of the previous
+           record for ``target``, so that jobs that ran alongside other jobs,
+           e.g. in a stage, do not replace the duration of the job.
+
+        :param int status: Optional. The exit status of the job. Defaults to
+           ``0``.
+
+        :param string fingerprint: Optional. A fingerprint of the job, as
+           returned by :func:`~buildlog.job_fingerprint()`.
+
+        :param string signature: Optional. The signature of the output. If
+           ``None``, uses :func:`~buildlog.output_signature()` of ``target``.
+
+        :param int peak: Optional. The peak resident set size of the job in
+           bytes. If ``None``, keeps the peak of the previous record for
+           ``target``.
+
+        :param string inputs: Optional. The
+           :func:`~dependency.inputs_digest()` of the dependencies of
+           ``target``.
+
+        Appends a record to the log file.
+
+        :returns: The new :class:`~buildlog.BuildLogEntry`.
+        """
+
+        if signature is None:
+            signature = output_signature(target)
+
+        if peak is None and target in self.entries:
+            peak = self.entries[target].peak
+
+        if start is None or end is None:
+            if target in self.entries:
+                start, end = self.entries[target].start, self.entries[target].end
+            else:
+                start, end = None, None
+
+        entry = BuildLogEntry(target, start, end, status, fingerprint, signature, peak, inputs)
+
+        if self._file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, 'a')
+
+            if new:
+                self._file.write(LOG_HEADER)
+
+        self._file.write(entry.format())
+        self._file.flush()
+
+        self.entries[target] = entry
+        self._records += 1
+
+        return entry
+
+    def compact(self):
+        """Rewrites the log file with only the most recent record for each
+        target. Replaces the log file atomically."""
+
+        self.close()
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(LOG_HEADER)
+            for target in sorted(self.entries):
+                f.write(self.entries[target].format())
+
+        os.rename(tmp, self.path)
+        self._records = len(self.entries)
+
+        logger.info('compacted build log {0} to {1} records'.format(self.path, self._records))
+
+    def close(self):
+        "Closes the log file."
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def durations(self):
+        """
+        :returns: A dict that maps targets to the number of seconds the most
+           recent successful job for the target took to run. Omits targets
+           whose jobs never ran on their own.
+        """
+
+        return dict((target, entry.duration)
+                    for target, entry in self.entries.items()
+                    if entry.status == 0 and entry.duration is not None)
+
+    def peaks(self):
+        """
+        :returns: A dict that maps targets to the most recently measured
+           peak resident set size of their jobs, in bytes.
+        """
+
+        return dict((target, entry.peak)
+                    for target, entry in self.entries.items()
+                    if entry.peak is not None)
+
+def record_job(log, target, job, start, status=0, peak=None, inputs=None):
+    """
+    :param BuildLog log: A :class:`~buildlog.BuildLog` object, or ``None``.
+
+    :param string target: The name of the target.
+
+    :param tuple job: The job that built ``target``.
+
+    :param float start: The time the job started, or ``None`` if the job did
+       not run on its own, e.g. in a stage, so that the log keeps the
+       previous duration of the job.
+
+    :param status: The exit status of the job, or the exception that the job
+       raised, which counts as the exit status of a failed command or as
+       ``1``.
+
+    :param int peak: Optional. The peak resident set size of the job in bytes.
+
+    :param string inputs: Optional. The :func:`~dependency.inputs_digest()` of
+       the dependencies of ``target``.
+
+    Records the outcome of ``job`` in ``log``, ending at the current time. Does
+    nothing if ``log`` is ``None``.
+    """
+
+    if log is None:
+        return
+
+    if isinstance(status, Exception):
+        status = getattr(status, 'status', 1)
+
+    end = None if start is None else time.time()
+
+    log.record(target, start, end, status, job_fingerprint(job), peak=peak, inputs=inputs)
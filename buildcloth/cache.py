@@ -0,0 +1,452 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`cache` stores the outputs of targets, so that builds can restore a
+target rather than run its job again when the job and the contents of its
+dependencies match an earlier build, for example after switching branches.
+
+:class:`~cache.ActionCache()` keys every target by a digest of its job, as
+from :func:`~buildlog.job_fingerprint()`, and the names and contents of the
+files it depends upon. The cache stores the contents of every output file
+once, under the digest of its contents, and evicts the least recently used
+files once the cache grows larger than its size limit.
+
+:class:`~cache.SharedCache()` stores outputs in a directory that many hosts
+share, e.g. on NFS, so that CI jobs reuse each other's outputs. Every file in
+a cache appears with a single rename, so that concurrent builds never read
+partial files, and only :meth:`~cache.ActionCache.gc()` evicts outputs from a
+shared cache.
+
+Set the :attr:`~system.BuildSystem.cache` of a build system, or use the
+``buildc --cache`` or ``buildc --shared-cache`` options, to use a cache. Use
+``buildc --mode cache-gc`` to trim a cache to a size or age budget.
+"""
+
+import os
+import re
+import time
+import uuid
+import socket
+import shutil
+import hashlib
+import logging
+
+from buildcloth.buildlog import job_fingerprint, output_signature
+from buildcloth.dependency import md5_file_check
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 2**30
+"The size, in bytes, above which :class:`~cache.ActionCache` evicts outputs by default."
+
+TMP_MAX_AGE = 3600
+"The number of seconds after which :meth:`~cache.ActionCache.gc()` removes abandoned temporary files."
+
+def parse_age(value):
+    """
+    :param value: A number of seconds, or a string with an ``s``, ``m``,
+       ``h``, ``d``, or ``w`` suffix, e.g. ``7d``.
+
+    :returns: The number of seconds, as a float.
+
+    :raises: :exc:`python:ValueError` if ``value`` is not an age.
+    """
+
+    if isinstance(value, bool):
+        raise ValueError('{0} is not an age'.format(value))
+    elif isinstance(value, (int, float)):
+        age = float(value)
+    else:
+        match = re.match(r'^\s*([0-9]+(?:\.[0-9]*)?)\s*([smhdw]?)\s*$', str(value).lower())
+
+        if match is None:
+            raise ValueError('{0} is not an age'.format(value))
+
+        units = { '': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+        age = float(match.group(1)) * units[match.group(2)]
+
+    if age < 0:
+        raise ValueError('{0} is not an age'.format(value))
+
+    return age
+
+class ActionCache(object):
+    """
+    :param path path: The directory that holds the cache. Created when the
+       cache stores its first output.
+
+    :param int max_size: Optional. The number of bytes of outputs to keep.
+       Defaults to :data:`~cache.DEFAULT_MAX_SIZE`.
+
+    :param callable digest: Optional. A function that returns the hex digest
+       of the contents of a file, for the cache keys. Defaults to
+       :func:`~dependency.md5_file_check()`.
+
+    The cache directory holds an ``objects`` directory, with the content of
+    every output in a file named for the md5 digest of the content, and an
+    ``actions`` directory, with a file for every cache key that names the
+    object and file mode of the output. Both directories have a subdirectory
+    for the first two characters of each digest, so that no directory grows
+    too large. Restoring an output marks its object as recently used.
+    """
+
+    def __init__(self, path='.buildc_cache', max_size=None, digest=None):
+        if max_size is None:
+            max_size = DEFAULT_MAX_SIZE
+
+        if digest is None:
+            digest = md5_file_check
+
+        self.digest = digest
+        """The function that returns the digest of a dependency. ``buildc``
+        uses the digests of the dependency check, e.g.
+        :meth:`~dependency.DependencyChecks._digest()`, so that the cache
+        reads the :class:`~dependency.DigestCache` rather than hashing every
+        dependency again."""
+
+        self.path = path
+        "The directory that holds the cache."
+
+        self.max_size = max_size
+        "The number of bytes of outputs to keep."
+
+        self.hits = 0
+        "The number of outputs restored from the cache."
+
+        self.misses = 0
+        "The number of lookups that found no usable output."
+
+        self._size = None
+        "The size of all objects in the cache, once known."
+
+    def _path(self, kind, digest):
+        """
+        :param string kind: Either ``objects`` or ``actions``.
+
+        :param string digest: A hex digest.
+
+        :returns: The path of the entry for ``digest``.
+        """
+
+        return os.path.join(self.path, kind, digest[:2], digest)
+
+    @staticmethod
+    def _tmp(path):
+        """
+        :returns: A temporary path next to ``path``, unique across threads,
+           processes, and hosts that share the directory.
+        """
+
+        return '{0}.{1}.{2}.tmp'.format(path, socket.gethostname(), uuid.uuid4().hex)
+
+    def _publish(self, source, path):
+        """
+        Copies ``source`` to a temporary file next to ``path``, and then
+        renames the copy to ``path``, so that readers never see a partial
+        file.
+        """
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp = self._tmp(path)
+
+        try:
+            shutil.copyfile(source, tmp)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def key(self, job, dependency):
+        """
+        :param tuple job: A job tuple, with a callable and its arguments.
+
+        :param list dependency: The paths of the files that the target
+           depends upon.
+
+        :returns: A hex digest of the job and the names and contents of
+           ``dependency``, or ``None`` if a dependency is not a file, and so
+           the target cannot use the cache.
+        """
+
+        key = hashlib.md5(job_fingerprint(job).encode('utf-8'))
+
+        for dep in dependency or []:
+            if not os.path.isfile(dep):
+                logger.debug('cannot cache target that depends on {0}, which is not a file.'.format(dep))
+                return None
+
+            key.update('\0{0}\0{1}'.format(dep, self.digest(dep)).encode('utf-8'))
+
+        return key.hexdigest()
+
+    def restore(self, key, target):
+        """
+        :param string key: A key from :meth:`~cache.ActionCache.key()`.
+
+        :param path target: The path of the output to restore.
+
+        :returns: ``True`` if the cache has an output for ``key``, and
+           replaced ``target`` with it, and ``False`` otherwise.
+        """
+
+        action = self._path('actions', key)
+
+        try:
+            with open(action, 'r') as f:
+                digest, mode = f.read().split()
+
+            obj = self._path('objects', digest)
+            self._publish(obj, target)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            logger.debug('no cached output for {0}'.format(target))
+            return False
+
+        os.chmod(target, int(mode, 8))
+
+        # mark the entry as recently used.
+        for path in (obj, action):
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+        self.hits += 1
+        logger.info('restored {0} from the cache'.format(target))
+        return True
+
+    def store(self, key, target, signature=None):
+        """
+        :param string key: A key from :meth:`~cache.ActionCache.key()`.
+
+        :param path target: The path of an output that a job built.
+
+        :param string signature: Optional. The
+           :func:`~buildlog.output_signature()` of ``target`` from before the
+           job ran. If ``target`` still has this signature, the job did not
+           write ``target`` (e.g. for targets that name source files), and
+           the cache does not store it.
+
+        :returns: ``True`` if the cache stored ``target`` under ``key``, and
+           ``False`` if ``target`` is not a file, or the job did not write it.
+
+        Evicts the least recently used outputs if the cache grows larger than
+        :attr:`~cache.ActionCache.max_size`.
+        """
+
+        if not os.path.isfile(target):
+            logger.debug('not caching {0}, which is not a file.'.format(target))
+            return False
+        elif signature is not None and signature == output_signature(target):
+            logger.debug('not caching {0}, which its job did not write.'.format(target))
+            return False
+
+        digest = md5_file_check(target)
+        obj = self._path('objects', digest)
+
+        if os.path.exists(obj):
+            os.utime(obj, None)
+        else:
+            self._publish(target, obj)
+
+            if self._size is not None:
+                self._size += os.path.getsize(obj)
+
+        action = self._path('actions', key)
+        if not os.path.isdir(os.path.dirname(action)):
+            os.makedirs(os.path.dirname(action))
+
+        tmp = self._tmp(action)
+        with open(tmp, 'w') as f:
+            f.write('{0} {1:o}\n'.format(digest, os.stat(target).st_mode & 0o7777))
+        os.rename(tmp, action)
+
+        logger.debug('stored {0} in the cache'.format(target))
+        self._evict()
+
+        return True
+
+    def _evict(self):
+        """
+        Called after every :meth:`~cache.ActionCache.store()`. Trims the cache
+        if it holds more than :attr:`~cache.ActionCache.max_size` bytes.
+        """
+
+        if self.size() > self.max_size:
+            self.trim()
+
+    def _objects(self, kind='objects', tmp=False):
+        """
+        :param string kind: Optional. Either ``objects`` or ``actions``.
+
+        :param bool tmp: Optional. If ``True``, lists temporary files rather
+           than entries.
+
+        :returns: A list of ``(mtime, size, path)`` tuples for every entry
+           in the cache.
+        """
+
+        objects = []
+        root = os.path.join(self.path, kind)
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                if fn.endswith('.tmp') is not tmp:
+                    continue
+
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                objects.append((st.st_mtime, st.st_size, path))
+
+        return objects
+
+    def size(self):
+        ":returns: The number of bytes of outputs in the cache."
+
+        if self._size is None:
+            self._size = sum(obj[1] for obj in self._objects())
+
+        return self._size
+
+    def trim(self, max_size=None):
+        """
+        :param int max_size: Optional. Defaults to
+           :attr:`~cache.ActionCache.max_size`. If neither is set, removes
+           nothing.
+
+        Removes the least recently used outputs until the cache holds at most
+        ``max_size`` bytes. Keys whose outputs the cache removed become misses.
+
+        :returns: The number of outputs removed.
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+
+            if max_size is None:
+                return 0
+
+        objects = self._objects()
+        size = sum(obj[1] for obj in objects)
+        removed = 0
+
+        for mtime, obj_size, path in sorted(objects):
+            if size <= max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            size -= obj_size
+            removed += 1
+
+        self._size = size
+        logger.info('evicted {0} outputs from the cache, which holds {1} bytes'.format(removed, size))
+
+        return removed
+
+    def gc(self, max_size=None, max_age=None):
+        """
+        :param int max_size: Optional. The number of bytes of outputs to
+           keep. Defaults to :attr:`~cache.ActionCache.max_size`, if set.
+
+        :param float max_age: Optional. Removes outputs and keys that no
+           build used in this many seconds.
+
+        Trims the cache to its budget: removes the outputs that were last
+        used before ``max_age``, then the least recently used outputs until
+        the cache holds at most ``max_size`` bytes, then the keys whose
+        outputs are gone, as well as temporary files that writers abandoned.
+        Safe to run while builds use the cache.
+
+        :returns: The number of outputs removed.
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+
+        now = time.time()
+        removed = 0
+
+        if max_age is not None:
+            for mtime, size, path in self._objects():
+                if now - mtime > max_age:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+
+        if max_size is not None:
+            removed += self.trim(max_size)
+
+        for mtime, size, path in self._objects('actions'):
+            try:
+                with open(path, 'r') as f:
+                    digest = f.read().split()[0]
+            except (IOError, OSError, IndexError):
+                digest = None
+
+            stale = max_age is not None and now - mtime > max_age
+
+            if digest is None or stale or not os.path.exists(self._path('objects', digest)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        for kind in ('objects', 'actions'):
+            for mtime, size, path in self._objects(kind, tmp=True):
+                if now - mtime > TMP_MAX_AGE:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+        self._size = None
+        logger.info('removed {0} outputs from the cache in {1}'.format(removed, self.path))
+
+        return removed
+
+class SharedCache(ActionCache):
+    """
+    :param path path: The shared directory that holds the cache.
+
+    :param int max_size: Optional. The default budget for
+       :meth:`~cache.ActionCache.gc()`. ``None`` by default.
+
+    An :class:`~cache.ActionCache` for a directory that many hosts or builds
+    use at once, such as a directory on NFS. Builds never evict outputs, since
+    the size of a shared cache changes under every build; run
+    :meth:`~cache.ActionCache.gc()`, e.g. with ``buildc --mode cache-gc``, from a
+    single scheduled job instead.
+    """
+
+    def __init__(self, path, max_size=None, digest=None):
+        super(SharedCache, self).__init__(path, digest=digest)
+        self.max_size = max_size
+
+    def _evict(self):
+        pass
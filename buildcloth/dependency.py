@@ -16,65 +16,511 @@
 :mod:`dependency` provides a set of tools for checking if dependencies need to
 be rebuilt. :class:`~dependency.DependencyChecks` provides a flexible interface
 to this dependency checking.
+
+:class:`~dependency.StatCache` remembers the result of every ``stat()`` call
+for the duration of a build, so that checks stat files that many targets
+depend upon (e.g. shared headers) only once.
+:class:`~dependency.DigestCache` remembers the digests of files between
+builds, so that the ``hash`` check only reads files that changed, and hashes
+each file once per build no matter how many targets depend upon it.
+:meth:`~dependency.DigestCache.prefetch()` hashes many files at once on a
+thread pool.
+
+With a :class:`~buildlog.BuildLog`, the ``hash`` check compares the current
+digests of the dependencies of a target with the digests that
+:func:`~dependency.inputs_digest()` recorded when the target last built.
+
+The ``mtime+hash`` check stats every dependency first, as ``mtime`` does, and
+only compares digests, as ``hash`` does, for targets that look stale. Files
+that a checkout touched without changing them do not rebuild their targets,
+and with a persistent :class:`~dependency.DigestCache` only files whose size
+or times changed are read.
+
+The hash checks use one of the :data:`~dependency.ALGORITHMS`, which
+:attr:`~dependency.DependencyChecks.algorithm` selects. Digest caches and
+recorded dependency digests from another algorithm never match, so changing
+the algorithm rebuilds every target once.
 """
 
 from buildcloth.err import DependencyCheckError
 from buildcloth.utils import is_function
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
 import inspect
 import hashlib
 import logging
+import errno
+import mmap
+import time
 import os
 
 logger = logging.getLogger(__name__)
 
-def mtime_check(target, dependency):
+ALGORITHMS = ('blake2b', 'sha256', 'md5')
+"The digest algorithms that the ``hash`` and ``mtime+hash`` checks support."
+
+HASH_CHECKS = ('hash', 'mtime+hash')
+"""The checks that compare digests, and record the digests of the
+dependencies of targets in a :class:`~buildlog.BuildLog`."""
+
+DEFAULT_ALGORITHM = 'md5'
+
+DIGEST_HEADER = '# buildcloth digests v2 {0}\n'
+"""The header of digest cache files, formatted with the name of the
+algorithm of the digests in the file."""
+
+RACY_WINDOW = 2
+"""Files modified less than this many seconds before they were hashed may
+change again without a new mtime, so :class:`~dependency.DigestCache` does not
+save their digests."""
+
+MMAP_THRESHOLD = 2**24
+"""Files of at least this many bytes are hashed through :mod:`python:mmap`
+rather than read in blocks."""
+
+BLOCK_SIZE = 2**20
+"The default size of the reads that hash files smaller than :data:`~dependency.MMAP_THRESHOLD`."
+
+class StatCache(object):
+    """
+    Caches the results of :func:`python:os.stat()`, including failures, by
+    path. Call :meth:`~dependency.StatCache.invalidate()` when a job writes a
+    file, so that later checks see the new file.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        "Mapping of paths to stat results, or ``None`` for missing files."
+
+    def __len__(self):
+        return len(self._stats)
+
+    def stat(self, path):
+        """
+        :param path path: The path of a file.
+
+        :returns: The result of :func:`python:os.stat()` for ``path``.
+
+        :raises: :exc:`python:OSError` if ``path`` does not exist.
+        """
+
+        try:
+            st = self._stats[path]
+        except KeyError:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            self._stats[path] = st
+
+        if st is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+        return st
+
+    def exists(self, path):
+        """
+        :param path path: The path of a file.
+
+        :returns: ``True`` if ``path`` exists, as with
+           :func:`python:os.path.exists()`.
+        """
+
+        try:
+            self.stat(path)
+            return True
+        except OSError:
+            return False
+
+    def invalidate(self, path=None):
+        """
+        :param path path: Optional. The path of a file that changed. If
+           ``None``, forgets every path.
+        """
+
+        if path is None:
+            self._stats.clear()
+        else:
+            self._stats.pop(path, None)
+
+def file_signature(st):
+    """
+    :param st: The result of :func:`python:os.stat()` for a file.
+
+    :returns: A ``(device, inode, size, mtime_ns, ctime_ns)`` tuple, which
+       changes whenever the content of the file may have changed.
+    """
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+class DigestCache(object):
+    """
+    :param path path: Optional. The path of the file that stores the digests.
+       Defaults to ``.buildc_digests`` in the current directory. If
+       ``None``, the cache only holds digests for the duration of a build.
+
+    :param StatCache stats: Optional. A :class:`~dependency.StatCache` to stat
+       files with.
+
+    :param string algorithm: Optional. One of the
+       :data:`~dependency.ALGORITHMS`. Defaults to ``md5``.
+
+    :param int block_size: Optional. The size of the reads that hash files.
+       See :func:`~dependency.file_digest()`.
+
+    Maps the :func:`~dependency.file_signature()` of files to their digests,
+    so that files are only hashed again when their signature changes. Call
+    :meth:`~dependency.DigestCache.load()` before the build, and
+    :meth:`~dependency.DigestCache.save()` after it.
+
+    :raises: :exc:`~err.DependencyCheckError` if ``algorithm`` is not
+       supported.
+    """
+
+    def __init__(self, path='.buildc_digests', stats=None, algorithm=DEFAULT_ALGORITHM,
+                 block_size=BLOCK_SIZE):
+        if stats is None:
+            stats = StatCache()
+
+        if algorithm not in ALGORITHMS:
+            raise DependencyCheckError('{0} is not a supported digest algorithm'.format(algorithm))
+
+        self.path = path
+        "The path of the file that stores the digests."
+
+        self.stats = stats
+        "The :class:`~dependency.StatCache` that the cache stats files with."
+
+        self.algorithm = algorithm
+        "The name of the algorithm of the digests in the cache."
+
+        self.block_size = block_size
+        "The size of the reads that hash files."
+
+        self.entries = {}
+        "Mapping of file signatures to ``(path, digest)`` tuples."
+
+        self.hashed = 0
+        "The number of files that the cache read and hashed."
+
+        self._used = set()
+        "The signatures that this build looked up or added."
+
+        self._racy = set()
+        "The signatures of files that changed moments before they were hashed."
+
+        self._dirty = False
+
+        self._lock = threading.Lock()
+        "Guards the bookkeeping of :meth:`~dependency.DigestCache.digest()`."
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """
+        Reads the digests from :attr:`~dependency.DigestCache.path`. Ignores
+        malformed records, files from other versions of buildcloth, and files
+        of digests from another :attr:`~dependency.DigestCache.algorithm`.
+
+        :returns: :attr:`~dependency.DigestCache.entries`
+        """
+
+        self.entries = {}
+
+        if self.path is None:
+            return self.entries
+
+        try:
+            with open(self.path, 'r') as f:
+                header = f.readline()
+
+                if header != DIGEST_HEADER.format(self.algorithm):
+                    if header.startswith(DIGEST_HEADER.split('{')[0]):
+                        logger.info('{0} holds digests from another algorithm than {1}, '
+                                    'ignoring it.'.format(self.path, self.algorithm))
+                    else:
+                        logger.warning('{0} is not a current digest cache, ignoring it.'.format(self.path))
+                    return self.entries
+
+                for line in f:
+                    try:
+                        fields = line.rstrip('\n').split('\t', 6)
+                        signature = tuple(int(field) for field in fields[:5])
+                        self.entries[signature] = (fields[6], fields[5])
+                    except (ValueError, IndexError):
+                        logger.warning('skipping malformed record in {0}'.format(self.path))
+        except IOError:
+            logger.debug('no digest cache at {0}'.format(self.path))
+
+        logger.debug('loaded {0} digests from {1}'.format(len(self.entries), self.path))
+        return self.entries
+
+    def digest(self, path):
+        """
+        :param path path: The path of a file.
+
+        :returns: The digest of ``path``, as from
+           :func:`~dependency.file_digest()`, from the cache if the
+           signature of ``path`` has not changed.
+
+        :raises: :exc:`python:OSError` if ``path`` does not exist.
+        """
+
+        signature = file_signature(self.stats.stat(path))
+
+        with self._lock:
+            self._used.add(signature)
+
+            if signature in self.entries:
+                return self.entries[signature][1]
+
+        now = time.time()
+        digest = file_digest(path, self.algorithm, self.block_size)
+
+        with self._lock:
+            self.hashed += 1
+
+            if now - signature[3] / 1e9 < RACY_WINDOW:
+                # only trust the digest for this build.
+                self._racy.add(signature)
+                logger.debug('not saving the digest of {0}, which changed moments ago'.format(path))
+            else:
+                self._dirty = True
+
+            self.entries[signature] = (path, digest)
+
+        return digest
+
+    def prefetch(self, paths, workers=None):
+        """
+        :param iterable paths: The paths of files.
+
+        :param int workers: Optional. The number of threads that hash files.
+           Defaults to the default of
+           :class:`python:concurrent.futures.ThreadPoolExecutor`.
+
+        Hashes every file in ``paths`` that is not in the cache on a pool of
+        threads, so that later calls to
+        :meth:`~dependency.DigestCache.digest()` return at once. Hashes each
+        file once, even if it appears in ``paths`` many times, and skips
+        missing files.
+
+        :returns: The number of files that the cache read and hashed.
+        """
+
+        pending = []
+
+        for path in set(paths):
+            try:
+                signature = file_signature(self.stats.stat(path))
+            except OSError:
+                continue
+
+            if signature not in self.entries:
+                pending.append(path)
+
+        if len(pending) == 0:
+            return 0
+        elif len(pending) == 1:
+            self.digest(pending[0])
+            return 1
+
+        hashed = self.hashed
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path in pending:
+                pool.submit(self.digest, path)
+
+        logger.debug('hashed {0} files ahead of dependency checks'.format(self.hashed - hashed))
+
+        return self.hashed - hashed
+
+    def save(self):
+        """
+        Rewrites :attr:`~dependency.DigestCache.path` atomically, if the build
+        hashed new files. Keeps the digests that the build used, and earlier
+        digests of files whose signatures still match, and prunes the rest.
+        """
+
+        if self._dirty is False or self.path is None:
+            return
+
+        entries = {}
+
+        for signature, entry in self.entries.items():
+            if signature in self._racy:
+                continue
+            elif signature not in self._used:
+                try:
+                    if file_signature(os.stat(entry[0])) != signature:
+                        continue
+                except OSError:
+                    continue
+
+            entries[signature] = entry
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(DIGEST_HEADER.format(self.algorithm))
+            for signature in sorted(entries, key=lambda sig: entries[sig][0]):
+                path, digest = entries[signature]
+                f.write('\t'.join([ str(field) for field in signature ] + [ digest, path ]) + '\n')
+
+        os.rename(tmp, self.path)
+
+        logger.info('saved {0} digests to {1}, pruned {2}'.format(len(entries), self.path,
+                                                                  len(self.entries) - len(entries)))
+        self.entries = entries
+        self._dirty = False
+
+    def close(self):
+        "Saves the digests. See :meth:`~dependency.DigestCache.save()`."
+        self.save()
+
+def mtime_check(target, dependency, stats=None):
     """
     :param path target: The path to a file to build.
 
     :param path dependency: The path of a file to that the ``target`` depends
        upon.
 
+    :param StatCache stats: Optional. A :class:`~dependency.StatCache` to
+       stat both files with.
+
     :returns: ``True`` if ``target`` has a larger *mtime* than the ``dependency``.
     """
-    if os.stat(target).st_mtime < os.stat(dependency).st_mtime:
+
+    if stats is None:
+        stat = os.stat
+    else:
+        stat = stats.stat
+
+    if stat(target).st_mtime < stat(dependency).st_mtime:
         return True
     else:
         return False
 
-def md5_file_check(file, block_size=2**20):
+def file_digest(file, algorithm=DEFAULT_ALGORITHM, block_size=BLOCK_SIZE):
     """
     :param path file: The path to a file.
 
-    :param int blocksize: The size of the block size for the hashing
-       process. Defaults to ``2**20`` or ``1048576``.
+    :param string algorithm: Optional. One of the
+       :data:`~dependency.ALGORITHMS`. Defaults to ``md5``.
+
+    :param int block_size: Optional. The size of the reads that hash the
+       file. Defaults to :data:`~dependency.BLOCK_SIZE`.
 
-    :returns: The md5 checkusm of ``file``.
+    :returns: The hex digest of ``file``. Maps files larger than
+       :data:`~dependency.MMAP_THRESHOLD` into memory rather than copying
+       blocks, and otherwise reads ``block_size`` bytes at a time into one
+       buffer. Releases the GIL while hashing, so threads may hash several
+       files at once.
+
+    :raises: :exc:`python:ValueError` if ``block_size`` is not positive.
     """
 
-    md5 = hashlib.md5()
+    if block_size < 1:
+        raise ValueError('cannot hash files in blocks of {0} bytes'.format(block_size))
+
+    digest = hashlib.new(algorithm)
 
     with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(128*md5.block_size), b''):
-            md5.update(chunk)
+        size = os.fstat(f.fileno()).st_size
+
+        if size > 0 and size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                digest.update(m)
+                return digest.hexdigest()
+
+        buf = bytearray(min(block_size, max(size, 1)))
+        view = memoryview(buf)
+
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
 
-    return md5.hexdigest()
+    return digest.hexdigest()
 
-def hash_check(target, dependency):
+def md5_file_check(file, block_size=BLOCK_SIZE):
+    """
+    :param path file: The path to a file.
+
+    :param int blocksize: The size of the block size for the hashing
+       process. Defaults to ``2**20`` or ``1048576``.
+
+    :returns: The md5 checkusm of ``file``, from
+       :func:`~dependency.file_digest()`.
+    """
+
+    return file_digest(file, 'md5', block_size)
+
+def hash_check(target, dependency, digest=None):
     """
     :param path target: The path to a file to build.
 
     :param path dependency: The path of a file to that the ``target`` depends
        upon.
 
-    :returns: ``True`` if ``target`` and ``dependency`` have different md5
-       checksums as determined by :func:`~dependency.md5_file_check()`.
+    :param callable digest: Optional. Returns the digest of a path.
+       Defaults to :func:`~dependency.md5_file_check()`, e.g. the
+       :meth:`~dependency.DigestCache.digest()` method of a cache.
+
+    :returns: ``True`` if ``target`` and ``dependency`` have different
+       digests as determined by ``digest``.
     """
 
-    if md5_file_check(target) != md5_file_check(dependency):
+    if digest is None:
+        digest = md5_file_check
+
+    if digest(target) != digest(dependency):
         return True
     else:
         return False
 
+def inputs_digest(dependency, digest=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    :param dependency: The path or list of paths of files that a target
+       depends upon.
+
+    :param callable digest: Optional. Returns the digest of a path. Defaults
+       to :func:`~dependency.file_digest()` with ``algorithm``.
+
+    :param string algorithm: Optional. One of the
+       :data:`~dependency.ALGORITHMS`. Defaults to ``md5``.
+
+    :returns: A hex digest of the paths and the digests of the ``dependency``
+       files, which changes when any of the files change, or when files are
+       added to or removed from ``dependency``. Missing files count as files
+       with the digest ``-``. Digests from algorithms other than ``md5`` start
+       with the name of the algorithm, e.g. ``blake2b:``.
+    """
+
+    if digest is None:
+        digest = functools.partial(file_digest, algorithm=algorithm)
+
+    if not isinstance(dependency, list):
+        dependency = [dependency]
+
+    inputs = hashlib.new(algorithm)
+
+    for dep in sorted(set(dependency)):
+        try:
+            dep_digest = digest(dep)
+        except (OSError, IOError):
+            dep_digest = '-'
+
+        inputs.update('{0}\t{1}\n'.format(dep, dep_digest).encode('utf-8'))
+
+    if algorithm == 'md5':
+        return inputs.hexdigest()
+    else:
+        return '{0}:{1}'.format(algorithm, inputs.hexdigest())
+
 class DependencyChecks(object):
     def __init__(self, check=None):
         """
@@ -95,6 +541,28 @@ class DependencyChecks(object):
                 else:
                     self.checks[member[0]] = member
 
+        self.checks['mtime+hash'] = ('mtime+hash', self._mtime_hash)
+
+        self.log = None
+        """A :class:`~buildlog.BuildLog` object with the outcomes of previous
+        builds, or ``None``. See :meth:`~dependency.DependencyChecks.check()`."""
+
+        self.stats = StatCache()
+        """A :class:`~dependency.StatCache` that every check shares for the
+        duration of a build."""
+
+        self._algorithm = DEFAULT_ALGORITHM
+
+        self.block_size = BLOCK_SIZE
+        """The size of the reads that hash files without a
+        :attr:`~dependency.DependencyChecks.digests` cache."""
+
+        self.digests = DigestCache(None, self.stats)
+        """A :class:`~dependency.DigestCache` that the ``hash`` check reads
+        digests from. By default, holds digests for the duration of a build
+        only. ``None`` to hash every file for every check. Must use the same
+        :attr:`~dependency.DependencyChecks.algorithm` as the checks."""
+
         if check is None and 'mtime' in self.checks:
             self._check = 'mtime'
             """The current default dependency check. Defaults to ``mtime`` if it
@@ -128,6 +596,49 @@ class DependencyChecks(object):
         else:
             raise DependencyCheckError('{0} does not exist'.format(value))
 
+    @property
+    def algorithm(self):
+        """
+        Property of the name of the digest algorithm of the ``hash`` check,
+        one of the :data:`~dependency.ALGORITHMS`. Defaults to ``md5``.
+
+        Setting the algorithm replaces a
+        :attr:`~dependency.DependencyChecks.digests` cache of another
+        algorithm with a memory-only cache. Raises
+        :exc:`~err.DependencyCheckError` for unsupported algorithms.
+        """
+        return self._algorithm
+
+    @algorithm.setter
+    def algorithm(self, value):
+        if value not in ALGORITHMS:
+            raise DependencyCheckError('{0} is not a supported digest algorithm'.format(value))
+
+        self._algorithm = value
+
+        if self.digests is not None and self.digests.algorithm != value:
+            self.digests = DigestCache(None, self.stats, value, self.block_size)
+
+    def _digest(self, path):
+        """
+        :returns: The digest of ``path`` with the current
+           :attr:`~dependency.DependencyChecks.algorithm`, from
+           :attr:`~dependency.DependencyChecks.digests` if set.
+        """
+
+        if self.digests is None:
+            return file_digest(path, self._algorithm, self.block_size)
+        else:
+            return self.digests.digest(path)
+
+    def _inputs(self, dependency):
+        """
+        :returns: The :func:`~dependency.inputs_digest()` of ``dependency``
+           with the current :attr:`~dependency.DependencyChecks.algorithm`.
+        """
+
+        return inputs_digest(dependency, self._digest, self._algorithm)
+
     def force(self, target, dependency):
         """
         :param path target: The path to a file to check.
@@ -161,17 +672,17 @@ class DependencyChecks(object):
            ``dependency`` list are newer than ``target``.
         """
 
-        if not os.path.exists(target) and not os.path.islink(target):
+        if not self.stats.exists(target) and not os.path.islink(target):
             return True
 
         if isinstance(dependency, list):
             for dep in dependency:
-                if mtime_check(target, dep) is True:
+                if mtime_check(target, dep, self.stats) is True:
                     return True
                 else:
                     continue
         else:
-            return mtime_check(target, dependency)
+            return mtime_check(target, dependency, self.stats)
 
     def hash(self, target, dependency):
         """
@@ -180,32 +691,89 @@ class DependencyChecks(object):
         :param path dependency: The path or list of paths of files that the ``target`` depends
            upon.
 
-        :returns: ``True`` when ``dependency`` or any members of a
-           ``dependency`` list have a different md5 checkusm than ``target``.
+        :returns: With a :attr:`~dependency.DependencyChecks.log`, ``True``
+           when the :func:`~dependency.inputs_digest()` of ``dependency``
+           differs from the digest recorded when ``target`` last built, or
+           when the log has no digest for ``target``. Without a log, ``True``
+           when ``dependency`` or any members of a ``dependency`` list have a
+           different digest than ``target``. Uses the digest
+           :attr:`~dependency.DependencyChecks.algorithm`.
         """
 
-        if not os.path.exists(target) and not os.path.islink(target):
+        if not self.stats.exists(target) and not os.path.islink(target):
             return True
 
+        digest = self._digest
+
+        if self.log is not None:
+            entry = self.log.get(target)
+
+            if entry is None or entry.inputs is None:
+                logger.debug('no recorded dependency digests for {0}'.format(target))
+                return True
+
+            return self._inputs(dependency) != entry.inputs
+
         if isinstance(dependency, list):
             for dep in dependency:
-                if hash_check(target, dep) is True:
+                if hash_check(target, dep, digest) is True:
                     return True
                 else:
                     continue
         else:
-            return hash_check(target, dependency)
+            return hash_check(target, dependency, digest)
 
-    def check(self, target, dependency):
+    def _mtime_hash(self, target, dependency):
         """
         :param path target: The path to a file to check.
 
         :param path dependency: The path or list of paths of files that the ``target`` depends
            upon.
 
+        :returns: ``False`` when the ``mtime`` check finds ``target`` up to
+           date. Otherwise, with a :attr:`~dependency.DependencyChecks.log`,
+           the result of the ``hash`` check, so that dependencies with new
+           times but the same content do not rebuild ``target``. Implements
+           the ``mtime+hash`` check.
+        """
+
+        if not self.mtime(target, dependency):
+            return False
+        elif self.log is None or not self.stats.exists(target):
+            return True
+
+        logger.debug('{0} is older than its dependencies, comparing digests'.format(target))
+        return self.hash(target, dependency)
+
+    def check(self, target, dependency, fingerprint=None):
+        """
+        :param path target: The path to a file to check.
+
+        :param path dependency: The path or list of paths of files that the ``target`` depends
+           upon.
+
+        :param string fingerprint: Optional. The fingerprint of the job that
+           builds ``target``, as returned by
+           :func:`~buildlog.job_fingerprint()`.
+
         :returns: ``True`` or ``False`` depending on the result of dependency
            check specified by :attr:`~dependency.DependencyChecks._check`.
+           With a :attr:`~dependency.DependencyChecks.log`, also returns
+           ``True`` when the most recent job that built ``target`` failed, or
+           when its fingerprint differs from ``fingerprint``.
         """
+
+        if self.log is not None and self._check != 'ignore':
+            entry = self.log.get(target)
+
+            if entry is not None:
+                if entry.status != 0:
+                    logger.info('rebuilding {0}: the last build failed'.format(target))
+                    return True
+                elif fingerprint is not None and entry.fingerprint != fingerprint:
+                    logger.info('rebuilding {0}: the job changed since the last build'.format(target))
+                    return True
+
         logger.debug('running dependency check ({0}), of target {1} on dependency {2}'.format(self._check, target, dependency))
         test = self.checks[self._check][1](target, dependency)
         logger.info('rebuild check {0} result: {1} for target {2}'.format(self._check, test, target))
@@ -116,6 +116,22 @@ class TargetError(BuildStagesError):
     """Raised when encountering an error in an attempt to narrow a build system."""
     pass
 
+class DependencyCycleError(InvalidSystem):
+    """Raised when the targets of a build system depend upon each other in a
+    cycle."""
+
+    def __init__(self, cycles):
+        """
+        :param list cycles: A list of cycles, each a list of the targets in the
+                            cycle.
+        """
+
+        self.cycles = cycles
+        "The targets of every cycle."
+
+        msg = '; '.join(', '.join(str(target) for target in cycle) for cycle in cycles)
+        BuildClothError.__init__(self, 'dependency cycles: ' + msg)
+
 #################### Dependency Checking Errors ####################
 
 class DependencyCheckError(BuildClothError):
@@ -0,0 +1,1027 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`executors` provides the worker pools that run the jobs in
+:class:`~stages.BuildSteps()` and :class:`~scheduler.BuildGraph()` objects.
+
+A :class:`~system.BuildSystem()` creates one :class:`~executors.Executor()`
+for an entire build and passes it to every stage, so that the cost of starting
+workers is paid once per build rather than once per stage. The
+:class:`~executors.Executor()` chooses a pool for each job by its type: shell
+jobs run on a :class:`~executors.ThreadWorkerPool()`, because a thread that
+waits on a command releases the GIL and avoids forking a Python process and
+pickling the job, and Python function jobs run on a
+:class:`~executors.WorkerPool()` of processes.
+
+Shell jobs (i.e. jobs that call :func:`python:subprocess.call`) run through
+:func:`~executors.call()`, which tracks the child process so that the
+``terminate()`` method of either pool can stop running commands when a build
+fails.
+
+With a ``max_load``, an :class:`~executors.Executor()` also holds back jobs
+while the system load average is at or above the limit, as ``make -l`` does,
+so that builds on shared hosts do not oversubscribe the machine.
+:class:`~executors.MemoryLimit()` provides the same kind of admission control
+for jobs with large memory requirements, and
+:func:`~executors.measured()` reports the peak memory use of a job so that
+later builds can use it in place of an estimate.
+
+For stages with many small Python function jobs, :func:`~executors.run_batch()`
+runs a chunk of jobs in one worker, so that the cost of sending jobs to the
+workers and their results back is paid once per chunk rather than once per
+job, and :class:`~executors.BatchSizer()` picks the size of each chunk from the
+measured time per job.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+from multiprocessing import cpu_count, Pool, SimpleQueue
+
+from concurrent.futures import ThreadPoolExecutor
+
+from buildcloth.err import StageRunError
+
+logger = logging.getLogger(__name__)
+
+_children = set()
+"The child processes started by :func:`~executors.call()` in this process."
+
+_RUSAGE_UNIT = 1 if sys.platform == 'darwin' else 1024
+"The number of bytes in a unit of ``ru_maxrss``."
+
+_fork_lock = threading.Lock()
+"""Held while starting commands or worker processes. A worker forked while
+another thread starts a command would inherit the pipe that
+:class:`python:subprocess.Popen` uses to wait for the command to start, and
+never close it."""
+
+def call(*popenargs, **kwargs):
+    """
+    Runs a command and waits for it to complete, with the same arguments as
+    :func:`python:subprocess.call`, while tracking the child process so that
+    :func:`~executors.stop_children()` can stop it.
+
+    :returns: The exit status of the command.
+    """
+
+    return _call(popenargs, kwargs)[0]
+
+def _call(popenargs, kwargs):
+    """
+    Implements :func:`~executors.call()`.
+
+    :returns: A tuple of the exit status of the command, and the peak
+       resident set size of the command in bytes, or ``None`` if the platform
+       does not report it.
+    """
+
+    with _fork_lock:
+        proc = subprocess.Popen(*popenargs, **kwargs)
+    _children.add(proc)
+
+    try:
+        if not hasattr(os, 'wait4'):
+            return proc.wait(), None
+
+        while True:
+            try:
+                pid, status, usage = os.wait4(proc.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+        return proc.returncode, usage.ru_maxrss * _RUSAGE_UNIT
+    finally:
+        _children.discard(proc)
+
+def stop_children():
+    """Kills every running child process started by :func:`~executors.call()`
+    in this process."""
+
+    for proc in list(_children):
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+def _init_worker(pids):
+    """
+    :param SimpleQueue pids: Receives the process id of the worker.
+
+    Initializer for pool workers. Makes each worker the leader of a new
+    process group, which the commands it runs inherit, so that
+    :meth:`~executors.WorkerPool.terminate()` can stop a worker and its
+    commands together.
+    """
+
+    global _fork_lock
+
+    # the pool forks workers while holding the lock in the parent.
+    _fork_lock = threading.Lock()
+
+    if hasattr(os, 'setpgid'):
+        os.setpgid(0, 0)
+        pids.put(os.getpid())
+
+def is_shell_job(func):
+    """
+    :param callable func: The callable object of a job.
+
+    :returns: ``True`` for shell jobs, as produced by
+       :meth:`~system.BuildSystemGenerator.generate_shell_job()`.
+    """
+
+    return func is subprocess.call or func is call
+
+def check_result(func, args, result):
+    """
+    :param callable func: The callable object of a job.
+
+    :param args: The arguments of the job.
+
+    :param result: The return value of the job.
+
+    :raises: :exc:`~err.StageRunError` if ``func`` is a shell job and
+       ``result`` is a non-zero exit status. The exception's ``status``
+       attribute holds the exit status.
+    """
+
+    if is_shell_job(func) and result != 0:
+        if isinstance(args, dict):
+            args = args.get('args', args)
+
+        err = StageRunError('command {0} exited with status {1}'.format(args, result))
+        err.status = result
+        raise err
+
+def _reset_peak_rss():
+    "Resets the peak resident set size of the current process, on Linux."
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def _peak_rss():
+    """
+    :returns: The peak resident set size of the current process in bytes,
+       since the last call to :func:`~executors._reset_peak_rss()`, or
+       ``None`` if the platform does not report it.
+    """
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RUSAGE_UNIT
+
+def measured(func, args):
+    """
+    :param callable func: The callable object of a job.
+
+    :param args: A tuple, list, or dict of arguments to pass to ``func``.
+
+    Runs a job, and measures its peak resident set size: for shell jobs, the
+    peak of the command, and for Python function jobs, the peak of the
+    current process while the job runs. Run Python function jobs that need
+    measurement in a :class:`~executors.WorkerPool()`, since in a thread the
+    measurement covers the entire process.
+
+    :returns: A tuple of the return value of the job and the peak resident
+       set size in bytes, or ``None`` if unknown.
+    """
+
+    if is_shell_job(func):
+        if isinstance(args, dict):
+            return _call((), args)
+        else:
+            return _call(tuple(args), {})
+
+    _reset_peak_rss()
+
+    if isinstance(args, dict):
+        result = func(**args)
+    else:
+        result = func(*args)
+
+    return result, _peak_rss()
+
+def _measured_job(func, args, callback, peak_callback):
+    """
+    :returns: A tuple of a callable, its arguments, and a callback that
+       together run the job with :func:`~executors.measured()`, pass the peak
+       resident set size to ``peak_callback``, and then pass the return value
+       of the job to ``callback``.
+    """
+
+    def unpack(value):
+        result, peak = value
+        peak_callback(peak)
+
+        if callback is not None:
+            callback(result)
+
+    return measured, (func, args), unpack
+
+def _checked_callback(func, args, callback, error_callback):
+    """
+    :returns: A callback for the result of a job that passes non-zero exit
+       statuses from shell jobs to ``error_callback`` as a
+       :exc:`~err.StageRunError`, and all other results to ``callback``.
+    """
+
+    if not is_shell_job(func):
+        return callback
+
+    def checked(result):
+        try:
+            check_result(func, args, result)
+        except StageRunError as e:
+            if error_callback is not None:
+                error_callback(e)
+        else:
+            if callback is not None:
+                callback(result)
+
+    return checked
+
+class PoolLimits(object):
+    """
+    :param dict depths: Optional. A mapping of the names of resource pools to
+       the maximum number of jobs in each pool that may run at once.
+
+    Tracks the number of running jobs in each named resource pool, so that a
+    scheduler can hold back jobs from full pools while other jobs use the
+    free workers. Jobs without a pool, and jobs in pools without a depth,
+    are never held back. Not thread safe: callers must hold a lock if jobs
+    complete in other threads.
+    """
+
+    def __init__(self, depths=None):
+        if depths is None:
+            depths = {}
+
+        self.depths = depths
+        "A mapping of the names of resource pools to their depths."
+
+        self.running = {}
+        "A mapping of the names of resource pools to their running jobs."
+
+    def available(self, name):
+        """
+        :param string name: The name of a resource pool, or ``None``.
+
+        :returns: ``True`` if a job in the pool named ``name`` may start.
+        """
+
+        if name is None or name not in self.depths:
+            return True
+        else:
+            return self.running.get(name, 0) < self.depths[name]
+
+    def acquire(self, name):
+        "Counts a job in the pool named ``name`` as running."
+
+        if name is not None:
+            self.running[name] = self.running.get(name, 0) + 1
+
+    def release(self, name):
+        "Counts a job in the pool named ``name`` as complete."
+
+        if name is not None:
+            self.running[name] -= 1
+
+LOAD_POLL_INTERVAL = 1.0
+"The number of seconds to wait before checking a high load average again."
+
+class LoadLimit(object):
+    """
+    :param float max_load: Optional. The load average at or above which new
+       jobs wait. If ``None``, jobs never wait.
+
+    Decides whether a new job may start, given the one minute load average
+    of the system from :func:`python:os.getloadavg`. A job may always start
+    when no other jobs are running, so that a build on a busy host still
+    makes progress.
+    """
+
+    def __init__(self, max_load=None):
+        self.max_load = max_load
+        "The load average at or above which new jobs wait."
+
+    @staticmethod
+    def load():
+        """
+        :returns: The one minute load average of the system, or ``None`` if
+           the platform does not report a load average.
+        """
+
+        try:
+            return os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return None
+
+    def available(self, running):
+        """
+        :param int running: The number of jobs that are running.
+
+        :returns: ``True`` if a new job may start.
+        """
+
+        if self.max_load is None or running == 0:
+            return True
+
+        load = self.load()
+
+        if load is None or load < self.max_load:
+            return True
+        else:
+            logger.debug('load average {0} is above {1}, holding jobs.'.format(load, self.max_load))
+            return False
+
+_SIZE_UNITS = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+
+def parse_size(value):
+    """
+    :param value: A number of bytes, or a string with a number and an
+       optional binary unit suffix: ``K``, ``M``, ``G``, or ``T`` (e.g.
+       ``512M`` or ``1.5G``).
+
+    :returns: The number of bytes, as an integer.
+
+    :raises: :exc:`python:ValueError` if ``value`` is not a valid size.
+    """
+
+    if isinstance(value, bool):
+        raise ValueError('{0} is not a size'.format(value))
+    elif isinstance(value, (int, float)):
+        size = value
+    else:
+        text = str(value).strip().upper()
+        if text.endswith('B'):
+            text = text[:-1]
+
+        if text[-1:] in _SIZE_UNITS:
+            size = float(text[:-1]) * _SIZE_UNITS[text[-1]]
+        else:
+            size = float(text)
+
+    if size < 0:
+        raise ValueError('{0} is not a size'.format(value))
+
+    return int(size)
+
+def mem_available():
+    """
+    :returns: The number of bytes of memory available for new processes,
+       from the ``MemAvailable`` field of ``/proc/meminfo``, or ``None`` on
+       systems without it.
+    """
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+class MemoryLimit(object):
+    """
+    :param int ceiling: Optional. The maximum number of bytes that the
+       memory estimates of running jobs may add up to. If ``None``, only the
+       memory available on the system limits jobs.
+
+    Tracks the memory estimates of running jobs, so that a scheduler can hold
+    back jobs that would exhaust the memory of the system. A job with an
+    estimate may start when the estimates of the running jobs plus its own
+    estimate fit under the ceiling, and its estimate fits in the
+    ``MemAvailable`` memory that the system reports. Jobs without an
+    estimate, and any job when no other jobs are running, may always start.
+    Not thread safe.
+    """
+
+    def __init__(self, ceiling=None):
+        self.ceiling = ceiling
+        "The maximum sum of the estimates of running jobs, or ``None``."
+
+        self.reserved = 0
+        "The sum of the estimates of running jobs."
+
+        self.running = 0
+        "The number of running jobs."
+
+    @staticmethod
+    def free():
+        ":returns: The available memory of the system. See :func:`~executors.mem_available()`."
+        return mem_available()
+
+    def available(self, mem):
+        """
+        :param int mem: The memory estimate of a job in bytes, or ``None``.
+
+        :returns: ``True`` if the job may start.
+        """
+
+        if not mem or self.running == 0:
+            return True
+
+        if self.ceiling is not None and self.reserved + mem > self.ceiling:
+            return False
+
+        free = self.free()
+
+        return free is None or mem <= free
+
+    def acquire(self, mem):
+        "Counts a job with the estimate ``mem`` as running."
+
+        self.running += 1
+        self.reserved += mem or 0
+
+    def release(self, mem):
+        "Counts a job with the estimate ``mem`` as complete."
+
+        self.running -= 1
+        self.reserved -= mem or 0
+
+def run_batch(jobs):
+    """
+    :param list jobs: A list of job tuples, with a callable and its
+       arguments.
+
+    Runs each job in order, in the current process.
+
+    :returns: A tuple of a list of the return values of the jobs, and the
+       number of seconds the jobs took to run.
+
+    :raises: The exception of the first job that fails.
+    """
+
+    start = time.time()
+    results = []
+
+    for func, args in jobs:
+        if args is None:
+            results.append(func())
+        elif isinstance(args, dict):
+            results.append(func(**args))
+        else:
+            results.append(func(*args))
+
+    return results, time.time() - start
+
+class BatchSizer(object):
+    """
+    :param float target: Optional. The number of seconds that each chunk of
+       jobs should take to run. Defaults to
+       :attr:`~executors.BatchSizer.TARGET`.
+
+    Picks the number of jobs to send to a worker at once. The first chunks
+    are small, so that the time per job is known early. Once chunks complete,
+    each new chunk holds about ``target`` seconds of work, based on a moving
+    average of the time per job, but never more than an even share of the
+    remaining jobs between the workers, so that every worker stays busy until
+    the end of the stage.
+    """
+
+    TARGET = 0.05
+    "The default number of seconds of work in each chunk."
+
+    INITIAL = 4
+    "The size of chunks before any chunk completes."
+
+    def __init__(self, target=None):
+        self.target = self.TARGET if target is None else target
+        "The number of seconds of work in each chunk."
+
+        self.per_job = None
+        "The moving average of the number of seconds each job takes, or ``None``."
+
+    def update(self, count, elapsed):
+        """
+        :param int count: The number of jobs in a completed chunk.
+
+        :param float elapsed: The number of seconds the chunk took to run.
+
+        Updates the average time per job.
+        """
+
+        if count == 0:
+            return
+
+        per_job = float(elapsed) / count
+
+        if self.per_job is None:
+            self.per_job = per_job
+        else:
+            self.per_job = 0.7 * self.per_job + 0.3 * per_job
+
+    def size(self, remaining, workers):
+        """
+        :param int remaining: The number of jobs not yet sent to a worker.
+
+        :param int workers: The number of workers.
+
+        :returns: The number of jobs to put in the next chunk.
+        """
+
+        share = max(1, -(-remaining // max(1, workers)))
+
+        if self.per_job is None:
+            size = self.INITIAL
+        elif self.per_job <= 0:
+            size = share
+        else:
+            size = int(self.target / self.per_job)
+
+        return max(1, min(size, share, remaining))
+
+class WorkerPool(object):
+    """
+    :param int workers: Optional. The number of worker processes. Defaults to
+       the number of cores/threads available on your system.
+
+    A wrapper around a :mod:`python:multiprocessing` worker pool that starts
+    the worker processes the first time a job needs them and keeps them
+    running until :meth:`~executors.WorkerPool.close()`. Use
+    :class:`~executors.WorkerPool()` as a context manager to close the pool
+    when the build completes.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.workers = workers
+        "The number of worker processes in the pool."
+
+        self._pool = None
+        "The underlying :mod:`python:multiprocessing` pool, once started."
+
+        self._pids = None
+        "A queue of the process ids of the workers in the pool."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    @property
+    def started(self):
+        "``True`` once the pool has started its worker processes."
+        return self._pool is not None
+
+    @property
+    def pool(self):
+        "The underlying worker pool. Starts the worker processes if needed."
+
+        if self._pool is None:
+            self._pids = SimpleQueue()
+
+            with _fork_lock:
+                self._pool = Pool(processes=self.workers, initializer=_init_worker,
+                                  initargs=(self._pids,))
+            logger.info('started worker pool with {0} workers'.format(self.workers))
+
+        return self._pool
+
+    def apply(self, func, args, callback=None, error_callback=None, peak_callback=None):
+        """
+        :param callable func: A callable object to run in the pool.
+
+        :param args: A tuple, list, or dict of arguments to pass to ``func``,
+           or ``None`` to call ``func`` without arguments.
+
+        :param callable callback: Optional. Called with the return value of
+           ``func`` when the job completes.
+
+        :param callable error_callback: Optional. Called with the exception if
+           ``func`` raises an exception.
+
+        :param callable peak_callback: Optional. If set, the job runs with
+           :func:`~executors.measured()`, and ``peak_callback`` receives the
+           peak resident set size of the job before ``callback`` runs.
+
+        Runs ``func`` asynchronously in the pool and returns the
+        :class:`~python:multiprocessing.pool.AsyncResult`. Shell jobs run with
+        :func:`~executors.call()`, and a non-zero exit status counts as a
+        failure: ``error_callback`` receives a :exc:`~err.StageRunError`.
+        """
+
+        if args is None:
+            args = tuple()
+
+        if is_shell_job(func):
+            func = call
+
+        checked = _checked_callback(func, args, callback, error_callback)
+
+        if peak_callback is not None:
+            func, args, checked = _measured_job(func, args, checked, peak_callback)
+
+        if isinstance(args, dict):
+            return self.pool.apply_async(func, kwds=args, callback=checked,
+                                         error_callback=error_callback)
+        else:
+            return self.pool.apply_async(func, tuple(args), callback=checked,
+                                         error_callback=error_callback)
+
+    def close(self):
+        """Waits for all submitted jobs to complete and stops the worker
+        processes. The pool will start new workers if it receives more jobs."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            logger.debug('closed worker pool.')
+
+    def terminate(self):
+        """Stops the worker processes immediately, without waiting for
+        outstanding jobs. Discards queued jobs and kills running commands."""
+
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+            # commands outlive their workers, but remain in the process
+            # group of the worker that started them.
+            while not self._pids.empty():
+                pid = self._pids.get()
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    logger.debug('no running commands from worker {0}.'.format(pid))
+
+            logger.warning('terminated worker pool.')
+
+class ThreadWorkerPool(object):
+    """
+    :param int workers: Optional. The number of worker threads. Defaults to
+       the number of cores/threads available on your system.
+
+    A worker pool with the same interface as :class:`~executors.WorkerPool()`
+    that runs jobs in threads of the current process, using a
+    :class:`python:concurrent.futures.ThreadPoolExecutor`. Suited to shell
+    jobs, which spend their time waiting on a command, and do not need to
+    pickle their arguments.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.workers = workers
+        "The number of worker threads in the pool."
+
+        self._pool = None
+        "The underlying :class:`python:concurrent.futures.ThreadPoolExecutor`, once started."
+
+        self._futures = set()
+        "The futures of the jobs that have not completed."
+
+        self._terminated = threading.Event()
+        "Set by :meth:`~executors.ThreadWorkerPool.terminate()` to stop queued jobs from starting."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    @property
+    def started(self):
+        "``True`` once the pool has started its worker threads."
+        return self._pool is not None
+
+    @property
+    def pool(self):
+        "The underlying thread pool. Starts the pool if needed."
+
+        if self._pool is None:
+            self._terminated.clear()
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            logger.info('started thread pool with {0} workers'.format(self.workers))
+
+        return self._pool
+
+    def _call(self, func, args):
+        if self._terminated.is_set():
+            raise StageRunError('worker pool terminated before job started.')
+        elif isinstance(args, dict):
+            return func(**args)
+        else:
+            return func(*args)
+
+    def apply(self, func, args, callback=None, error_callback=None, peak_callback=None):
+        """
+        Runs ``func`` asynchronously in a worker thread and returns the
+        :class:`~python:concurrent.futures.Future`. Takes the same arguments
+        as :meth:`~executors.WorkerPool.apply()`. As with
+        :meth:`~executors.WorkerPool.apply()`, a non-zero exit status from a
+        shell job counts as a failure.
+        """
+
+        if args is None:
+            args = tuple()
+
+        if is_shell_job(func):
+            func = call
+
+        checked = _checked_callback(func, args, callback, error_callback)
+
+        if peak_callback is not None:
+            func, args, checked = _measured_job(func, args, checked, peak_callback)
+
+        future = self.pool.submit(self._call, func, args)
+        self._futures.add(future)
+
+        def done(future):
+            self._futures.discard(future)
+
+            if future.cancelled():
+                return
+
+            err = future.exception()
+            if err is not None:
+                if error_callback is not None:
+                    error_callback(err)
+            elif checked is not None:
+                checked(future.result())
+
+        future.add_done_callback(done)
+
+        return future
+
+    def close(self):
+        """Waits for all submitted jobs to complete and stops the worker
+        threads. The pool will start new threads if it receives more jobs."""
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            logger.debug('closed thread pool.')
+
+    def terminate(self):
+        """Stops the pool without waiting for outstanding jobs. Discards
+        queued jobs and kills running commands."""
+
+        if self._pool is not None:
+            self._terminated.set()
+
+            for future in list(self._futures):
+                future.cancel()
+
+            stop_children()
+
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+            logger.warning('terminated thread pool.')
+
+class Executor(object):
+    """
+    :param int workers: Optional. The number of workers in each pool. Defaults
+       to the number of cores/threads available on your system.
+
+    :param dict pools: Optional. A mapping of job types, as returned by
+       :meth:`~executors.Executor.job_type()`, to pool objects that override
+       the default pool for that type of job.
+
+    :param float max_load: Optional. Holds back new jobs while the load
+       average of the system is at or above this value. If ``None``, does not
+       check the load average.
+
+    Runs each job on the pool for its type of job: ``shell`` jobs on a
+    :class:`~executors.ThreadWorkerPool()`, and ``python`` jobs on a
+    :class:`~executors.WorkerPool()`. Provides the same interface as the pools
+    it contains, and only starts a pool once a job of that type needs it.
+
+    At most ``workers`` jobs of either type run at once:
+    :meth:`~executors.Executor.apply()` queues jobs while ``workers`` jobs
+    run, and, with a ``max_load``, until the load average drops below the
+    limit or no other job is running. Queued jobs start as running jobs
+    complete, or after :data:`~executors.LOAD_POLL_INTERVAL` seconds.
+    """
+
+    def __init__(self, workers=None, pools=None, max_load=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.workers = workers
+        "The number of workers in each pool."
+
+        self.pools = {
+            'shell': ThreadWorkerPool(workers),
+            'python': WorkerPool(workers),
+        }
+        "A mapping of job types to the pool objects that run them."
+
+        if pools is not None:
+            self.pools.update(pools)
+
+        self.load = LoadLimit(max_load)
+        "A :class:`~executors.LoadLimit` that decides when held jobs start."
+
+        self.running = 0
+        "The number of jobs started and not yet complete."
+
+        self._held = deque()
+        "Jobs waiting for a free worker, or for the load average to drop."
+
+        # reentrant, because a pool may call a callback from apply().
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._timer = None
+        self._terminated = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    @staticmethod
+    def job_type(func):
+        """
+        :param callable func: The callable object of a job.
+
+        :returns: ``shell`` for shell jobs, and ``python`` otherwise.
+        """
+
+        if is_shell_job(func):
+            return 'shell'
+        else:
+            return 'python'
+
+    @property
+    def started(self):
+        "``True`` once any pool has started its workers."
+        return any(pool.started for pool in self.pools.values())
+
+    def apply(self, func, args, callback=None, error_callback=None, peak_callback=None):
+        """
+        Runs ``func`` asynchronously on the pool for its job type. Takes the
+        same arguments as :meth:`~executors.WorkerPool.apply()`.
+
+        :returns: The result object of the pool, or ``None`` if the job waits
+           for a free worker or for the load average to drop.
+        """
+
+        with self._lock:
+            self._held.append((func, args, callback, error_callback, peak_callback))
+
+        return self._admit()
+
+    def _admit(self):
+        """
+        Starts held jobs while fewer than ``workers`` jobs are running and
+        the load average permits, and schedules another check if jobs remain
+        held.
+
+        :returns: The result object of the last job started, or ``None``.
+        """
+
+        result = None
+
+        # start jobs while holding the lock, so that no job starts once
+        # terminate() has discarded the held jobs.
+        with self._lock:
+            while (self._held and self._terminated is False and self.running < self.workers and
+                   self.load.available(self.running)):
+                func, args, callback, error_callback, peak_callback = self._held.popleft()
+                self.running += 1
+
+                try:
+                    result = self._start(func, args, self._complete(callback),
+                                         self._complete(error_callback), peak_callback)
+                except Exception:
+                    self.running -= 1
+                    self._idle.notify_all()
+                    raise
+
+            if (self._held and self._timer is None and self.running > 0 and
+                self.load.max_load is not None):
+                self._timer = threading.Timer(LOAD_POLL_INTERVAL, self._poll)
+                self._timer.daemon = True
+                self._timer.start()
+
+        return result
+
+    def _start(self, func, args, callback, error_callback, peak_callback):
+        pool = self.pools[self.job_type(func)]
+
+        if peak_callback is None:
+            return pool.apply(func, args, callback=callback, error_callback=error_callback)
+        else:
+            return pool.apply(func, args, callback=callback, error_callback=error_callback,
+                              peak_callback=peak_callback)
+
+    def _poll(self):
+        with self._lock:
+            self._timer = None
+
+        self._admit()
+
+    def _complete(self, callback):
+        """
+        :returns: A callback that calls ``callback``, counts the job as
+           complete, and then starts held jobs.
+        """
+
+        def done(value):
+            # count the job until its callback returns, so that close() also
+            # waits for jobs that the callback submits.
+            try:
+                if callback is not None:
+                    callback(value)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self._idle.notify_all()
+
+            self._admit()
+
+        return done
+
+    def _discard_held(self, terminate=False):
+        with self._lock:
+            self._held.clear()
+            self._terminated = terminate
+
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def close(self):
+        """Waits for all submitted jobs, including held jobs, to complete and
+        stops every pool."""
+
+        with self._lock:
+            while (self._held or self.running > 0) and self._terminated is False:
+                self._idle.wait(LOAD_POLL_INTERVAL)
+
+        for pool in self.pools.values():
+            pool.close()
+
+        self._discard_held()
+
+    def terminate(self):
+        """Stops every pool immediately, discards jobs waiting for the load
+        average to drop, and kills running commands."""
+
+        self._discard_held(terminate=True)
+
+        for pool in self.pools.values():
+            pool.terminate()
+
+        self.running = 0
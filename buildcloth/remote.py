@@ -0,0 +1,591 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`remote` runs the jobs of a build on workers on other hosts.
+
+A :class:`~remote.RemoteExecutor()` is a coordinator: it has the same
+interface as :class:`~executors.Executor()`, so that any
+:class:`~system.BuildSystem()`, :class:`~stages.BuildStage()`, or
+:class:`~scheduler.BuildGraph()` can use it, but rather than running jobs
+itself it serves a queue of jobs over TCP with
+:mod:`python:multiprocessing.managers`. Each :class:`~remote.RemoteWorker()`
+connects to the coordinator, takes jobs from the queue as it has free
+workers, runs them with a local :class:`~executors.Executor()`, and sends back
+the outcome, the start and end time, and the name of the worker for every job.
+
+The coordinator and workers must share a filesystem, since jobs refer to
+paths, and workers must be able to import the modules that define Python
+function jobs. Anyone who can connect to the coordinator with its
+``authkey`` can run arbitrary code on the workers, so use a secret key, and
+only listen on trusted networks.
+
+Use ``buildc --mode coordinator`` and ``buildc --mode worker`` to run
+distributed builds from the command line.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+from itertools import count
+from multiprocessing import cpu_count
+from multiprocessing.managers import BaseManager
+from queue import Queue, Empty
+
+from buildcloth.err import StageRunError
+from buildcloth.executors import Executor, _fork_lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = ('127.0.0.1', 5731)
+"The address that the coordinator listens on, and workers connect to, by default."
+
+POLL_INTERVAL = 0.5
+"The number of seconds that workers wait for a job before checking for a stop."
+
+CONNECT_TIMEOUT = 30
+"The number of seconds that workers try to connect to the coordinator."
+
+WORKER_TIMEOUT = 10
+"""The number of seconds after which the coordinator fails the running jobs
+of a worker that has stopped polling it."""
+
+class _Control(object):
+    """
+    Lives in the server process of the coordinator, and tells workers when
+    the coordinator terminates a build.
+    """
+
+    def __init__(self):
+        self._generation = 0
+        self._workers = {}
+        """Mapping of worker names to the time of their last poll and the ids
+        of the jobs that they run."""
+
+    def generation(self):
+        "Returns a number that changes every time the build stops."
+        return self._generation
+
+    def poll(self, worker, running):
+        """
+        Records that ``worker`` is alive, and runs the jobs with the ids in
+        ``running``. Returns the generation, as
+        :meth:`~remote._Control.generation()`.
+        """
+
+        self._workers[worker] = (time.time(), running)
+        return self._generation
+
+    def lost(self, timeout):
+        """
+        Returns a list of ``(worker, running)`` tuples for the workers that
+        have not polled within ``timeout`` seconds, and forgets them.
+        """
+
+        now = time.time()
+        result = []
+
+        for worker, (last, running) in list(self._workers.items()):
+            if now - last > timeout:
+                del self._workers[worker]
+                result.append((worker, running))
+
+        return result
+
+    def stop(self):
+        "Discards queued jobs, and tells the workers to stop running jobs."
+
+        while True:
+            try:
+                _jobs.get_nowait()
+            except Empty:
+                break
+
+        self._generation += 1
+
+_jobs = Queue()
+_results = Queue()
+_control = _Control()
+
+def _get_jobs():
+    return _jobs
+
+def _get_results():
+    return _results
+
+def _get_control():
+    return _control
+
+class _CoordinatorManager(BaseManager):
+    "Serves the job and result queues of a coordinator."
+
+_CoordinatorManager.register('jobs', callable=_get_jobs)
+_CoordinatorManager.register('results', callable=_get_results)
+_CoordinatorManager.register('control', callable=_get_control)
+
+def parse_address(value):
+    """
+    :param string value: An address as ``host:port``, or ``port``.
+
+    :returns: A ``(host, port)`` tuple. The host defaults to the host of
+       :data:`~remote.DEFAULT_ADDRESS`.
+
+    :raises: :exc:`python:ValueError` if ``value`` is malformed.
+    """
+
+    if isinstance(value, tuple):
+        return value
+
+    host, sep, port = value.rpartition(':')
+
+    if not host:
+        host = DEFAULT_ADDRESS[0]
+
+    return (host, int(port))
+
+def _authkey(authkey):
+    if authkey is None:
+        authkey = os.environ.get('BUILDC_AUTHKEY')
+
+    if not authkey:
+        logger.critical('distributed builds need an authkey, or BUILDC_AUTHKEY in the environment.')
+        raise StageRunError('no authkey for distributed build.')
+
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode('utf-8')
+
+    return authkey
+
+class RemoteExecutor(object):
+    """
+    :param int workers: Optional. The maximum number of jobs to run at once
+       across all workers. Defaults to the number of cores/threads available
+       on your system.
+
+    :param tuple address: Optional. The ``(host, port)`` to listen on.
+       Defaults to :data:`~remote.DEFAULT_ADDRESS`. Use port ``0`` to pick a
+       free port, and read :attr:`~remote.RemoteExecutor.address` after
+       :meth:`~remote.RemoteExecutor.start()`.
+
+    :param string authkey: Optional. The secret that workers use to connect.
+       Defaults to the ``BUILDC_AUTHKEY`` environment variable.
+
+    :param float max_load: Ignored. Pass ``--max-load`` to each worker
+       instead.
+
+    Serves jobs to :class:`~remote.RemoteWorker()` objects. Starts a server
+    process the first time a job needs it, and stops the server in
+    :meth:`~remote.RemoteExecutor.close()`. When a worker stops polling the
+    coordinator for :attr:`~remote.RemoteExecutor.worker_timeout` seconds,
+    e.g. because its host went down, its running jobs fail. Queued jobs wait
+    for another worker.
+
+    :raises: :exc:`~err.StageRunError` if there is no ``authkey``.
+    """
+
+    def __init__(self, workers=None, address=None, authkey=None, max_load=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.workers = workers
+        "The maximum number of jobs that run at once across all workers."
+
+        self.address = parse_address(address or DEFAULT_ADDRESS)
+        "The ``(host, port)`` that the coordinator listens on."
+
+        self.authkey = _authkey(authkey)
+
+        self.timings = []
+        """A list of ``(worker, start, end)`` tuples for every job that
+        completed, in the order that they completed."""
+
+        self.worker_timeout = WORKER_TIMEOUT
+        """The number of seconds after which the running jobs of a worker
+        that has stopped polling the coordinator fail."""
+
+        self._manager = None
+        self._jobs = None
+        self._control = None
+        self._pending = {}
+        "Mapping of job ids to the callbacks of jobs that have not completed."
+
+        self._ids = count()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    @property
+    def started(self):
+        "``True`` once the coordinator serves jobs."
+        return self._manager is not None
+
+    def start(self):
+        "Starts serving jobs, if the coordinator has not started already."
+
+        if self._manager is not None:
+            return
+
+        manager = _CoordinatorManager(address=self.address, authkey=self.authkey)
+
+        with _fork_lock:
+            manager.start()
+
+        self._manager = manager
+        self._jobs = manager.jobs()
+        self._control = manager.control()
+        self.address = manager.address
+
+        self._listener = threading.Thread(target=self._listen, args=(manager.results(), manager.control()))
+        self._listener.daemon = True
+        self._listener.start()
+
+        logger.info('coordinator listening on {0}:{1}'.format(*self.address))
+
+    def _listen(self, results, control):
+        """
+        Passes the outcome of every job from the workers to the callbacks of
+        the job, until the coordinator stops. Fails the jobs of lost workers
+        with :meth:`~remote.RemoteExecutor._fail_lost()`.
+        """
+
+        checked = time.time()
+
+        while True:
+            if time.time() - checked > POLL_INTERVAL:
+                try:
+                    self._fail_lost(control)
+                except (EOFError, IOError, OSError):
+                    return
+                checked = time.time()
+
+            try:
+                item = results.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            except (EOFError, IOError, OSError):
+                return
+
+            if item is None:
+                return
+
+            job_id, success, value, peak, worker, start, end = item
+
+            with self._lock:
+                callbacks = self._pending.pop(job_id, None)
+
+            if callbacks is None:
+                logger.debug('ignoring result of cancelled job {0} from {1}'.format(job_id, worker))
+                continue
+
+            callback, error_callback, peak_callback = callbacks
+            self.timings.append((worker, start, end))
+            logger.info('job {0} {1} on {2} in {3:.3f}s'.format(job_id, 'completed' if success else 'failed',
+                                                                 worker, end - start))
+
+            if peak_callback is not None:
+                peak_callback(peak)
+
+            if success is True:
+                if callback is not None:
+                    callback(value)
+            elif error_callback is not None:
+                error_callback(value)
+
+    def _fail_lost(self, control):
+        """
+        Calls the error callbacks of the running jobs of every worker that has
+        not polled the coordinator within
+        :attr:`~remote.RemoteExecutor.worker_timeout` seconds.
+        """
+
+        for worker, running in control.lost(self.worker_timeout):
+            for job_id in running:
+                with self._lock:
+                    callbacks = self._pending.pop(job_id, None)
+
+                if callbacks is None:
+                    continue
+
+                logger.error('worker {0} stopped responding, failing job {1}'.format(worker, job_id))
+
+                error_callback = callbacks[1]
+                if error_callback is not None:
+                    error_callback(StageRunError('worker {0} stopped responding.'.format(worker)))
+
+    def apply(self, func, args, callback=None, error_callback=None, peak_callback=None):
+        """
+        Queues ``func`` for the next free worker. Takes the same arguments as
+        :meth:`~executors.WorkerPool.apply()`. ``func`` and ``args`` must be
+        picklable, and ``func`` must be importable on the workers.
+
+        :returns: The id of the job.
+        """
+
+        self.start()
+
+        with self._lock:
+            job_id = next(self._ids)
+            self._pending[job_id] = (callback, error_callback, peak_callback)
+
+        self._jobs.put((job_id, func, args, peak_callback is not None))
+
+        return job_id
+
+    def _stop(self):
+        if self._manager is None:
+            return
+
+        with self._lock:
+            self._pending.clear()
+
+        self._manager.results().put(None)
+        self._listener.join()
+
+        self._jobs = None
+        self._control = None
+        self._manager.shutdown()
+        self._manager = None
+
+    def close(self):
+        """Waits for all queued jobs to complete or fail, and stops the
+        coordinator, which disconnects the workers."""
+
+        while self._manager is not None and self._pending:
+            time.sleep(0.05)
+
+        self._stop()
+        logger.debug('closed coordinator.')
+
+    def terminate(self):
+        """Discards queued jobs, tells the workers to kill running jobs, and
+        stops the coordinator."""
+
+        if self._manager is not None:
+            self._control.stop()
+            self._stop()
+            logger.warning('terminated coordinator.')
+
+class RemoteWorker(object):
+    """
+    :param tuple address: Optional. The ``(host, port)`` of the coordinator.
+       Defaults to :data:`~remote.DEFAULT_ADDRESS`.
+
+    :param string authkey: Optional. The secret of the coordinator. Defaults
+       to the ``BUILDC_AUTHKEY`` environment variable.
+
+    :param int workers: Optional. The number of jobs to run at once. Defaults
+       to the number of cores/threads available on your system.
+
+    :param float max_load: Optional. Passed to the local
+       :class:`~executors.Executor`.
+
+    Runs jobs from a :class:`~remote.RemoteExecutor()` until the coordinator
+    stops.
+
+    :raises: :exc:`~err.StageRunError` if there is no ``authkey``.
+    """
+
+    def __init__(self, address=None, authkey=None, workers=None, max_load=None):
+        if workers is None:
+            workers = cpu_count()
+
+        self.address = parse_address(address or DEFAULT_ADDRESS)
+        "The ``(host, port)`` of the coordinator."
+
+        self.authkey = _authkey(authkey)
+
+        self.workers = workers
+        "The number of jobs to run at once."
+
+        self.max_load = max_load
+
+        self.name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        "The name that identifies this worker in the timings of the coordinator."
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+        :param float timeout: The number of seconds to keep trying.
+
+        :returns: A connected manager for the coordinator.
+
+        :raises: :exc:`~err.StageRunError` if the coordinator is not
+           reachable within ``timeout`` seconds.
+        """
+
+        deadline = time.time() + timeout
+
+        while True:
+            manager = _CoordinatorManager(address=self.address, authkey=self.authkey)
+
+            try:
+                manager.connect()
+                return manager
+            except (IOError, OSError) as e:
+                if time.time() > deadline:
+                    logger.critical('cannot connect to coordinator at {0}:{1}: {2}'.format(self.address[0], self.address[1], e))
+                    raise StageRunError('cannot connect to coordinator.')
+
+                time.sleep(POLL_INTERVAL)
+
+    def run(self, timeout=CONNECT_TIMEOUT):
+        """
+        :param float timeout: The number of seconds to try to connect.
+
+        Connects to the coordinator and runs its jobs, at most
+        :attr:`~remote.RemoteWorker.workers` at once. When the coordinator
+        terminates a build, kills the running jobs. Returns when the
+        coordinator stops.
+
+        :returns: The number of jobs that the worker ran.
+        """
+
+        manager = self.connect(timeout)
+        jobs = manager.jobs()
+        control = manager.control()
+
+        logger.info('worker {0} connected to {1}:{2}'.format(self.name, *self.address))
+
+        generation = control.generation()
+        slots = threading.Semaphore(self.workers)
+        outcomes = Queue()
+        ran = 0
+
+        # the ids of the jobs that run here, until their outcome reaches the
+        # coordinator.
+        running = set()
+        lock = threading.Lock()
+
+        def sent(job_id):
+            with lock:
+                running.discard(job_id)
+
+        # proxies connect once per thread: a single thread sends every
+        # outcome, rather than each thread of the local pool.
+        sender = threading.Thread(target=self._send, args=(outcomes, sent))
+        sender.daemon = True
+        sender.start()
+
+        def report(job_id, slots, peaks):
+            start = time.time()
+
+            def done(success, value):
+                outcomes.put((job_id, success, value, peaks.get('peak'), self.name, start, time.time()))
+                slots.release()
+
+            return done
+
+        pool = Executor(self.workers, max_load=self.max_load)
+
+        try:
+            while True:
+                # poll the coordinator on every pass, even when every slot
+                # runs a job, to notice stops and to stay alive.
+                if slots.acquire(timeout=POLL_INTERVAL):
+                    try:
+                        item = jobs.get(timeout=POLL_INTERVAL)
+                    except Empty:
+                        slots.release()
+                        item = None
+                    except (EOFError, IOError, OSError):
+                        break
+                else:
+                    item = None
+
+                with lock:
+                    if item is not None:
+                        running.add(item[0])
+                    ids = list(running)
+
+                try:
+                    current = control.poll(self.name, ids)
+                except (EOFError, IOError, OSError):
+                    break
+
+                if current != generation:
+                    # the coordinator terminated the build: the killed jobs
+                    # never release their slots, so start over with new slots.
+                    logger.warning('coordinator stopped the build, killing running jobs.')
+                    pool.terminate()
+                    pool = Executor(self.workers, max_load=self.max_load)
+                    slots = threading.Semaphore(self.workers)
+                    generation = current
+
+                    with lock:
+                        running.clear()
+
+                    # a job taken before the stop belongs to the stopped build.
+                    continue
+
+                if item is None:
+                    continue
+
+                job_id, func, args, measure = item
+                peaks = {}
+                done = report(job_id, slots, peaks)
+
+                if measure is True:
+                    peak_callback = lambda peak, peaks=peaks: peaks.__setitem__('peak', peak)
+                else:
+                    peak_callback = None
+
+                pool.apply(func, args,
+                           callback=lambda result, done=done: done(True, result),
+                           error_callback=lambda err, done=done: done(False, err),
+                           peak_callback=peak_callback)
+                ran += 1
+        finally:
+            pool.terminate()
+            outcomes.put(None)
+            sender.join()
+
+        logger.info('coordinator stopped, worker {0} ran {1} jobs.'.format(self.name, ran))
+        return ran
+
+    def _send(self, outcomes, sent):
+        """
+        Sends the outcome of every job in the ``outcomes`` queue to the
+        coordinator, and calls ``sent`` with the id of the job, until it
+        reads ``None``.
+        """
+
+        results = self.connect().results()
+
+        while True:
+            item = outcomes.get()
+
+            if item is None:
+                return
+
+            try:
+                try:
+                    results.put(item)
+                except (EOFError, IOError, OSError):
+                    raise
+                except Exception:
+                    # the exception of the job does not pickle.
+                    results.put(item[:2] + (StageRunError(repr(item[2])),) + item[3:])
+            except (EOFError, IOError, OSError):
+                logger.debug('coordinator stopped before job {0} completed.'.format(item[0]))
+
+            sent(item[0])
@@ -0,0 +1,616 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`scheduler` runs the targets of a dependency graph directly, rather than
+flattening the graph into a series of :class:`~stages.BuildStage()` objects.
+
+:class:`~scheduler.BuildGraph()` starts every target as soon as all of the
+targets it depends upon have completed, and keeps the worker pool full for the
+entire build rather than waiting on a barrier between each stage. Use it with
+:meth:`~system.BuildSystem.run()` and ``mode='dag'``, or with the ``buildc
+--scheduler dag`` option.
+
+When more targets are ready than there are free workers,
+:class:`~scheduler.BuildGraph()` starts the targets on the longest remaining
+path through the graph first, weighted by the time each target took to build
+in the past, so that long chains of targets do not start last.
+
+Targets may belong to named resource pools, with a depth that limits how many
+targets in the pool run at once (e.g. link jobs, or jobs that use a database).
+Targets from full pools wait, while other ready targets use the free workers.
+Targets with a memory estimate wait until the estimate fits in the memory of
+the system, as described by :class:`~executors.MemoryLimit()`.
+
+With a :class:`~cache.ActionCache()`, targets whose job and dependencies
+match an earlier build restore their output from the cache rather than run.
+
+Targets may be *restat* targets, as with the ``restat`` option of ninja rules:
+when the job of a restat target leaves its output unchanged, targets that
+are in the graph only because they depend on it do not run, unless the
+:attr:`~scheduler.BuildGraph.check` of the graph finds that they need a
+rebuild of their own.
+"""
+
+import time
+import heapq
+import logging
+from collections import deque
+from multiprocessing import cpu_count
+from queue import Queue
+
+from buildcloth.err import InvalidJob, StageRunError
+from buildcloth.buildlog import record_job, output_signature
+from buildcloth.executors import Executor, PoolLimits, MemoryLimit
+from buildcloth.stages import BuildSteps
+
+logger = logging.getLogger(__name__)
+
+class BuildGraph(object):
+    """
+    A representation of a group of targets, the jobs that build those targets,
+    and the dependencies between the targets.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        "Mapping of targets to job tuples."
+
+        self.graph = {}
+        "Mapping of targets to the list of targets that they depend upon."
+
+        self.executor = Executor
+        """A callable that takes a number of workers and returns the pool
+        object that :meth:`~scheduler.BuildGraph.run()` submits jobs to."""
+
+        self._workers = cpu_count()
+        """The number of jobs that :meth:`~scheduler.BuildGraph.run()` will
+        run concurrently."""
+
+        self.durations = {}
+        """Mapping of targets to the number of seconds that the job for the
+        target took to run. :meth:`~scheduler.BuildGraph.run()` updates this
+        mapping as targets complete, and uses it to decide which ready target
+        to start first."""
+
+        self.log = None
+        """A :class:`~buildlog.BuildLog` object that records the outcome of
+        every target that :meth:`~scheduler.BuildGraph.run()` builds, or
+        ``None``."""
+
+        self.pools = {}
+        """A mapping of the names of resource pools to the maximum number of
+        targets in each pool that may run at once."""
+
+        self.job_pools = {}
+        "A mapping of targets to the names of their resource pools."
+
+        self.job_memory = {}
+        "A mapping of targets to the memory, in bytes, that their jobs need."
+
+        self.mem_ceiling = None
+        """The maximum number of bytes that the memory estimates of running
+        targets may add up to, or ``None``."""
+
+        self.cache = None
+        """A :class:`~cache.ActionCache` object that stores the output of
+        every target that :meth:`~scheduler.BuildGraph.run()` builds, and
+        restores outputs in place of running jobs, or ``None``."""
+
+        self.stats = None
+        """A :class:`~dependency.StatCache` to invalidate as targets complete,
+        or ``None``."""
+
+        self.inputs = None
+        """A callable that returns the :func:`~dependency.inputs_digest()` of
+        a list of dependencies, to record in the
+        :attr:`~scheduler.BuildGraph.log` for every target that builds
+        successfully, or ``None``."""
+
+        self.restat = set()
+        """The targets whose dependents only run when the job of the target
+        changes its output."""
+
+        self.stale = set()
+        """The targets that need a rebuild whatever their dependencies do.
+        Other targets are in the graph because a dependency will rebuild."""
+
+        self.check = None
+        """A callable that takes a target, and returns ``True`` if the target
+        needs a rebuild. :meth:`~scheduler.BuildGraph.run()` calls it for
+        targets that are not :attr:`~scheduler.BuildGraph.stale`, when none of
+        their dependencies changed. If ``None``, every target runs."""
+
+        self.digest = None
+        """A callable that returns the digest of a file, to compare the
+        outputs of :attr:`~scheduler.BuildGraph.restat` targets whose size or
+        modification time changed, or ``None`` to only compare those."""
+
+    def __contains__(self, target):
+        return target in self.jobs
+
+    def _inputs(self, target):
+        """
+        :returns: The digest of the dependencies of ``target`` from
+           :attr:`~scheduler.BuildGraph.inputs`, or ``None`` without a
+           :attr:`~scheduler.BuildGraph.log`.
+        """
+
+        if self.inputs is None or self.log is None:
+            return None
+        else:
+            return self.inputs(self.graph[target])
+
+    @property
+    def workers(self):
+        """The number of jobs to run concurrently. Defaults to the number of
+        cores/threads available on your system. Cannot be set to a value lower
+        than ``2``."""
+
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        if value <= 1:
+            self._workers = 2
+            logger.debug("worker values must be at least 2, cannot have a pool with {0} workers".format(value))
+        else:
+            self._workers = value
+            logger.debug("set the default size of the worker pool to {0}".format(value))
+
+    def add(self, target, func, args, dependency=None, pool=None, mem=None, restat=False):
+        """
+        :param string target: The name of the target that the job builds.
+
+        :param callable func: A callable object to run as a job.
+
+        :param tuple args: A tuple or dict of arguments to pass to the callable.
+
+        :param list dependency: Optional. A list of the names of the targets
+           that must complete before ``target`` can run.
+
+        :param string pool: Optional. The name of a resource pool in
+           :attr:`~scheduler.BuildGraph.pools`.
+
+        :param int mem: Optional. An estimate of the memory, in bytes, that
+           the job needs.
+
+        :param bool restat: Optional. If ``True``, adds ``target`` to
+           :attr:`~scheduler.BuildGraph.restat`.
+
+        :raises: :exc:`~err.InvalidJob` if ``target`` already exists in the
+           graph or if the job is malformed.
+        """
+
+        if target in self.jobs:
+            logger.critical('cannot add {0} to the graph a second time.'.format(target))
+            raise InvalidJob('{0} already exists in the graph'.format(target))
+
+        if args is not None and BuildSteps.validate((func, args)) is False:
+            logger.critical('cannot add malformed job for {0} to the graph.'.format(target))
+            raise InvalidJob('malformed job for {0}'.format(target))
+
+        if dependency is None:
+            dependency = []
+
+        self.jobs[target] = (func, args)
+        self.graph[target] = list(dependency)
+
+        if pool is not None:
+            self.job_pools[target] = pool
+
+        if mem is not None:
+            self.job_memory[target] = mem
+
+        if restat is True:
+            self.restat.add(target)
+
+        logger.debug('added {0} to the build graph'.format(target))
+
+    def count(self):
+        """
+        :returns: The number of targets in the :class:`~scheduler.BuildGraph`.
+        """
+        return len(self.jobs)
+
+    def _edges(self):
+        """
+        :returns: A tuple of two dicts: the first maps every target to the
+           number of its dependencies that exist in the graph, and the second
+           maps every target to the list of targets that depend upon it.
+
+        Dependencies that are not targets in the graph (i.e. source files or
+        targets that do not need a rebuild) do not constrain the order.
+        """
+
+        remaining = {}
+        dependents = {}
+
+        for target in self.jobs:
+            remaining[target] = 0
+            dependents[target] = []
+
+        for target, dependency in self.graph.items():
+            for dep in set(dependency):
+                if dep in self.jobs and dep != target:
+                    remaining[target] += 1
+                    dependents[dep].append(target)
+
+        return remaining, dependents
+
+    def _priorities(self, remaining, dependents):
+        """
+        :param dict remaining: Maps targets to the number of their
+           dependencies in the graph, as returned by
+           :meth:`~scheduler.BuildGraph._edges()`.
+
+        :param dict dependents: Maps targets to the targets that depend upon
+           them, as returned by :meth:`~scheduler.BuildGraph._edges()`.
+
+        :returns: A dict that maps every target to the length of the longest
+           path from the target to the end of the build, i.e. the duration of
+           the target plus the longest path of any target that depends upon
+           it. Targets without a recorded duration count as the average of
+           the recorded durations, or ``1`` if there are none.
+        """
+
+        if self.durations:
+            default = float(sum(self.durations.values())) / len(self.durations)
+        else:
+            default = 1.0
+
+        remaining = dict(remaining)
+        ready = deque([ target for target in self.jobs if remaining[target] == 0 ])
+        order = []
+
+        while ready:
+            target = ready.popleft()
+            order.append(target)
+
+            for dependent in dependents[target]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+
+        priority = {}
+
+        # targets in a dependency cycle never run, and only need a value.
+        for target in self.jobs:
+            priority[target] = self.durations.get(target, default)
+
+        for target in reversed(order):
+            longest = 0
+            for dependent in dependents[target]:
+                if priority[dependent] > longest:
+                    longest = priority[dependent]
+
+            priority[target] += longest
+
+        return priority
+
+    def _needs_run(self, target, changed):
+        """
+        :param string target: The name of a target whose dependencies have
+           completed.
+
+        :param set changed: The targets that ran or were restored, and whose
+           output changed.
+
+        :returns: ``True`` if the job for ``target`` must run: when there is
+           no :attr:`~scheduler.BuildGraph.check`, when ``target`` is
+           :attr:`~scheduler.BuildGraph.stale`, when a dependency changed, or
+           when the check finds that ``target`` needs a rebuild.
+        """
+
+        if self.check is None or target in self.stale:
+            return True
+
+        for dep in self.graph[target]:
+            if dep in changed:
+                return True
+
+        if self.check(target) is True:
+            return True
+
+        logger.info('skipping {0}: its dependencies did not change'.format(target))
+        return False
+
+    def _output_state(self, target):
+        """
+        :returns: A tuple of the :func:`~buildlog.output_signature()` of
+           ``target``, and its digest from :attr:`~scheduler.BuildGraph.digest`
+           or ``None``, to pass to
+           :meth:`~scheduler.BuildGraph._output_changed()` once the job runs.
+        """
+
+        signature = output_signature(target)
+
+        if self.digest is None or signature == '-':
+            return (signature, None)
+
+        try:
+            return (signature, self.digest(target))
+        except (OSError, IOError):
+            return (signature, None)
+
+    def _output_changed(self, target, before):
+        """
+        :param tuple before: The result of
+           :meth:`~scheduler.BuildGraph._output_state()` before the job ran.
+
+        :returns: ``False`` if the job left ``target`` as it was: with the
+           same size and modification time, or with the same digest.
+        """
+
+        signature = output_signature(target)
+
+        if signature == '-':
+            return True
+        elif signature == before[0]:
+            return False
+        elif before[1] is None:
+            return True
+
+        try:
+            return self.digest(target) != before[1]
+        except (OSError, IOError):
+            return True
+
+    @staticmethod
+    def _dispatch(pool, target, job, done, peaks=None):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param string target: The name of the target.
+
+        :param tuple job: A job tuple with a callable and its arguments.
+
+        :param Queue done: A queue that receives a ``(target, success,
+           result)`` tuple when the job completes.
+
+        :param dict peaks: Optional. If set, measures the peak resident set
+           size of the job and stores it in ``peaks`` under ``target``.
+        """
+
+        def callback(result):
+            done.put((target, True, result))
+
+        def error_callback(err):
+            done.put((target, False, err))
+
+        if peaks is None:
+            BuildSteps.dispatch(pool, job, callback, error_callback)
+        else:
+            BuildSteps.dispatch(pool, job, callback, error_callback,
+                                lambda peak: peaks.__setitem__(target, peak))
+        logger.info('started {0}'.format(target))
+
+    def _restore(self, target, keys):
+        """
+        :param string target: The name of a target.
+
+        :param dict keys: Maps targets to a tuple of their cache key and
+           their :func:`~buildlog.output_signature()` before the job runs.
+           Receives an item for ``target`` if the job for ``target`` must
+           run and its output may be cached.
+
+        :returns: ``True`` if :attr:`~scheduler.BuildGraph.cache` restored
+           ``target``, and ``False`` if the job for ``target`` must run.
+        """
+
+        if self.cache is None:
+            return False
+
+        key = self.cache.key(self.jobs[target], self.graph[target])
+
+        if key is None:
+            return False
+        elif self.cache.restore(key, target) is True:
+            return True
+        else:
+            keys[target] = (key, output_signature(target))
+            return False
+
+    def run(self, workers=None, pool=None):
+        """
+        :param int workers: Overrides :attr:`~scheduler.BuildGraph.workers`.
+
+        :param Executor pool: Optional. A :class:`~executors.Executor` to
+           submit jobs to. If ``None``, creates a pool for the graph.
+
+        Runs every target in the graph. Each target starts as soon as all of
+        its dependencies complete, and at most ``workers`` jobs run at once.
+        Targets in a resource pool also wait until fewer than the depth of
+        the pool are running, and targets with a memory estimate wait until
+        the estimate fits, as with :class:`~executors.MemoryLimit`.
+        Of the targets that are ready to run, starts the target with the
+        longest path to the end of the build first. With a
+        :attr:`~scheduler.BuildGraph.cache`, restores targets from the cache
+        when possible, and stores the output of every other target. Records the duration of
+        every job in :attr:`~scheduler.BuildGraph.durations`, and the outcome
+        and peak memory use of every job in :attr:`~scheduler.BuildGraph.log`.
+        When the job of a :attr:`~scheduler.BuildGraph.restat` target leaves
+        its output unchanged, skips the targets that depend on it, unless
+        they are :attr:`~scheduler.BuildGraph.stale`, another dependency
+        changed, or the :attr:`~scheduler.BuildGraph.check` finds that they
+        need a rebuild.
+
+        :returns: ``True`` upon completion, and ``False`` if a job raised an
+           exception or a shell job exited with a non-zero status. After the
+           first failure, terminates ``pool``, which discards queued jobs and
+           stops running commands.
+
+        :raises: :exc:`~err.StageRunError` if the graph contains a cycle.
+        """
+
+        if workers is None:
+            if pool is None:
+                workers = self.workers
+            else:
+                workers = pool.workers
+
+        if pool is None:
+            with self.executor(workers) as pool:
+                logger.info('created worker pool with {0} workers for build graph'.format(workers))
+                return self._run(pool, workers)
+        else:
+            return self._run(pool, workers)
+
+    def _run(self, pool, workers):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param int workers: The maximum number of jobs to run at once.
+
+        Implements :meth:`~scheduler.BuildGraph.run()`.
+        """
+
+        remaining, dependents = self._edges()
+        priority = self._priorities(remaining, dependents)
+
+        # a heap of (-priority, target) tuples: the target with the longest
+        # path to the end of the build, and then the first by name, runs next.
+        ready = [ (-priority[target], target) for target in self.jobs if remaining[target] == 0 ]
+        heapq.heapify(ready)
+
+        if self.jobs and not ready:
+            logger.critical('every target in the graph depends on another target.')
+            raise StageRunError('dependency cycle in build graph.')
+
+        done = Queue()
+        limits = PoolLimits(self.pools)
+        memory = MemoryLimit(self.mem_ceiling)
+        peaks = None if self.log is None else {}
+        keys = {}
+        restored = set()
+        changed = set()
+        runnable = set()
+        before = {}
+        held = {}
+        mem_held = []
+        started = {}
+        running = 0
+        completed = 0
+        failed = None
+
+        def release(target):
+            for dependent in dependents[target]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, (-priority[dependent], dependent))
+
+        while ready or running:
+            while ready and running < workers:
+                item = heapq.heappop(ready)
+                target = item[1]
+                name = self.job_pools.get(target)
+
+                if target not in runnable:
+                    if not self._needs_run(target, changed):
+                        completed += 1
+                        release(target)
+                        continue
+
+                    runnable.add(target)
+
+                if not limits.available(name):
+                    heapq.heappush(held.setdefault(name, []), item)
+                    continue
+
+                mem = self.job_memory.get(target)
+                if not memory.available(mem):
+                    heapq.heappush(mem_held, item)
+                    continue
+
+                limits.acquire(name)
+                memory.acquire(mem)
+                started[target] = time.time()
+                running += 1
+
+                if target in self.restat:
+                    before[target] = self._output_state(target)
+
+                if self._restore(target, keys) is True:
+                    restored.add(target)
+                    done.put((target, True, None))
+                else:
+                    self._dispatch(pool, target, self.jobs[target], done, peaks)
+
+            if running == 0:
+                # every ready target was skipped.
+                continue
+
+            target, success, result = done.get()
+            running -= 1
+
+            if self.stats is not None:
+                self.stats.invalidate(target)
+            start = started.pop(target)
+            key = keys.pop(target, None)
+
+            # restoring a target says nothing about how long its job takes.
+            if target in restored:
+                restored.discard(target)
+            else:
+                self.durations[target] = time.time() - start
+
+            # one slot opened in the target's resource pool: the held target
+            # with the highest priority in that pool may run.
+            name = self.job_pools.get(target)
+            limits.release(name)
+            if held.get(name):
+                heapq.heappush(ready, heapq.heappop(held[name]))
+
+            # memory is free: any of the targets that waited for memory may fit.
+            memory.release(self.job_memory.get(target))
+            while mem_held:
+                heapq.heappush(ready, heapq.heappop(mem_held))
+
+            peak = None if peaks is None else peaks.pop(target, None)
+
+            if success is True:
+                record_job(self.log, target, self.jobs[target], start, peak=peak,
+                           inputs=self._inputs(target))
+            else:
+                record_job(self.log, target, self.jobs[target], start, result, peak)
+
+            if success is False:
+                logger.critical('{0} failed, cancelling remaining jobs: {1}'.format(target, result))
+                failed = target
+                pool.terminate()
+                break
+
+            if key is not None:
+                self.cache.store(key[0], target, key[1])
+
+            if target in before and not self._output_changed(target, before.pop(target)):
+                logger.info('{0} did not change, pruning the targets that depend on it'.format(target))
+            else:
+                changed.add(target)
+
+            completed += 1
+            logger.info('completed {0}'.format(target))
+
+            release(target)
+
+        if failed is not None:
+            logger.critical('build graph stopped after failure in: {0}'.format(failed))
+            return False
+        elif completed != len(self.jobs):
+            blocked = [ target for target in self.jobs if remaining[target] > 0 ]
+            logger.critical('targets in a dependency cycle never ran: {0}'.format(', '.join(sorted(blocked))))
+            raise StageRunError('dependency cycle in build graph.')
+
+        logger.debug('completed all {0} targets in build graph.'.format(completed))
+        return True
@@ -37,9 +37,14 @@ despite different behaviors.
 
 import types
 import logging
-from multiprocessing import cpu_count, Pool
+import threading
+from collections import deque
+from multiprocessing import cpu_count
+from queue import Queue
 
 from buildcloth.err import InvalidStage, StageClosed, StageRunError, InvalidJob, InvalidSystem
+from buildcloth.executors import (Executor, PoolLimits, MemoryLimit, BatchSizer, run_batch,
+                                  check_result, is_shell_job)
 from buildcloth.utils import is_function
 
 logger = logging.getLogger(__name__)
@@ -76,6 +81,35 @@ class BuildSteps(object):
         """An attribute that specifies the number of worker processes used in
         the pool for builds run in parallel."""
 
+        self.executor = Executor
+        """A callable that takes a number of workers and returns the pool
+        object that :meth:`~stages.BuildSteps.run()` submits jobs to. Defaults
+        to :class:`~executors.Executor`, which runs shell jobs in threads and
+        Python function jobs in processes."""
+
+        self.pools = {}
+        """A mapping of the names of resource pools to the maximum number of
+        jobs in each pool that may run at once."""
+
+        self.job_pools = {}
+        """A mapping of the indexes of jobs in
+        :attr:`~stages.BuildSteps.stage` to the names of their resource
+        pools."""
+
+        self.job_memory = {}
+        """A mapping of the indexes of jobs in
+        :attr:`~stages.BuildSteps.stage` to the memory, in bytes, that the
+        jobs need."""
+
+        self.mem_ceiling = None
+        """The maximum number of bytes that the memory estimates of running
+        jobs may add up to, or ``None``."""
+
+        self.results = []
+        """A list of ``(job, result)`` tuples, in the order that the jobs
+        completed during the most recent run. For shell jobs, ``result`` is the
+        exit status of the command."""
+
         if initial_stage is not None:
             self.add(initial_stage)
 
@@ -159,7 +193,9 @@ class BuildSteps(object):
                 logger.warning('in permissive mode, error  returning false.')
                 return False
 
-        if not isinstance(stage[1], tuple) and not isinstance(stage[1], dict) and not isinstance(stage[1], list):
+        if stage[1] is None and isinstance(getattr(stage[0], '__self__', None), BuildSteps):
+            logger.debug('stage is a nested group of jobs.')
+        elif not isinstance(stage[1], tuple) and not isinstance(stage[1], dict) and not isinstance(stage[1], list):
             if strict:
                 logger.warning('strict mode, error causing an exception.')
                 raise InvalidStage('not a tuple or dict')
@@ -169,7 +205,7 @@ class BuildSteps(object):
 
         return True
 
-    def add(self, func, args, strict=True):
+    def add(self, func, args, strict=True, pool=None, mem=None):
         """
         :param callable func: A callable object (e.g. function or method) to run
             as a job.
@@ -180,6 +216,13 @@ class BuildSteps(object):
             exceptions when attempting to perform inadmissible actions. If
             strict is ``False``, will continue to operate silently.
 
+        :param string pool: Optional. The name of a resource pool in
+            :attr:`~stages.BuildSteps.pools` that limits how many jobs like
+            this one run at once.
+
+        :param int mem: Optional. An estimate of the memory, in bytes, that
+            the job needs.
+
         :raises: :exc:`err.StageClosed` in strict mode, if attempting to add to
             an already closed stage.
 
@@ -199,6 +242,12 @@ class BuildSteps(object):
 
         stage = (func, args)
         if self.validate(stage, strict):
+            if pool is not None:
+                self.job_pools[len(self.stage)] = pool
+
+            if mem is not None:
+                self.job_memory[len(self.stage)] = mem
+
             self.stage.append(stage)
             logger.info('added stage calling {0}'.format(func.__name__))
             return True
@@ -264,47 +313,340 @@ class BuildSteps(object):
         """
         return len(self.stage)
 
+    def _pool_size(self, workers=None):
+        """
+        :param int workers: Optional. Overrides :meth:~stages.BuildSteps.workers`.
+
+        :returns: The number of workers to use for a pool created by this
+           object.
+        """
+
+        if workers is None:
+            logger.debug('no worker specified to run(), using the class default.')
+            workers = self.workers
+
+        if is_function(workers):
+            workers = workers()
+
+        return workers
+
+    @staticmethod
+    def dispatch(pool, job, callback, error_callback, peak_callback=None):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param tuple job: A job tuple, with a callable and its arguments.
+
+        :param callable callback: Called when the job completes.
+
+        :param callable error_callback: Called with the exception if the job
+           fails.
+
+        :param callable peak_callback: Optional. Called with the peak
+           resident set size of the job, as measured by
+           :func:`~executors.measured()`. Not called for nested jobs.
+
+        Submits ``job`` to ``pool``. If the job's callable is the ``run()``
+        method of another :class:`~stages.BuildSteps` object, as with the jobs
+        that :meth:`~system.BuildSystemGenerator.generate_sequence()`
+        produces, submits the nested jobs to ``pool`` directly rather than
+        running the nested object inside of a single worker.
+        """
+
+        owner = getattr(job[0], '__self__', None)
+
+        if isinstance(owner, BuildSteps):
+            logger.debug('submitting nested jobs to the shared pool.')
+            owner.submit(pool, callback, error_callback)
+        elif peak_callback is None:
+            pool.apply(job[0], job[1], callback=callback, error_callback=error_callback)
+            logger.info('calling job ({0}) operation asynchronously'.format(job[0].__name__))
+        else:
+            pool.apply(job[0], job[1], callback=callback, error_callback=error_callback,
+                       peak_callback=peak_callback)
+            logger.info('calling job ({0}) operation asynchronously'.format(job[0].__name__))
+
+    def submit(self, pool, callback, error_callback):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param callable callback: Called once all jobs complete.
+
+        :param callable error_callback: Called with the exception if a job
+           fails.
+
+        :raises: :exc:`python:NotImplementedError()`
+        """
+        raise NotImplementedError
+
     def run(self):
         """
         :raises: :exc:`python:NotImplementedError()`
         """
         raise NotImplementedError
 
+    def _wait(self, pool):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        Submits the jobs to ``pool`` and blocks until they complete, or until
+        the first job fails. After a failure, terminates ``pool``, which
+        discards queued jobs and stops running commands.
+
+        :returns: ``True`` upon completion, and ``False`` if a job failed.
+        """
+
+        done = Queue()
+        self.results = []
+
+        self.submit(pool,
+                    lambda result: done.put((True, result)),
+                    lambda err: done.put((False, err)))
+
+        logger.info('now waiting for jobs to finish.')
+        success, result = done.get()
+
+        if success is False:
+            logger.critical('job failed, cancelling remaining jobs: {0}'.format(result))
+            pool.terminate()
+            return False
+
+        return True
+
+    def _record(self, job):
+        """
+        :param tuple job: A job tuple.
+
+        :returns: A callback that appends the result of ``job`` to
+           :attr:`~stages.BuildSteps.results`.
+        """
+
+        def record(result):
+            self.results.append((job, result))
+
+        return record
+
+BATCH_MIN_JOBS = 256
+"""The number of Python function jobs in a :class:`~stages.BuildStage` at
+which the stage starts to send jobs to workers in chunks."""
+
 class BuildStage(BuildSteps):
     """
     A subclass of :class:~stages.BuildSteps` that executes jobs using a
     :mod:`python:multiprocessing` worker pool.
     """
 
-    def run(self, workers=None):
+    def __init__(self, initial_stage=None):
+        super(BuildStage, self).__init__(initial_stage)
+
+        self.batch = None
+        """Controls whether the stage sends Python function jobs to workers
+        in chunks, with :func:`~executors.run_batch()`, rather than one at a
+        time. ``True`` always uses chunks, ``False`` never does, and ``None``
+        uses chunks for stages with at least
+        :data:`~stages.BATCH_MIN_JOBS` such jobs. Shell jobs, nested jobs,
+        and jobs in resource pools or with memory estimates always run one at
+        a time."""
+
+    def _batched(self):
+        """
+        :returns: A list of the indexes of the jobs in the stage to run in
+           chunks, according to :attr:`~stages.BuildStage.batch`.
+        """
+
+        if self.batch is False:
+            return []
+
+        batched = [ idx for idx, job in enumerate(self.stage)
+                    if not is_shell_job(job[0])
+                    and not isinstance(getattr(job[0], '__self__', None), BuildSteps)
+                    and idx not in self.job_pools
+                    and idx not in self.job_memory ]
+
+        if self.batch is True or len(batched) >= BATCH_MIN_JOBS:
+            return batched
+        else:
+            return []
+
+    def submit(self, pool, callback, error_callback):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param callable callback: Called once all jobs complete.
+
+        :param callable error_callback: Called with the exception if a job
+           fails.
+
+        Submits every job in the stage to ``pool`` at once, except for jobs
+        in resource pools that are already full, which wait until a job in
+        the same resource pool completes, and jobs with memory estimates that
+        do not fit, as described by :class:`~executors.MemoryLimit`, which
+        wait until any job completes.
+
+        Sends Python function jobs to ``pool`` in chunks, if
+        :attr:`~stages.BuildStage.batch` calls for it. At most two chunks per
+        worker wait in ``pool`` at once, and a
+        :class:`~executors.BatchSizer` sizes each chunk from the time per job
+        of the chunks that completed.
+        """
+
+        if not self.stage:
+            callback(True)
+            return
+
+        lock = threading.Lock()
+        state = {'remaining': len(self.stage), 'failed': False}
+        limits = PoolLimits(self.pools)
+        memory = MemoryLimit(self.mem_ceiling)
+        held = {}
+        mem_held = deque()
+
+        batched = self._batched()
+        chunks = deque(self.stage[idx] for idx in batched)
+        sizer = BatchSizer()
+        workers = getattr(pool, 'workers', None) or cpu_count()
+        state['chunks'] = 0
+
+        def admit(item, ready):
+            # call with the lock held.
+            name, mem, job = item
+
+            if not limits.available(name):
+                held.setdefault(name, deque()).append(item)
+            elif not memory.available(mem):
+                mem_held.append(item)
+            else:
+                limits.acquire(name)
+                memory.acquire(mem)
+                ready.append(item)
+
+        def start(name, mem, job):
+            self.dispatch(pool, job, complete(name, mem, job), failed)
+
+        def complete(name, mem, job):
+            record = self._record(job)
+
+            def done(result):
+                record(result)
+                ready = []
+
+                with lock:
+                    state['remaining'] -= 1
+                    finished = state['remaining'] == 0 and state['failed'] is False
+
+                    limits.release(name)
+                    memory.release(mem)
+
+                    # only jobs in the same resource pool, and jobs that
+                    # waited for memory, can start now.
+                    waiting = held.get(name)
+                    while waiting and limits.available(name):
+                        admit(waiting.popleft(), ready)
+
+                    for i in range(len(mem_held)):
+                        admit(mem_held.popleft(), ready)
+
+                if finished:
+                    logger.debug('completed all jobs in stage.')
+                    callback(True)
+                elif state['failed'] is False:
+                    for item in ready:
+                        start(*item)
+
+            return done
+
+        def next_chunks():
+            # call with the lock held.
+            ready = []
+
+            while chunks and state['chunks'] < 2 * workers:
+                size = sizer.size(len(chunks), workers)
+                ready.append([ chunks.popleft() for i in range(size) ])
+                state['chunks'] += 1
+
+            return ready
+
+        def start_chunk(chunk):
+            pool.apply(run_batch, (chunk,), callback=complete_chunk(chunk), error_callback=failed)
+            logger.debug('sent a chunk of {0} jobs to the pool.'.format(len(chunk)))
+
+        def complete_chunk(chunk):
+            def done(value):
+                results, elapsed = value
+
+                with lock:
+                    self.results.extend(zip(chunk, results))
+                    sizer.update(len(chunk), elapsed)
+
+                    state['chunks'] -= 1
+                    state['remaining'] -= len(chunk)
+                    finished = state['remaining'] == 0 and state['failed'] is False
+
+                    ready = next_chunks()
+
+                if finished:
+                    logger.debug('completed all jobs in stage.')
+                    callback(True)
+                elif state['failed'] is False:
+                    for item in ready:
+                        start_chunk(item)
+
+            return done
+
+        def failed(err):
+            with lock:
+                first = state['failed'] is False
+                state['failed'] = True
+
+            if first:
+                error_callback(err)
+
+        ready = []
+        with lock:
+            skip = set(batched)
+            for idx, job in enumerate(self.stage):
+                if idx not in skip:
+                    admit((self.job_pools.get(idx), self.job_memory.get(idx), job), ready)
+
+            ready_chunks = next_chunks()
+
+        if batched:
+            logger.info('running {0} jobs in chunks.'.format(len(batched)))
+
+        for name, waiting in held.items():
+            logger.debug('holding {0} jobs until resource pool {1} has room.'.format(len(waiting), name))
+
+        if mem_held:
+            logger.debug('holding {0} jobs until there is enough memory.'.format(len(mem_held)))
+
+        for item in ready:
+            start(*item)
+
+        for chunk in ready_chunks:
+            start_chunk(chunk)
+
+    def run(self, workers=None, pool=None):
         """
         :param int workers: Overrides the :meth:~stages.BuildSteps.workers`
            value, which is typically the number of CPU cores your system has.
 
+        :param Executor pool: Optional. A :class:`~executors.Executor` to
+           submit jobs to. :class:`~system.BuildSystem` shares one pool between
+           all stages in a build. If ``None``, creates a pool for this stage.
+
         Runs all jobs in :attr:~stages.BuildSteps.stages` using a worker pool.
 
         :returns: ``True`` upon completion.
         """
 
-        if workers is None:
-            logger.debug('no worker specified to run(), using the class default.')
-            workers = self.workers()
-
-        p = Pool(processes=workers)
-        logger.info('created working pool with {0} workers'.format(workers))
-
-        for job in self.stage:
-            if isinstance(job[1], dict):
-                p.apply_async(job[0], kwds=job[1])
-            else:
-                p.apply_async(job[0], job[1])
-            logger.info('calling job ({0}) operation asynchronously'.format(job[0].__name__))
+        if pool is None:
+            workers = self._pool_size(workers)
 
-        p.close()
-        logger.info('now waiting for jobs to finish.')
-        p.join()
-        logger.debug('completed worker pool for stage.')
-        return True
+            with self.executor(workers) as pool:
+                logger.info('created working pool with {0} workers'.format(workers))
+                return self._wait(pool)
+        else:
+            return self._wait(pool)
 
 
 class BuildSequence(BuildSteps):
@@ -315,13 +657,71 @@ class BuildSequence(BuildSteps):
     :returns: ``True`` upon completion.
     """
 
-    def run(self, *args, **kwargs):
-        """Runs all jobs in :class:~stages.BuildSteps` in the order they were
-        added to the object. Ignores all arguments."""
+    def submit(self, pool, callback, error_callback):
+        """
+        :param Executor pool: A :class:`~executors.Executor` object.
+
+        :param callable callback: Called once all jobs complete.
+
+        :param callable error_callback: Called with the exception if a job
+           fails.
+
+        Submits the first job to ``pool`` and each following job when the
+        previous job completes. Stops after a failed job.
+        """
+
+        jobs = deque(self.stage)
+
+        def step(job=None, result=None):
+            if job is not None:
+                self.results.append((job, result))
+
+            if jobs:
+                job = jobs.popleft()
+                self.dispatch(pool, job, lambda result: step(job, result), error_callback)
+            else:
+                logger.debug('completed all jobs in sequence.')
+                callback(True)
+
+        step()
+
+    def run(self, workers=None, pool=None):
+        """
+        :param int workers: Ignored.
+
+        :param Executor pool: Optional. A :class:`~executors.Executor` to
+           submit jobs to, one at a time. If ``None``, runs the jobs in the
+           current process.
+
+        Runs all jobs in :class:~stages.BuildSteps` in the order they were
+        added to the object.
+
+        :returns: ``True`` upon completion, and ``False`` if a shell job exits
+           with a non-zero status, without running the remaining jobs.
+        """
+
+        if pool is not None:
+            logger.info('running jobs in a build sequence using a shared pool.')
+            return self._wait(pool)
 
         logger.info('running jobs in a build sequence.')
+        self.results = []
+
         for job in self.stage:
             logger.info('running {0}'.format(job[0].__name__))
-            job[0](*job[1])
+            if job[1] is None:
+                result = job[0]()
+            elif isinstance(job[1], dict):
+                result = job[0](**job[1])
+            else:
+                result = job[0](*job[1])
+
+            self.results.append((job, result))
+
+            try:
+                check_result(job[0], job[1], result)
+            except StageRunError as e:
+                logger.critical('job failed, not running remaining jobs: {0}'.format(e))
+                return False
 
         return True
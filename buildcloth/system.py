@@ -26,11 +26,15 @@ import subprocess
 import json
 import logging
 import os.path
+from multiprocessing import cpu_count
 
-from buildcloth.err import InvalidStage, StageClosed, StageRunError, InvalidJob, InvalidSystem
-from buildcloth.tsort import topological_sort, tsort
+from buildcloth.err import InvalidStage, StageClosed, StageRunError, InvalidJob, InvalidSystem, TargetError, DependencyCycleError
+from buildcloth.tree import DependencyTree
 from buildcloth.stages import BuildSequence, BuildStage, BuildSteps
-from buildcloth.dependency import DependencyChecks
+from buildcloth.scheduler import BuildGraph
+from buildcloth.executors import Executor, parse_size
+from buildcloth.dependency import DependencyChecks, HASH_CHECKS
+from buildcloth.buildlog import record_job, job_fingerprint, output_signature
 from buildcloth.utils import is_function
 
 logger = logging.getLogger(__name__)
@@ -67,6 +71,63 @@ class BuildSystem(object):
         ``False`` makes it possible to add stages to a finalized build or run
         un-finalized build processes"""
 
+        self.graph = None
+        """A :class:`~scheduler.BuildGraph` object that holds the dependency
+        tree for builds run in ``dag`` mode. ``None`` for build systems without
+        targets."""
+
+        self._workers = cpu_count()
+        """The number of workers in the pools that all stages of the build
+        share."""
+
+        self.executor = Executor
+        """A callable that takes a number of workers and returns the pool
+        object that every stage of a build shares. Defaults to
+        :class:`~executors.Executor`, which runs shell jobs in threads and
+        Python function jobs in processes."""
+
+        self.log = None
+        """A :class:`~buildlog.BuildLog` object that records the outcome of
+        every target the build system builds, or ``None``."""
+
+        self.max_load = None
+        """The load average at or above which the build holds back new jobs,
+        as with ``make -l``. ``None`` to start jobs regardless of the load of
+        the system."""
+
+        self.mem_ceiling = None
+        """The maximum number of bytes that the memory estimates of running
+        jobs may add up to, or ``None`` to limit jobs with estimates only by
+        the memory available on the system. See
+        :class:`~executors.MemoryLimit`."""
+
+        self.targets = {}
+        """A mapping of the names of stages to lists of ``(target, job)``
+        tuples for the targets that each stage builds."""
+
+        self.dependencies = {}
+        """A mapping of targets to the lists of files and targets that they
+        depend upon."""
+
+        self.cache = None
+        """A :class:`~cache.ActionCache` object that stores the outputs of
+        targets, and restores outputs in place of running jobs, or ``None``."""
+
+        self.stats = None
+        """The :class:`~dependency.StatCache` of the dependency checks for the
+        build, which forgets every target once its job runs, or ``None``."""
+
+        self.inputs = None
+        """A callable that returns the :func:`~dependency.inputs_digest()` of
+        a list of dependencies, to record in the
+        :attr:`~system.BuildSystem.log` for every target that builds
+        successfully, or ``None``."""
+
+        self.digest = None
+        """A callable that returns the digest of a file, which the
+        :attr:`~system.BuildSystem.graph` uses to compare the outputs of
+        ``restat`` targets, or ``None``."""
+
         if initial_system is not None:
             logger.debug('creating BuildSystem object with a default set of stages.')
             self.extend(initial_system)
@@ -97,6 +158,24 @@ class BuildSystem(object):
         else:
             logger.warning('cannot set strict to: {0}, leaving strict at {1}'.format(value, self._strict))
 
+    @property
+    def workers(self):
+        """The size of the worker pool that
+        :meth:`~system.BuildSystem.run()` creates once and shares between every
+        stage in the build. Defaults to the number of cores/threads available
+        on your system, and cannot be set to a value lower than ``2``."""
+
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        if value <= 1:
+            self._workers = 2
+            logger.debug("worker values must be at least 2, cannot have a pool with {0} workers".format(value))
+        else:
+            self._workers = value
+            logger.debug("set the default size of the worker pool to {0}".format(value))
+
     def close(self):
         "Sets the :attr:`~system.BuildSystem.open` value to ``False``."
         if self.open is True:
@@ -140,6 +219,8 @@ class BuildSystem(object):
         """
         if isinstance(system, BuildSystem):
             self.stages.update(system.stages)
+            self.targets.update(system.targets)
+            self.dependencies.update(system.dependencies)
 
             for job in system._stages:
                 self._stages.append(job)
@@ -307,9 +388,140 @@ class BuildSystem(object):
                                   exception=StageRunError,
                                   strict=strict)
         else:
-            self.stages[name].run(strict)
+            with self._executor() as pool:
+                self._run_one(name, pool)
             return True
 
+    def _executor(self):
+        """
+        :returns: A new pool object from :attr:`~system.BuildSystem.executor`
+           with :attr:`~system.BuildSystem.workers` workers, which holds back
+           jobs above :attr:`~system.BuildSystem.max_load`, if set.
+        """
+
+        if self.max_load is None:
+            return self.executor(self.workers)
+        else:
+            return self.executor(self.workers, max_load=self.max_load)
+
+    def _run_one(self, name, pool):
+        """
+        :param string name: The name of a stage.
+
+        :param Executor pool: The :class:`~executors.Executor` for the build.
+
+        Runs the stage, and records the outcome of the targets that the stage
+        builds in :attr:`~system.BuildSystem.log`. Every target in the stage
+        shares the start time and end time of the stage. With a
+        :attr:`~system.BuildSystem.cache`, skips the stage if the cache
+        restores every target of the stage, and otherwise stores the outputs
+        of the stage's targets once the stage succeeds.
+
+        :returns: The return value of the stage's ``run()`` method.
+        """
+
+        if self.mem_ceiling is not None:
+            self.stages[name].mem_ceiling = self.mem_ceiling
+
+        stage, keys = self._restore_stage(name)
+
+        if stage is None:
+            logger.info('restored every target of stage {0} from the cache'.format(name))
+            ret = True
+        else:
+            ret = stage.run(pool=pool)
+
+            if ret is not False:
+                for target, key in keys.items():
+                    self.cache.store(key[0], target, key[1])
+
+        if self.stats is not None:
+            for target, job in self.targets.get(name, []):
+                self.stats.invalidate(target)
+
+        self._record_stage(name, 1 if ret is False else 0)
+
+        return ret
+
+    def _restore_stage(self, name):
+        """
+        :param string name: The name of a stage.
+
+        :returns: A tuple of the stage to run, and a dict that maps the
+           targets of the stage that may be cached to tuples of their cache
+           key and their :func:`~buildlog.output_signature()`. The stage is
+           ``None`` if :attr:`~system.BuildSystem.cache` restored every target
+           that the stage builds, and a new stage with only the remaining
+           jobs if the cache restored some of them.
+
+        Targets that depend on another target in the same stage do not use
+        the cache, since their dependencies may change as the stage runs.
+        """
+
+        stage = self.stages[name]
+
+        if self.cache is None:
+            return stage, {}
+
+        targets = self.targets.get(name, [])
+        names = set(target for target, job in targets)
+        restored = set()
+        keys = {}
+
+        for target, job in targets:
+            dependency = self.dependencies.get(target, [])
+
+            if names.intersection(dependency):
+                continue
+
+            key = self.cache.key(job, dependency)
+
+            if key is None:
+                continue
+            elif self.cache.restore(key, target) is True:
+                restored.add(target)
+            else:
+                keys[target] = (key, output_signature(target))
+
+        if not restored:
+            return stage, keys
+        elif len(restored) == len(targets):
+            return None, keys
+
+        # generated stages add the jobs of their targets in order.
+        remaining = BuildStage()
+        remaining.pools = stage.pools
+        remaining.mem_ceiling = stage.mem_ceiling
+
+        for idx, (target, job) in enumerate(targets):
+            if target not in restored:
+                remaining.add(job[0], job[1], pool=stage.job_pools.get(idx), mem=stage.job_memory.get(idx))
+
+        return remaining, keys
+
+    def _record_stage(self, name, status):
+        """
+        :param string name: The name of a stage.
+
+        :param status: The exit status of the stage, or an exception.
+
+        Records the outcome of every target in the stage in
+        :attr:`~system.BuildSystem.log`, if there is a log. The jobs of a
+        stage run alongside each other, so the log keeps the durations of the
+        targets from earlier builds, rather than the time of the whole stage.
+        """
+
+        if self.log is None:
+            return
+
+        for target, job in self.targets.get(name, []):
+            if status == 0 and self.inputs is not None:
+                inputs = self.inputs(self.dependencies.get(target, []))
+            else:
+                inputs = None
+
+            record_job(self.log, target, job, None, status, inputs=inputs)
+
     def run_part(self, stop=0, start=0, run_all=False, strict=None):
         """
         :param int stop: The last job in the zero-indexed list of the tasks in
@@ -329,6 +541,8 @@ class BuildSystem(object):
 
         Calls the :meth:`~stages.BuildSteps.run()` method of each stage object
         until the ``idx``\ :sup:`th` item of the :attr:`~stages.BuildSystem._stages` array.
+        Every stage submits its jobs to a single :class:`~executors.Executor`
+        that lasts for the duration of the call.
         """
 
         if strict is None:
@@ -367,27 +581,44 @@ class BuildSystem(object):
             logger.critical('cannot run build systems that are open in strict mode.')
             raise StageRunError("Build system must be closed before running.")
         else:
-            for job in run_stages:
-                logger.info('running build stage {0}'.format(job))
-                ret = self.stages[job].run()
-                logger.info('completed build stage {0}'.format(job))
-
-                if ret is False:
-                    msg = 'job {0} failed, stopping and returning False'.format(idx)
-                    logger.critical(msg)
-                    return self._error_or_return(msg=msg, exception=StageRunError, strict=strict)
+            with self._executor() as pool:
+                for job in run_stages:
+                    logger.info('running build stage {0}'.format(job))
+                    ret = self._run_one(job, pool)
+                    logger.info('completed build stage {0}'.format(job))
+
+                    if ret is False:
+                        msg = 'stage {0} failed, stopping and returning False'.format(job)
+                        logger.critical(msg)
+                        return self._error_or_return(msg=msg, exception=StageRunError, strict=strict)
 
             return ret
 
-    def run(self, strict=None):
+    def run(self, strict=None, mode='stages'):
         """
         :param bool strict: Defaults to :attr:`~system.BuildSystem.strict`.
 
+        :param string mode: Defaults to ``stages``. Either ``stages`` or
+           ``dag``. In ``dag`` mode, runs the targets in
+           :attr:`~system.BuildSystem.graph` with
+           :meth:`~scheduler.BuildGraph.run()`, which starts each target as
+           soon as its dependencies complete, before running the remaining
+           stages.
+
         :raises: :exc:`~err.StageRunError` if ``strict`` is ``True`` and
-           :attr:`~system.BuildSystem.open` is ``True``.
+           :attr:`~system.BuildSystem.open` is ``True``, or if ``mode`` is not
+           a valid scheduler.
 
         Calls the :meth:`~stages.BuildSteps.run()` method of each stage object.
         """
+
+        if mode == 'dag':
+            return self._run_graph(strict)
+        elif mode != 'stages':
+            return self._error_or_return(msg='{0} is not a valid scheduler mode.'.format(mode),
+                                         exception=StageRunError,
+                                         strict=strict)
+
         logger.info('running entire build system')
         ret = self.run_part(run_all=True, strict=strict)
 
@@ -395,6 +626,90 @@ class BuildSystem(object):
 
         return ret
 
+    def run_async(self, strict=None, mode='stages'):
+        """
+        :param bool strict: Defaults to :attr:`~system.BuildSystem.strict`.
+
+        :param string mode: Defaults to ``stages``. Either ``stages`` or
+           ``dag``, as in :meth:`~system.BuildSystem.run()`.
+
+        :returns: An awaitable that runs the build on the current
+           :mod:`python:asyncio` event loop with an
+           :class:`~aio.AsyncRunner`, and returns ``True`` upon completion.
+           At most :attr:`~system.BuildSystem.workers` jobs run at once.
+           Does not use :attr:`~system.BuildSystem.cache`, or the memory
+           estimates of jobs and :attr:`~system.BuildSystem.mem_ceiling`.
+
+        :raises: :exc:`~err.StageRunError` if ``strict`` is ``True`` and
+           :attr:`~system.BuildSystem.open` is ``True``, or if a job fails.
+        """
+
+        from buildcloth.aio import run_system
+
+        return run_system(self, strict=strict, mode=mode)
+
+    def _run_graph(self, strict=None):
+        """
+        :param bool strict: Defaults to :attr:`~system.BuildSystem.strict`.
+
+        Implements the ``dag`` mode of :meth:`~system.BuildSystem.run()`. Runs
+        :attr:`~system.BuildSystem.graph`, and then every stage that does not
+        build a target in the graph.
+        """
+
+        if strict is None:
+            strict = self.strict
+
+        if strict is True and self.open is True:
+            logger.critical('cannot run build systems that are open in strict mode.')
+            raise StageRunError("Build system must be closed before running.")
+
+        ret = True
+
+        with self._executor() as pool:
+            if self.graph is None:
+                logger.debug('no build graph, running stages only.')
+            else:
+                logger.info('running build graph with {0} targets'.format(self.graph.count()))
+
+                if self.log is not None:
+                    self.graph.log = self.log
+                    self.graph.durations.update(self.log.durations())
+
+                if self.mem_ceiling is not None:
+                    self.graph.mem_ceiling = self.mem_ceiling
+
+                if self.cache is not None:
+                    self.graph.cache = self.cache
+
+                if self.stats is not None:
+                    self.graph.stats = self.stats
+
+                self.graph.inputs = self.inputs
+                self.graph.digest = self.digest
+
+                ret = self.graph.run(pool=pool)
+
+                if ret is False:
+                    msg = 'build graph failed, stopping and returning False'
+                    logger.critical(msg)
+                    return self._error_or_return(msg=msg, exception=StageRunError, strict=strict)
+
+            for job in self._stages:
+                if self.graph is not None and job in self.graph:
+                    continue
+
+                logger.info('running build stage {0}'.format(job))
+                ret = self._run_one(job, pool)
+                logger.info('completed build stage {0}'.format(job))
+
+                if ret is False:
+                    msg = 'stage {0} failed, stopping and returning False'.format(job)
+                    logger.critical(msg)
+                    return self._error_or_return(msg=msg, exception=StageRunError, strict=strict)
+
+        return ret
+
 class BuildSystemGenerator(object):
     """
     :class:`~system.BuildSystemGenerator` objects provide a unifying interface
@@ -455,14 +770,35 @@ class BuildSystemGenerator(object):
         logger.info('created empty build system object for build generator.')
 
         self._process_jobs = {}
-        "Mapping of targets to job tuples."
+        """Mapping of targets to ``(job, rebuild)`` tuples. ``rebuild`` is
+        ``None`` until :meth:`~system.BuildSystemGenerator.finalize()` checks
+        the target."""
 
         self._process_tree = {}
         "Internal representation of the dependency tree."
 
+        self._tree = None
+        """A :class:`~tree.DependencyTree()` of the edges between the targets
+        in :attr:`~system.BuildSystemGenerator._process_tree`, which
+        :meth:`~system.BuildSystemGenerator.finalize()` builds."""
+
+        self._order = None
+        """An array of the ids of the targets in
+        :attr:`~system.BuildSystemGenerator._tree`, where every target
+        precedes the targets that it depends upon."""
+
+        self._stale = set()
+        """The targets that need a rebuild of their own, rather than because a
+        target that they depend upon will rebuild."""
+
         self.specs = {}
         "Mapping of job specs targets to specs."
 
+        self.pools = {}
+        """Mapping of the names of resource pools to the maximum number of jobs
+        in each pool that may run at once. Specs declare pools in a document
+        with a ``pools`` key, and add jobs to a pool with a ``pool`` key."""
+
         self.system = None
 
         self._final = False
@@ -484,12 +820,18 @@ class BuildSystemGenerator(object):
         else:
             self.check.check_method = value
 
-    def finalize(self):
+    def finalize(self, goals=None):
         """
+        :param list goals: Optional. The names of the targets and stages to
+           build. If ``None``, builds every target and stage.
+
         :raises: :exc:`~err.InvalidSystem` if you call
            :meth:`~system.BuildSystemGenerator.finalize()` more than once on a
            single :class:`~system.BuildSystemGenerator()` object.
 
+        :raises: :exc:`~err.TargetError` if a goal is neither a target nor a
+           stage.
+
         You must call :meth:`~system.BuildSystemGenerator.finalize()` before
         running the build system.
 
@@ -499,10 +841,21 @@ class BuildSystemGenerator(object):
         :attr:`~system.BuildSystemGenerator.system` object. Otherwise,
         :meth:`~system.BuildSystemGenerator.finalize()` orders the tasks with
         dependencies, inserts them into a :class:`~stages.BuildSequence` object
-        before inserting the :attr:`~system.BuildSystemGenerator._stages` tasks.
+        before inserting the :attr:`~system.BuildSystemGenerator._stages` tasks,
+        and stores the dependency tree as a :class:`~scheduler.BuildGraph` in
+        :attr:`~system.BuildSystem.graph` for builds run in ``dag`` mode.
+
+        With ``goals``, only the goals and the targets that they depend upon,
+        directly or indirectly, remain in the build system. Dependency checks
+        run here, rather than as the generator ingests specs. See
+        :meth:`~system.BuildSystemGenerator._check_targets()`.
         """
 
         if self._final is False and self.system is None:
+            self._tree = DependencyTree(self._process_tree)
+
+            if goals is not None:
+                self._narrow(goals)
 
             if len(self._process_tree) == 0:
                 logger.debug('no dependency tasks exist, trying to add build stages.')
@@ -514,17 +867,34 @@ class BuildSystemGenerator(object):
                     raise InvalidSystem
 
             elif len(self._process_tree) > 0:
-                self.system = BuildSystem(self._stages)
+                self.system = BuildSystem()
+                self.system.dependencies.update(self._process_tree)
+
+                try:
+                    self._order = self._tree.sort()
+                except DependencyCycleError as e:
+                    logger.critical('cannot sort dependency tree with cycles: {0}'.format(e.msg))
+                    raise
 
-                self._process = tsort(self._process_tree)
+                self._process = [ self._tree.targets[node] for node in self._order ]
                 logger.debug('successfully sorted dependency tree.')
 
+                self._tree.reverse()
+                self._check_targets()
                 self._finalize_process_tree()
+                self._finalize_process_graph()
 
                 if self._stages.count() > 0:
                     self.system.extend(self._stages)
                     logger.info('added stages tasks to build system.')
 
+            self._finalize_pools()
+
+            self.system.stats = self.check.stats
+
+            if self.check.check_method in HASH_CHECKS:
+                self.system.inputs = self.check._inputs
+                self.system.digest = self.check._digest
             self.system.close()
             self._final = True
 
@@ -532,64 +902,230 @@ class BuildSystemGenerator(object):
             logger.critical('cannot finalize object')
             raise InvalidSystem
 
-    def _finalize_process_tree(self):
+    def _narrow(self, goals):
+        """
+        :param list goals: The names of targets and stages.
+
+        :raises: :exc:`~err.TargetError` if a goal is neither a target nor a
+           stage.
+
+        Removes every target that no goal depends upon, directly or
+        indirectly, from :attr:`~system.BuildSystemGenerator._tree` and
+        :attr:`~system.BuildSystemGenerator._process_tree`, and every stage
+        that is not a goal.
+        """
+
+        for goal in goals:
+            if goal not in self._tree and not self._stages.stage_exists(goal):
+                logger.critical('cannot build nonextant target named: {0}'.format(goal))
+                raise TargetError('{0} is not a target or stage'.format(goal))
+
+        tree = self._tree.narrow([ self._tree.ids[goal] for goal in goals if goal in self._tree ])
+
+        logger.info('building {0} of {1} targets for {2}'.format(len(tree), len(self._tree),
+                                                               ', '.join(goals)))
+
+        self._tree = tree
+        self._process_tree = dict((target, self._process_tree[target]) for target in tree.targets)
+
+        stages = BuildSystem()
+        for name in self._stages.get_order():
+            if name in goals:
+                stages.add_stage(name, self._stages.stages[name], strict=False)
+
+        self._stages = stages
+
+    def _mark_dirty(self, node, marked):
+        """
+        :param int node: The id of a target that needs a rebuild.
+
+        :param bytearray marked: Flags, by id, the targets that depend on a
+           target that needs a rebuild. Receives every target that this call
+           marks.
+
+        Marks the target, and every target that depends upon it directly or
+        indirectly, as needing a rebuild, following the dependents in
+        :attr:`~system.BuildSystemGenerator._tree`.
+        """
+
+        targets = self._tree.targets
+        pending = [node]
+
+        # targets marked earlier had their dependents marked with them.
+        while pending:
+            node = pending.pop()
+            target = targets[node]
+            self._process_jobs[target] = (self._process_jobs[target][0], True)
+
+            for dependent in self._tree.dependents(node):
+                if not marked[dependent]:
+                    marked[dependent] = 1
+                    pending.append(dependent)
+
+    def _check_targets(self):
         """
-        Loops over the :attr:`~system.BuildSystemGenerator._process` list tree
-        created in the main :meth:`~system.BuildSystemGenerator.finalize()`
-        method, and adds tasks to :attr:`~system.BuildSystemGenerator.system`
-        object, which is itself a :class:`~system.BuildSystem` object.
+        Decides which targets in :attr:`~system.BuildSystemGenerator._process`
+        need a rebuild, in dependency order, so that every target is checked
+        after the targets that it depends upon. When a target needs a
+        rebuild, every target that depends upon it is marked with
+        :meth:`~system.BuildSystemGenerator._mark_dirty()`, and needs no
+        dependency check. Other targets do not rebuild. Records the targets
+        that need a rebuild of their own in
+        :attr:`~system.BuildSystemGenerator._stale`. Targets whose
+        ``rebuild`` value in
+        :attr:`~system.BuildSystemGenerator._process_jobs` is already set keep
+        it, unless they depend on a target that rebuilds.
+
+        With the ``hash`` check, first hashes every dependency of the targets
+        at once with :meth:`~dependency.DigestCache.prefetch()`. The
+        ``mtime+hash`` check only hashes the dependencies of stale targets,
+        so does not prefetch.
+        """
+
+        if self.check.check_method == 'hash' and self.check.digests is not None:
+            self.check.digests.prefetch(dep for target in self._process
+                                        for dep in self._process_tree[target])
+
+        checked = 0
+        marked = bytearray(len(self._tree))
+
+        for node in reversed(self._order):
+            if marked[node]:
+                continue
+
+            target = self._tree.targets[node]
+            job, rebuild = self._process_jobs[target]
 
-        While constructing the :attr:`~system.BuildSystemGenerator.system`
-        object, :meth:`~system.BuildSystemGenerator._finalize_process_tree()`
-        combines adjacent tasks that do not depend upon each other to increase
-        the potential for parallel execution.
+            if rebuild is None:
+                rebuild = self._check_target(target, job, self._process_tree[target])
+                checked += 1
+
+            if rebuild is True:
+                self._stale.add(target)
+                self._mark_dirty(node, marked)
+            else:
+                self._process_jobs[target] = (job, False)
+
+        dirty = sum(1 for target in self._process if self._process_jobs[target][1] is True)
+
+        logger.debug('ran dependency checks on {0} of {1} targets'.format(checked, len(self._process)))
+        logger.info('{0} of {1} targets need a rebuild'.format(dirty, len(self._process)))
+
+    def _recheck_target(self, target):
+        """
+        :returns: ``True`` if the dependency check finds that ``target``
+           needs a rebuild. Checks targets that were only marked for a
+           rebuild because a target that they depend upon would rebuild.
+        """
+
+        return self._check_target(target, self._process_jobs[target][0], self._process_tree[target])
+
+    def _check_target(self, target, job, dependency):
+        """
+        :returns: ``True`` if the dependency check finds that ``target``
+           needs a rebuild, and ``False`` otherwise.
+        """
+
+        if self.check.log is None:
+            fingerprint = None
+        else:
+            fingerprint = job_fingerprint(job)
+
+        if self.check.check(target, dependency, fingerprint) is True:
+            logger.info('target {0} is older than dependency {1}: adding to build queue'.format(target, dependency))
+            return True
+        else:
+            logger.info('rebuild not needed for {0}.'.format(target))
+            return False
+
+    def _finalize_process_tree(self):
+        """
+        Groups the targets that
+        :meth:`~system.BuildSystemGenerator._check_targets()` marked for a
+        rebuild into levels with :meth:`~tree.DependencyTree.levels()`, and
+        adds a stage for every level to the
+        :attr:`~system.BuildSystemGenerator.system` object, which is itself a
+        :class:`~system.BuildSystem` object. Targets in a level do not depend
+        upon each other, so every stage runs its tasks in parallel, after the
+        stages of the targets that they depend upon. Each stage takes the name
+        of its first target.
 
         :meth:`~system.BuildSystemGenerator._finalize_process`, calls
         :meth:`~system.BuildSystemGenerator._add_tasks_to_stage()` which may
         raise :exc:`~err.InvalidSystem` in the case of malformed tasks.
         """
 
-        total = len(self._process)
-        rebuilds_needed = False
-        idx = -1
-        stack = []
+        targets = self._tree.targets
+        process = [ node for node in reversed(self._order)
+                    if self._process_jobs[targets[node]][1] is True ]
 
-        for i in self._process:
-            idx += 1
+        levels = self._tree.levels(process)
+        total = len(levels)
 
-            if rebuilds_needed is False:
-                if self._process_jobs[i][1] is False:
-                    logger.debug('{0}: does not need a rebuild, passing'.format(i))
-                    continue
-                elif self._process_jobs[i][1] is True:
-                    logger.debug('{0}: needs rebuild.'.format(i))
-                    rebuilds_needed = True
-
-            # rebuild needed here.
-            if idx+1 == total:
-                # last task in tree.
-                if stack:
-                    # if there are non dependent items in the stack, we
-                    # might as well add the current task there.
-                    stack.append(i)
-                else:
-                    # if there's no stack, we'll just add the task directly.
-                    pass
-            else:
+        for idx, level in enumerate(levels):
+            stack = [ targets[node] for node in level ]
+            logger.debug('adding {0} tasks to the stage for level {1}'.format(len(stack), idx))
 
-                if i not in self._process_tree[self._process[idx]]:
-                    stack.append(i)
-                    logger.debug('adding task {0} to queue not continuing.'.format(i))
-                    continue
-                else:
-                    # here the previous stack doesn't depend on the
-                    # current task. add current task to stack then build
-                    # the stack in parallel.
-                    stack.append(i)
-                    logger.debug('adding task to the stage queue, but not continuing'.format(i))
+            self._add_tasks_to_stage(True, idx, total, stack[0], stack)
+
+    def _finalize_pools(self):
+        """
+        :raises: :exc:`~err.InvalidSystem` if a job uses a resource pool that
+           no spec declares.
+
+        Gives every stage, and the :class:`~scheduler.BuildGraph`, of
+        :attr:`~system.BuildSystemGenerator.system` the depths of the resource
+        pools in :attr:`~system.BuildSystemGenerator.pools`.
+        """
+
+        stages = list(self.system.stages.values())
+        used = set()
+
+        for stage in stages:
+            stage.pools = self.pools
+            used.update(stage.job_pools.values())
+
+        if self.system.graph is not None:
+            self.system.graph.pools = self.pools
+            used.update(self.system.graph.job_pools.values())
+
+        for name in used:
+            if name not in self.pools:
+                logger.critical('jobs use the resource pool {0}, which has no depth.'.format(name))
+                raise InvalidSystem('undeclared resource pool {0}'.format(name))
+
+    def _finalize_process_graph(self):
+        """
+        Adds every target that needs a rebuild, and every target that depends
+        on a target that needs a rebuild, to a :class:`~scheduler.BuildGraph`
+        object with the dependencies from
+        :attr:`~system.BuildSystemGenerator._process_tree`. Attaches the graph
+        to the :attr:`~system.BuildSystemGenerator.system` object.
+
+        Targets with a true ``restat`` key in their spec are
+        :attr:`~scheduler.BuildGraph.restat` targets. The graph checks the
+        targets that depend on them with
+        :meth:`~system.BuildSystemGenerator._recheck_target()` when they
+        leave their output unchanged.
+        """
+
+        graph = BuildGraph()
+
+        for target in reversed(self._process):
+            job, rebuild = self._process_jobs[target]
+
+            if rebuild is False:
+                logger.debug('{0}: does not need a rebuild, leaving out of graph'.format(target))
+                continue
+
+            graph.add(target, job[0], job[1], self._process_tree[target], self.specs[target].get('pool'),
+                      self._job_memory(target), self.specs[target].get('restat') is True)
 
-            self._add_tasks_to_stage(rebuilds_needed, idx, total, i, stack)
-            stack = []
+        graph.stale.update(self._stale)
+        graph.check = self._recheck_target
+
+        self.system.graph = graph
+        logger.debug('added {0} targets to the build graph.'.format(graph.count()))
 
     def _add_tasks_to_stage(self, rebuilds_needed, idx, total, task, stack):
         """
@@ -616,14 +1152,20 @@ class BuildSystemGenerator(object):
 
         if rebuilds_needed is True:
             self.system.new_stage(task)
+            self.system.targets[task] = [ (target, self._process_jobs[target][0])
+                                          for target in (stack or [task]) ]
+
             if stack:
                 for job in stack:
                     self.system.stages[task].add(self._process_jobs[job][0][0],
-                                                 self._process_jobs[job][0][1])
+                                                 self._process_jobs[job][0][1],
+                                                 pool=self.specs[job].get('pool'),
+                                                 mem=self._job_memory(job))
             else:
                 logger.debug('{0}: adding to rebuild queue'.format(task))
                 self.system.stages[task].add(self._process_jobs[task][0][0],
-                    self._process_jobs[task][0][1])
+                    self._process_jobs[task][0][1], pool=self.specs[task].get('pool'),
+                    mem=self._job_memory(task))
         elif rebuilds_needed is False:
             logger.warning("dropping {0} task, no rebuild needed.".format(task))
             return None
@@ -947,21 +1489,13 @@ class BuildSystemGenerator(object):
 
         Wraps :meth:`~system.BuildSystemGenerator._process_stage()` and
         modifies the internal strucutres associated with the
-        dependency tree.
+        dependency tree. Does not check whether the target needs a rebuild:
+        :meth:`~system.BuildSystemGenerator.finalize()` does.
         """
         job = self._process_stage(spec)
-        dependencies = self.get_dependency_list(spec)
 
         self.specs[spec['target']] = spec
-
-        if self.check.check(spec['target'], dependencies) is True:
-            msg = 'target {0} is older than dependency {1}: adding to build queue'
-            logger.info(msg.format(spec['target'], dependencies))
-
-            self._process_jobs[spec['target']] = (job, True)
-        else:
-            logger.info('rebuild not needed for {0}.')
-            self._process_jobs[spec['target']] = (job, False)
+        self._process_jobs[spec['target']] = (job, None)
 
         logger.debug('added {0} to dependency graph'.format(spec['target']))
         self._process_tree[spec['target']] = self.get_dependency_list(spec)
@@ -971,9 +1505,26 @@ class BuildSystemGenerator(object):
         :param dict spec: A dictionary of strings that describe a build job.
 
         Processes the ``spec`` and attempts to create and add the resulting task
-        to the build system.
+        to the build system. Specs with a ``pools`` key declare resource pools,
+        as a mapping of pool names to depths, rather than jobs, and may not
+        have any other key.
         """
 
+        if 'pools' in spec:
+            if len(spec) > 1:
+                logger.critical('pools declarations cannot describe jobs: {0}'.format(spec))
+                raise InvalidJob('pools declaration with other keys.')
+
+            self._process_pools(spec['pools'])
+            return True
+
+        if 'mem' in spec:
+            try:
+                spec['mem'] = parse_size(spec['mem'])
+            except ValueError:
+                logger.critical('memory estimate {0} is not a size.'.format(spec['mem']))
+                raise InvalidJob('invalid memory estimate {0}'.format(spec['mem']))
+
         if strings is not None:
             for key in spec:
                 spec[key] = spec[key].format(strings)
@@ -1007,10 +1558,54 @@ class BuildSystemGenerator(object):
                 logger.debug('creating new stage named {0}'.format(spec['stage']))
                 self._stages.new_stage(spec['stage'])
 
-            self._stages.stages[spec['stage']].add(job[0], job[1])
+            self._stages.stages[spec['stage']].add(job[0], job[1], pool=spec.get('pool'),
+                                                   mem=spec.get('mem'))
             logger.debug('added job to stage: {0}'.format(spec['stage']))
             return True
 
+    def _job_memory(self, target):
+        """
+        :param string target: The name of a target.
+
+        :returns: The memory, in bytes, that the job for ``target`` needs: the
+           peak memory use that the build log recorded for the target, if
+           known, and otherwise the ``mem`` estimate of the spec, or ``None``.
+           Only targets with a ``mem`` estimate use recorded peaks.
+        """
+
+        mem = self.specs[target].get('mem')
+
+        if mem is not None and self.check.log is not None:
+            entry = self.check.log.get(target)
+
+            if entry is not None and entry.peak is not None:
+                logger.debug('using the recorded peak memory of {0}: {1}'.format(target, entry.peak))
+                return entry.peak
+
+        return mem
+
+    def _process_pools(self, pools):
+        """
+        :param dict pools: A mapping of the names of resource pools to their
+           depths.
+
+        :raises: :exc:`~err.InvalidJob` if a depth is not a positive integer.
+
+        Adds the resource pools to :attr:`~system.BuildSystemGenerator.pools`.
+        """
+
+        if not isinstance(pools, dict):
+            logger.critical('pools must be a mapping of names to depths: {0}'.format(pools))
+            raise InvalidJob('malformed pools declaration.')
+
+        for name, depth in pools.items():
+            if not isinstance(depth, int) or depth < 1:
+                logger.critical('depth of pool {0} must be a positive integer.'.format(name))
+                raise InvalidJob('invalid depth for pool {0}'.format(name))
+
+            self.pools[name] = depth
+            logger.debug('declared resource pool {0} with depth {1}'.format(name, depth))
+
 def narrow_buildsystem(targets, bs):
     if not isinstance(bs, BuildSystemGenerator):
         raise TargetError
@@ -1025,6 +1620,7 @@ def narrow_buildsystem(targets, bs):
             logger.debug('{0} is a target that exists. Resolving dependencies'.format(target))
 
     bsg = BuildSystemGenerator(bs.funcs)
+    bsg.pools.update(bs.pools)
 
     safety = 0
 
@@ -0,0 +1,225 @@
+# Copyright 2013 Sam Kleinman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`tree` holds the dependency tree of a
+:class:`~system.BuildSystemGenerator()` in a compact, integer-indexed form.
+
+:class:`~tree.DependencyTree()` interns the name of every target once, and
+refers to targets by their position in
+:attr:`~tree.DependencyTree.targets`. The edges between targets live in
+:mod:`array` objects in compressed sparse row form: the ids of the
+dependencies of target ``n`` are
+``edges[offsets[n]:offsets[n + 1]]``. A tree of hundreds of thousands of
+targets then takes a few bytes per edge, rather than a list and a
+dictionary entry of strings for every target, and sorting, leveling and
+narrowing the tree only compares integers.
+"""
+
+from array import array
+
+from buildcloth.tsort import sort_ids
+
+class DependencyTree(object):
+    """
+    The edges between the targets of a dependency tree, as integer arrays.
+    Dependencies that are not targets, e.g. source files, have no id and do
+    not appear in the tree.
+    """
+
+    def __init__(self, tree=None):
+        """
+        :param dict tree: Optional. A mapping of target names to lists of the
+           names of their dependencies.
+        """
+
+        self.targets = []
+        "The names of the targets, by id."
+
+        self.ids = {}
+        "Mapping of target names to ids."
+
+        self.offsets = array('i', [ 0 ])
+        """The dependencies of target ``n`` are
+        ``edges[offsets[n]:offsets[n + 1]]``."""
+
+        self.edges = array('i')
+        "The ids of the dependencies of every target, in target order."
+
+        self.reverse_offsets = None
+        """The offsets of the dependents of every target in
+        :attr:`~tree.DependencyTree.reverse_edges`. ``None`` until
+        :meth:`~tree.DependencyTree.reverse()` builds them."""
+
+        self.reverse_edges = None
+        "The ids of the targets that depend upon every target, in target order."
+
+        if tree is not None:
+            self.targets = list(tree)
+            self.ids = dict((target, idx) for idx, target in enumerate(self.targets))
+
+            ids = self.ids
+            append = self.offsets.append
+            extend = self.edges.extend
+            for target in self.targets:
+                extend([ ids[dep] for dep in tree[target] if dep in ids ])
+                append(len(self.edges))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __contains__(self, target):
+        return target in self.ids
+
+    def dependencies(self, node):
+        "Returns an array of the ids of the targets that ``node`` depends upon."
+
+        return self.edges[self.offsets[node]:self.offsets[node + 1]]
+
+    def dependents(self, node):
+        """
+        Returns an array of the ids of the targets that depend upon ``node``.
+        Call :meth:`~tree.DependencyTree.reverse()` first.
+        """
+
+        return self.reverse_edges[self.reverse_offsets[node]:self.reverse_offsets[node + 1]]
+
+    def reverse(self):
+        """
+        Builds :attr:`~tree.DependencyTree.reverse_offsets` and
+        :attr:`~tree.DependencyTree.reverse_edges`. Every target appears once
+        among the dependents of each of its dependencies, and never among its
+        own dependents.
+        """
+
+        size = len(self.targets)
+        offsets = self.offsets
+        edges = self.edges
+
+        # seen[dep] is the last target that counted dep, so that targets that
+        # name a dependency twice count it once.
+        seen = array('i', [ -1 ]) * size
+        count = array('i', [ 0 ]) * (size + 1)
+
+        for node in range(size):
+            seen[node] = node
+            for pos in range(offsets[node], offsets[node + 1]):
+                dep = edges[pos]
+                if seen[dep] != node:
+                    seen[dep] = node
+                    count[dep + 1] += 1
+
+        for node in range(size):
+            count[node + 1] += count[node]
+
+        reverse = array('i', [ 0 ]) * count[size]
+        fill = count[:size]
+        seen = array('i', [ -1 ]) * size
+
+        for node in range(size):
+            seen[node] = node
+            for pos in range(offsets[node], offsets[node + 1]):
+                dep = edges[pos]
+                if seen[dep] != node:
+                    seen[dep] = node
+                    reverse[fill[dep]] = node
+                    fill[dep] += 1
+
+        self.reverse_offsets = count
+        self.reverse_edges = reverse
+
+    def sort(self):
+        """
+        :returns: An array of the ids of every target, where every target
+           precedes the targets that it depends upon.
+
+        :raises: :exc:`~err.DependencyCycleError` if some targets depend upon
+           each other in a cycle.
+        """
+
+        return sort_ids(self.targets, self.offsets, self.edges)
+
+    def narrow(self, goals):
+        """
+        :param list goals: The ids of some targets.
+
+        :returns: A new :class:`~tree.DependencyTree()` with only the
+           ``goals`` and the targets that they depend upon, directly or
+           indirectly, in the order of this tree.
+        """
+
+        offsets = self.offsets
+        edges = self.edges
+
+        reachable = bytearray(len(self.targets))
+        pending = list(goals)
+
+        while pending:
+            node = pending.pop()
+
+            if reachable[node]:
+                continue
+
+            reachable[node] = 1
+            pending.extend(dep for dep in edges[offsets[node]:offsets[node + 1]]
+                           if not reachable[dep])
+
+        kept = [ node for node in range(len(self.targets)) if reachable[node] ]
+
+        remap = array('i', [ -1 ]) * len(self.targets)
+        for idx, node in enumerate(kept):
+            remap[node] = idx
+
+        tree = DependencyTree()
+        tree.targets = [ self.targets[node] for node in kept ]
+        tree.ids = dict((target, idx) for idx, target in enumerate(tree.targets))
+
+        for node in kept:
+            tree.edges.extend([ remap[dep] for dep in edges[offsets[node]:offsets[node + 1]] ])
+            tree.offsets.append(len(tree.edges))
+
+        return tree
+
+    def levels(self, nodes):
+        """
+        :param list nodes: The ids of some targets, where every target follows
+           the targets that it depends upon.
+
+        :returns: A list of levels, each a list of ids from ``nodes``, in
+           ``nodes`` order. The first level holds the targets that depend on
+           no target in ``nodes``, and every other level holds the targets
+           that depend on a target in the level before it. Targets in a level
+           do not depend upon each other.
+        """
+
+        offsets = self.offsets
+        edges = self.edges
+
+        # level[node] is -1 for targets that are not in nodes.
+        level = array('i', [ -1 ]) * len(self.targets)
+        result = []
+
+        for node in nodes:
+            depth = 0
+            for pos in range(offsets[node], offsets[node + 1]):
+                dep = edges[pos]
+                if level[dep] >= depth and dep != node:
+                    depth = level[dep] + 1
+
+            level[node] = depth
+            if depth == len(result):
+                result.append([])
+            result[depth].append(node)
+
+        return result
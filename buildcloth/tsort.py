@@ -3,92 +3,169 @@
 # usage: Public domain, do with it as you will
 # from: http://www.logarithmic.net/pfh-files/blog/01208083168/sort.py
 # date: 2013-08-03
+#
+# The graph is now held in compressed sparse row arrays of integer node ids,
+# and Tarjan's algorithm walks it with an explicit stack, so that chains of
+# hundreds of thousands of targets do not reach the recursion limit.
 
-def _strongly_connected_components(graph):
+from array import array
+
+from buildcloth.err import DependencyCycleError
+
+def csr(graph):
+    """
+    :param dict graph: A mapping of node names to lists of successor nodes.
+
+    :returns: A list of the nodes of ``graph``, and the ``offsets`` and
+       ``edges`` arrays of its edges in compressed sparse row form: the ids of
+       the successors of the node with id ``n`` are
+       ``edges[offsets[n]:offsets[n + 1]]``. Successors that are not nodes of
+       ``graph`` have no id and are dropped.
+    """
+
+    nodes = list(graph)
+    ids = dict((node, idx) for idx, node in enumerate(nodes))
+
+    offsets = array('i', [ 0 ])
+    edges = array('i')
+
+    for node in nodes:
+        edges.extend([ ids[successor] for successor in graph[node] if successor in ids ])
+        offsets.append(len(edges))
+
+    return nodes, offsets, edges
+
+def _strongly_connected_components(offsets, edges):
     """
     Find the strongly connected components in a graph using
     Tarjan's algorithm.
 
-    graph should be a dictionary mapping node names to
-    lists of successor nodes.
+    ``offsets`` and ``edges`` hold the successors of every node id, as
+    returned by :func:`~tsort.csr()`. Returns a list of components, each a
+    list of node ids, in the order that Tarjan's algorithm completes them:
+    every component follows the components that it reaches.
     """
 
+    size = len(offsets) - 1
+    done = size
+
+    # index[node] is -1 until the walk reaches the node.
+    index = array('i', [ -1 ]) * size
+    low = array('i', [ 0 ]) * size
+    stack_pos = array('i', [ 0 ]) * size
+
     result = [ ]
     stack = [ ]
-    low = { }
-
-    def visit(node):
-        if node in low: return
+    count = 0
+
+    for root in range(size):
+        if index[root] != -1:
+            continue
+
+        index[root] = low[root] = count
+        count += 1
+        stack_pos[root] = len(stack)
+        stack.append(root)
+
+        # frames of (node, position in edges of the next successor).
+        work = [ (root, offsets[root]) ]
+        while work:
+            node, pos = work[-1]
+
+            if pos < offsets[node + 1]:
+                work[-1] = (node, pos + 1)
+                successor = edges[pos]
+
+                if index[successor] == -1:
+                    index[successor] = low[successor] = count
+                    count += 1
+                    stack_pos[successor] = len(stack)
+                    stack.append(successor)
+                    work.append((successor, offsets[successor]))
+                elif low[successor] < low[node]:
+                    low[node] = low[successor]
+                continue
+
+            work.pop()
+
+            if low[node] == index[node]:
+                start = stack_pos[node]
+                component = stack[start:]
+                del stack[start:]
+                for item in component:
+                    low[item] = done
+                result.append(component)
+
+            if work:
+                parent = work[-1][0]
+                if low[node] < low[parent]:
+                    low[parent] = low[node]
 
-        num = len(low)
-        low[node] = num
-        stack_pos = len(stack)
-        stack.append(node)
+    return result
 
-        for successor in graph[node]:
-            visit(successor)
-            low[node] = min(low[node], low[successor])
+def sort_components(offsets, edges):
+    """
+    :returns: The strongly connected components of the graph in ``offsets``
+       and ``edges``, as returned by :func:`~tsort.csr()`, in topological
+       order. Each component is a list of node ids. Nodes in a cycle share a
+       component.
+    """
 
-        if num == low[node]:
-            component = tuple(stack[stack_pos:])
-            del stack[stack_pos:]
-            result.append(component)
-        for item in component:
-            low[item] = len(graph)
+    # Tarjan's algorithm completes every component after the components that
+    # it reaches, so its reverse is a topological order of the components.
+    components = _strongly_connected_components(offsets, edges)
+    components.reverse()
 
-    for node in graph:
-        visit(node)
+    return components
 
-    return result
+def sort_ids(nodes, offsets, edges):
+    """
+    :param list nodes: The names of the nodes, by id.
 
+    :returns: A list of the node ids of the graph in ``offsets`` and
+       ``edges``, as returned by :func:`~tsort.csr()`, where every node
+       precedes its successors.
 
-def _topological_sort(graph):
-    count = { }
-    for node in graph:
-        count[node] = 0
-    for node in graph:
-        for successor in graph[node]:
-            count[successor] += 1
+    :raises: :exc:`~err.DependencyCycleError` if some nodes form a cycle. The
+       ``cycles`` attribute of the exception lists the names of the members
+       of every cycle.
+    """
 
-    ready = [ node for node in graph if count[node] == 0 ]
+    components = sort_components(offsets, edges)
 
-    result = [ ]
-    while ready:
-        node = ready.pop(-1)
-        result.append(node)
+    cycles = [ [ nodes[node] for node in component ]
+               for component in components if len(component) > 1 ]
 
-        for successor in graph[node]:
-            count[successor] -= 1
-            if count[successor] == 0:
-                ready.append(successor)
+    if cycles:
+        raise DependencyCycleError(cycles)
 
-    return result
+    return array('i', (component[0] for component in components))
 
 def topological_sort(graph):
     """
     First identify strongly connected components,
     then perform a topological sort on these components.
+
+    Returns a list of tuples of node names, one for each component. Nodes in
+    a cycle share a tuple.
     """
 
-    components = _strongly_connected_components(graph)
+    nodes, offsets, edges = csr(graph)
+
+    return [ tuple(nodes[node] for node in component)
+             for component in sort_components(offsets, edges) ]
 
-    node_component = { }
-    for component in components:
-        for node in component:
-            node_component[node] = component
+def tsort(graph):
+    """
+    :param dict graph: A mapping of node names to lists of successor nodes.
 
-    component_graph = { }
-    for component in components:
-        component_graph[component] = [ ]
+    :returns: A list of the nodes of ``graph`` where every node precedes its
+       successors.
 
-    for node in graph:
-        node_c = node_component[node]
-        for successor in graph[node]:
-            successor_c = node_component[successor]
-            if node_c != successor_c:
-                component_graph[node_c].append(successor_c)
+    :raises: :exc:`~err.DependencyCycleError` if some nodes form a cycle. The
+       ``cycles`` attribute of the exception lists the members of every cycle.
+    """
 
-    return _topological_sort(component_graph)
+    nodes, offsets, edges = csr(graph)
 
-def tsort(graph):
-    return [i[0] for i in topological_sort(graph) ]
+    return [ nodes[node] for node in sort_ids(nodes, offsets, edges) ]
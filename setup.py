@@ -1,13 +1,8 @@
 from setuptools import setup
 import buildcloth
-from sys import version_info
 
 REQUIRES = ['pyyaml']
 
-if version_info < (2, 7):
-    # no argparse in 2.6 standard
-    REQUIRES.append('argparse')
-
 setup(
     name='buildcloth',
     description='A framework for genarting build system description files, with support for Ninja and Make.',
@@ -17,6 +12,7 @@ setup(
     license='Apache',
     url='http://cyborginstitute.org/projects/buildcloth',
     install_requires=REQUIRES,
+    python_requires='>=3.6',
     packages=['buildcloth'],
     setup_requires=['nose'],
     test_suite='test',
@@ -27,8 +23,8 @@ setup(
         },
     classifiers=[
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Topic :: Software Development :: Build Tools'
@@ -0,0 +1,267 @@
+from unittest import TestCase
+from buildcloth.aio import AsyncRunner
+from buildcloth.system import BuildSystem
+from buildcloth.stages import BuildStage, BuildSequence
+from buildcloth.scheduler import BuildGraph
+from buildcloth.buildc import stages
+from buildcloth.err import StageRunError
+from multiprocessing import cpu_count
+from test.utils import dummy_function, fail_function, dump_args_to_json_file_with_newlines, process_running, exclusive_command
+import multiprocessing
+import subprocess
+import asyncio
+import json
+import time
+import os
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+class TestAsyncRunner(TestCase):
+    @classmethod
+    def setUp(self):
+        self.r = AsyncRunner(2)
+        self.fn = 'aio.json'
+
+    @classmethod
+    def tearDown(self):
+        self.r.terminate()
+
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def read_output(self):
+        with open(self.fn, 'r') as f:
+            return [ json.loads(ln)[0] for ln in f.readlines() ]
+
+    def test_default_workers(self):
+        self.assertEqual(AsyncRunner().workers, cpu_count())
+
+    def test_run_command(self):
+        self.assertEqual(run(self.r.run_command(dict(args=['true'], cwd='/tmp'))), 0)
+
+    def test_run_command_exit_status(self):
+        self.assertEqual(run(self.r.run_command(dict(args=['sh', '-c', 'exit 3']))), 3)
+
+    def test_run_shell_job_failure(self):
+        with self.assertRaises(StageRunError):
+            run(self.r.run_job((subprocess.call, dict(args=['false']))))
+
+    def test_run_function(self):
+        self.assertEqual(run(self.r.run_job((dummy_function, (1, 2)))), (1, 2))
+
+    def test_run_function_failure(self):
+        with self.assertRaises(ValueError):
+            run(self.r.run_job((fail_function, (1, 2))))
+
+    def test_run_stage_results(self):
+        stage = BuildStage()
+        stage.add(dummy_function, (1, 2))
+        stage.add(subprocess.call, dict(args=['true']))
+
+        self.assertTrue(run(self.r.run_steps(stage)))
+        self.assertEqual(len(stage.results), 2)
+
+    def test_run_stage_limits_concurrency(self):
+        stage = BuildStage()
+        for i in range(4):
+            stage.add(subprocess.call, dict(args=['sleep', '0.3']))
+
+        start = time.time()
+        run(self.r.run_steps(stage))
+
+        self.assertTrue(time.time() - start >= 0.6)
+
+    def test_run_wide_stage(self):
+        self.r.workers = 16
+        stage = BuildStage()
+        for i in range(500):
+            stage.add(subprocess.call, dict(args=['true']))
+
+        self.assertTrue(run(self.r.run_steps(stage)))
+        self.assertEqual(len(stage.results), 500)
+
+    def test_run_stage_pool_depth(self):
+        stage = BuildStage()
+        stage.pools = {'db': 1}
+        for i in range(4):
+            stage.add(subprocess.call, dict(args=exclusive_command('aio-db-lock')), pool='db')
+
+        self.assertTrue(run(self.r.run_steps(stage)))
+
+    def test_run_graph_pool_depth(self):
+        g = BuildGraph()
+        g.pools = {'link': 1}
+        for target in ['a', 'b', 'c']:
+            g.add(target, subprocess.call, dict(args=exclusive_command('aio-link-lock')), pool='link')
+
+        self.assertTrue(run(self.r.run_graph(g)))
+
+    def test_run_stage_max_load(self):
+        self.r = AsyncRunner(4, max_load=1.0)
+        self.r.load.load = lambda: 2.0
+
+        stage = BuildStage()
+        for i in range(4):
+            stage.add(subprocess.call, dict(args=exclusive_command('aio-load-lock')))
+
+        self.assertTrue(run(self.r.run_steps(stage)))
+        self.assertEqual(self.r.running, 0)
+
+    def test_run_sequence_order(self):
+        seq = BuildSequence()
+        for i in range(3):
+            seq.add(dump_args_to_json_file_with_newlines, (i, None, self.fn))
+
+        self.assertTrue(run(self.r.run_steps(seq)))
+        self.assertEqual(self.read_output(), [0, 1, 2])
+
+    def test_run_nested_sequence(self):
+        seq = BuildSequence()
+        seq.add(dump_args_to_json_file_with_newlines, (0, None, self.fn))
+        seq.add(dump_args_to_json_file_with_newlines, (1, None, self.fn))
+
+        stage = BuildStage()
+        stage.add(seq.run, None)
+
+        self.assertTrue(run(self.r.run_steps(stage)))
+        self.assertEqual(self.read_output(), [0, 1])
+
+    def test_failure_stops_running_commands(self):
+        pid_fn = os.path.abspath('pid')
+        stage = BuildStage()
+        stage.add(subprocess.call, dict(args=['sh', '-c', 'echo $$ > {0}; exec sleep 30'.format(pid_fn)]))
+        stage.add(subprocess.call, dict(args=['sh', '-c', 'sleep 0.5; exit 2']))
+
+        start = time.time()
+        with self.assertRaises(StageRunError):
+            run(self.r.run_steps(stage))
+        self.assertTrue(time.time() - start < 10)
+
+        with open(pid_fn, 'r') as f:
+            pid = int(f.read())
+        os.remove(pid_fn)
+
+        self.assertFalse(process_running(pid))
+
+    def test_run_graph_order(self):
+        g = BuildGraph()
+        g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), ['b'])
+        g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn), ['c'])
+        g.add('c', dump_args_to_json_file_with_newlines, ('c', None, self.fn))
+
+        self.assertTrue(run(self.r.run_graph(g)))
+        self.assertEqual(self.read_output(), ['c', 'b', 'a'])
+
+    def test_run_graph_cycle(self):
+        g = BuildGraph()
+        g.add('a', dummy_function, (1, 2), ['b'])
+        g.add('b', dummy_function, (1, 2), ['a'])
+
+        with self.assertRaises(StageRunError):
+            run(self.r.run_graph(g))
+
+    def test_run_graph_restat(self):
+        out = 'aio_restat.txt'
+        with open(out, 'w') as f:
+            f.write('same')
+
+        g = BuildGraph()
+        g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), [out])
+        g.add(out, dummy_function, (1, 2), restat=True)
+        g.stale.add(out)
+        g.check = lambda target: False
+
+        try:
+            self.assertTrue(run(self.r.run_graph(g)))
+        finally:
+            os.remove(out)
+
+        self.assertFalse(os.path.exists(self.fn))
+
+    def test_run_graph_failure_stops_dependents(self):
+        g = BuildGraph()
+        g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), ['b'])
+        g.add('b', fail_function, (1, 2))
+
+        with self.assertRaises(ValueError):
+            run(self.r.run_graph(g))
+
+        self.assertFalse(os.path.exists(self.fn))
+
+class TestBuildSystemRunAsync(TestCase):
+    @classmethod
+    def setUp(self):
+        self.bs = BuildSystem()
+        self.bs.workers = 2
+        self.fn = 'aio.json'
+
+        for name in ['one', 'two']:
+            stage = BuildStage()
+            stage.add(dump_args_to_json_file_with_newlines, (name, None, self.fn))
+            self.bs.add_stage(name, stage)
+
+    @classmethod
+    def tearDown(self):
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def read_output(self):
+        with open(self.fn, 'r') as f:
+            return [ json.loads(ln)[0] for ln in f.readlines() ]
+
+    def test_run_async(self):
+        self.bs.close()
+
+        self.assertTrue(run(self.bs.run_async()))
+        self.assertEqual(self.read_output(), ['one', 'two'])
+
+    def test_run_async_open_strict(self):
+        with self.assertRaises(StageRunError):
+            run(self.bs.run_async(strict=True))
+
+    def test_run_async_invalid_mode(self):
+        self.bs.close()
+
+        with self.assertRaises(StageRunError):
+            run(self.bs.run_async(mode='magic'))
+
+    def test_asyncio_engine_rejects_mem_ceiling(self):
+        with self.assertRaises(StageRunError):
+            stages(2, [], [], 'force', engine='asyncio', mem_ceiling=1024)
+
+    def test_run_async_failure_strict(self):
+        self.bs.stages['one'].add(subprocess.call, dict(args=['false']))
+        self.bs.close()
+
+        with self.assertRaises(StageRunError):
+            run(self.bs.run_async(strict=True))
+
+        self.assertEqual(self.read_output(), ['one'])
+
+    def test_run_async_failure_permissive(self):
+        self.bs.stages['one'].add(fail_function, (1, 2))
+        self.bs.close()
+
+        self.assertFalse(run(self.bs.run_async(strict=False)))
+
+    def test_run_async_cancelled_stops_workers(self):
+        self.bs.stages['one'].add(time.sleep, (30,))
+        self.bs.close()
+
+        async def cancel():
+            task = asyncio.ensure_future(self.bs.run_async())
+            await asyncio.sleep(1)
+            task.cancel()
+            await task
+
+        start = time.time()
+        with self.assertRaises(asyncio.CancelledError):
+            run(cancel())
+        self.assertTrue(time.time() - start < 10)
+
+        self.assertEqual(multiprocessing.active_children(), [])
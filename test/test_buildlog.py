@@ -0,0 +1,433 @@
+from unittest import TestCase
+from buildcloth.buildlog import (BuildLog, BuildLogEntry, LOG_HEADER, LOG_HEADER_V1, LOG_HEADER_V2,
+                                 COMPACT_MIN_RECORDS, job_fingerprint, output_signature, record_job)
+from buildcloth.dependency import DependencyChecks, inputs_digest
+from buildcloth.scheduler import BuildGraph
+from buildcloth.system import BuildSystemGenerator
+from buildcloth.err import StageRunError
+from test.utils import dummy_function
+import subprocess
+import time
+import os
+
+class TestBuildLogEntry(TestCase):
+    def test_round_trip(self):
+        entry = BuildLogEntry('out/a b.txt', 10.5, 12.25, 0, 'abc', '1-2')
+        self.assertEqual(BuildLogEntry.parse(entry.format()), entry)
+
+    def test_round_trip_peak(self):
+        entry = BuildLogEntry('a', 10.5, 12.25, 0, 'abc', '1-2', 4096)
+        self.assertEqual(BuildLogEntry.parse(entry.format()), entry)
+
+    def test_round_trip_inputs(self):
+        entry = BuildLogEntry('a', 10.5, 12.25, 0, 'abc', '1-2', None, 'def')
+        self.assertEqual(BuildLogEntry.parse(entry.format()), entry)
+
+    def test_parse_v2(self):
+        entry = BuildLogEntry.parse('1000\t2000\t0\t4096\tabc\t1-2\ta\n', LOG_HEADER_V2)
+        self.assertEqual(entry, BuildLogEntry('a', 1.0, 2.0, 0, 'abc', '1-2', 4096, None))
+
+    def test_parse_v1(self):
+        entry = BuildLogEntry.parse('1000\t2000\t0\tabc\t1-2\ta\n', LOG_HEADER_V1)
+        self.assertEqual(entry, BuildLogEntry('a', 1.0, 2.0, 0, 'abc', '1-2', None))
+
+    def test_duration(self):
+        self.assertEqual(BuildLogEntry('a', 10.0, 12.5, 0, '-', '-').duration, 2.5)
+
+    def test_parse_malformed(self):
+        with self.assertRaises(ValueError):
+            BuildLogEntry.parse('1\t2\tthree\n')
+
+class TestFingerprints(TestCase):
+    def test_job_fingerprint_stable(self):
+        self.assertEqual(job_fingerprint((dummy_function, (1, 2))),
+                         job_fingerprint((dummy_function, (1, 2))))
+
+    def test_job_fingerprint_args(self):
+        self.assertNotEqual(job_fingerprint((dummy_function, (1, 2))),
+                            job_fingerprint((dummy_function, (1, 3))))
+
+    def test_job_fingerprint_dict_order(self):
+        self.assertEqual(job_fingerprint((subprocess.call, dict(cwd='/tmp', args=['ls']))),
+                         job_fingerprint((subprocess.call, dict(args=['ls'], cwd='/tmp'))))
+
+    def test_job_fingerprint_unchanged_for_plain_args(self):
+        import hashlib
+        desc = [ 'subprocess', 'call', sorted(dict(args=['ls', '-l'], cwd='/tmp').items()) ]
+
+        self.assertEqual(job_fingerprint((subprocess.call, dict(args=['ls', '-l'], cwd='/tmp'))),
+                         hashlib.md5(repr(desc).encode('utf-8')).hexdigest())
+
+    def test_job_fingerprint_set_order(self):
+        self.assertEqual(job_fingerprint((dummy_function, (set(['a', 'b', 'c']), None))),
+                         job_fingerprint((dummy_function, (set(['c', 'b', 'a']), None))))
+
+    def test_job_fingerprint_function_args(self):
+        self.assertEqual(job_fingerprint((dummy_function, (dummy_function, None))),
+                         job_fingerprint((dummy_function, (dummy_function, None))))
+        self.assertNotEqual(job_fingerprint((dummy_function, (dummy_function, None))),
+                            job_fingerprint((dummy_function, (subprocess.call, None))))
+
+    def test_job_fingerprint_unstable_args(self):
+        self.assertEqual(job_fingerprint((dummy_function, (object(), None))),
+                         job_fingerprint((dummy_function, (object(), None))))
+        self.assertEqual(job_fingerprint((dummy_function, ([1, object()], None))),
+                         job_fingerprint((dummy_function, ([2, object()], None))))
+
+    def test_output_signature_missing(self):
+        self.assertEqual(output_signature('does-not-exist'), '-')
+
+    def test_output_signature(self):
+        self.assertNotEqual(output_signature(__file__), '-')
+
+class TestBuildLog(TestCase):
+    @classmethod
+    def setUp(self):
+        self.fn = 'test.buildc_log'
+        self.log = BuildLog(self.fn)
+
+    @classmethod
+    def tearDown(self):
+        self.log.close()
+
+        for fn in [ self.fn, self.fn + '.tmp' ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def count_records(self):
+        with open(self.fn, 'r') as f:
+            return len(f.readlines()) - 1
+
+    def test_load_missing(self):
+        self.assertEqual(self.log.load(), {})
+
+    def test_record_and_load(self):
+        self.log.record('a', 1.0, 2.0, 0, 'abc')
+        self.log.record('b', 1.0, 4.0, 2, 'def')
+        self.log.close()
+
+        log = BuildLog(self.fn)
+        log.load()
+
+        self.assertEqual(len(log), 2)
+        self.assertEqual(log.get('a').fingerprint, 'abc')
+        self.assertEqual(log.get('b').status, 2)
+        self.assertEqual(log.get('b').duration, 3.0)
+
+    def test_later_records_win(self):
+        self.log.record('a', 1.0, 2.0, 1)
+        self.log.record('a', 3.0, 4.0, 0)
+        self.log.close()
+
+        log = BuildLog(self.fn)
+        log.load()
+
+        self.assertEqual(log.get('a').status, 0)
+        self.assertEqual(self.count_records(), 2)
+
+    def test_record_appends(self):
+        self.log.record('a', 1.0, 2.0)
+        self.log.close()
+
+        log = BuildLog(self.fn)
+        log.load()
+        log.record('b', 1.0, 2.0)
+        log.close()
+
+        self.assertEqual(self.count_records(), 2)
+
+    def test_compaction(self):
+        for i in range(COMPACT_MIN_RECORDS + 1):
+            self.log.record('a', i, i + 1)
+        self.log.record('b', 1.0, 2.0)
+        self.log.close()
+
+        log = BuildLog(self.fn)
+        log.load()
+
+        self.assertEqual(self.count_records(), 2)
+        self.assertEqual(log.get('a').start, COMPACT_MIN_RECORDS)
+
+    def test_no_compaction_below_threshold(self):
+        for i in range(10):
+            self.log.record('a', i, i + 1)
+        self.log.close()
+
+        BuildLog(self.fn).load()
+        self.assertEqual(self.count_records(), 10)
+
+    def test_skips_malformed_records(self):
+        with open(self.fn, 'w') as f:
+            f.write(LOG_HEADER)
+            f.write('garbage\n')
+            f.write(BuildLogEntry('a', 1.0, 2.0, 0, '-', '-').format())
+
+        self.assertEqual(list(self.log.load()), ['a'])
+
+    def test_replaces_unknown_format(self):
+        with open(self.fn, 'w') as f:
+            f.write('# some other log\n1\t2\t0\t-\t-\ta\n')
+
+        self.assertEqual(self.log.load(), {})
+
+        with open(self.fn, 'r') as f:
+            self.assertEqual(f.read(), LOG_HEADER)
+
+    def test_upgrades_v1(self):
+        with open(self.fn, 'w') as f:
+            f.write(LOG_HEADER_V1)
+            f.write('1000\t2000\t0\tabc\t1-2\ta\n')
+
+        self.assertEqual(self.log.load()['a'].fingerprint, 'abc')
+
+        with open(self.fn, 'r') as f:
+            self.assertEqual(f.readline(), LOG_HEADER)
+
+    def test_upgrades_v2(self):
+        with open(self.fn, 'w') as f:
+            f.write(LOG_HEADER_V2)
+            f.write('1000\t2000\t0\t4096\tabc\t1-2\ta\n')
+
+        self.assertEqual(self.log.load()['a'].peak, 4096)
+
+        with open(self.fn, 'r') as f:
+            self.assertEqual(f.readline(), LOG_HEADER)
+
+    def test_peaks(self):
+        self.log.record('a', 1.0, 2.0, peak=4096)
+        self.log.record('b', 1.0, 2.0)
+
+        self.assertEqual(self.log.peaks(), {'a': 4096})
+
+    def test_keeps_previous_peak(self):
+        self.log.record('a', 1.0, 2.0, peak=4096)
+        self.log.record('a', 3.0, 4.0)
+
+        self.assertEqual(self.log.get('a').peak, 4096)
+
+    def test_durations_skip_failures(self):
+        self.log.record('a', 1.0, 3.0, 0)
+        self.log.record('b', 1.0, 3.0, 1)
+
+        self.assertEqual(self.log.durations(), {'a': 2.0})
+
+    def test_untimed_record_keeps_duration(self):
+        self.log.record('a', 1.0, 3.0)
+        self.log.record('a', None, None, 1)
+        self.log.record('b', None, None)
+        self.log.close()
+
+        log = BuildLog(self.fn)
+        log.load()
+
+        self.assertEqual(log.get('a').status, 1)
+        self.assertIsNone(log.get('b').duration)
+        self.assertEqual(log.durations(), {})
+
+        log.record('a', None, None)
+        self.assertEqual(log.durations(), {'a': 2.0})
+        log.close()
+
+    def test_record_job_exception_status(self):
+        err = StageRunError('failed')
+        err.status = 7
+
+        record_job(self.log, 'a', (dummy_function, (1, 2)), 1.0, err)
+        record_job(self.log, 'b', (dummy_function, (1, 2)), 1.0, ValueError())
+
+        self.assertEqual(self.log.get('a').status, 7)
+        self.assertEqual(self.log.get('b').status, 1)
+        self.assertEqual(self.log.get('a').fingerprint, job_fingerprint((dummy_function, (1, 2))))
+
+    def test_graph_records_targets(self):
+        g = BuildGraph()
+        g.log = self.log
+        g.add('a', dummy_function, (1, 2), ['b'])
+        g.add('b', dummy_function, (1, 2))
+
+        self.assertTrue(g.run())
+        self.assertEqual(sorted(self.log.entries), ['a', 'b'])
+        self.assertEqual(self.log.get('a').status, 0)
+
+    def test_graph_records_inputs(self):
+        g = BuildGraph()
+        g.log = self.log
+        g.inputs = inputs_digest
+        g.add('a', dummy_function, (1, 2), [__file__])
+        g.add('b', subprocess.call, dict(args=['sh', '-c', 'exit 3']), [__file__])
+
+        self.assertFalse(g.run())
+        self.assertEqual(self.log.get('a').inputs, inputs_digest([__file__]))
+        self.assertIsNone(self.log.get('b').inputs)
+
+    def test_graph_records_peaks(self):
+        g = BuildGraph()
+        g.log = self.log
+        g.add('a', dummy_function, (1, 2))
+        g.add('b', subprocess.call, dict(args=['true']))
+
+        self.assertTrue(g.run())
+        self.assertTrue(self.log.get('a').peak > 0)
+        self.assertTrue(self.log.get('b').peak > 0)
+
+    def test_graph_records_failed_command(self):
+        g = BuildGraph()
+        g.log = self.log
+        g.add('a', subprocess.call, dict(args=['sh', '-c', 'exit 3']))
+
+        self.assertFalse(g.run())
+        self.assertEqual(self.log.get('a').status, 3)
+
+    def test_system_records_targets(self):
+        bsg = BuildSystemGenerator({'dumb': dummy_function})
+        bsg.check_method = 'force'
+        bsg.ingest([ { 'target': 'a', 'dep': ['b'], 'job': 'dumb', 'args': [1, 2] },
+                     { 'target': 'b', 'dep': [], 'job': 'dumb', 'args': [3, 4] } ])
+        bsg.finalize()
+        bsg.system.log = self.log
+
+        self.assertTrue(bsg.system.run())
+        self.assertEqual(sorted(self.log.entries), ['a', 'b'])
+        self.assertEqual(self.log.get('b').fingerprint, job_fingerprint(bsg._process_jobs['b'][0]))
+
+    def test_system_stages_record_no_durations(self):
+        bsg = BuildSystemGenerator({'dumb': dummy_function})
+        bsg.check_method = 'force'
+        bsg.ingest([ { 'target': 'a', 'dep': ['b'], 'job': 'dumb', 'args': [1, 2] },
+                     { 'target': 'b', 'dep': [], 'job': 'dumb', 'args': [3, 4] } ])
+        bsg.finalize()
+        bsg.system.log = self.log
+
+        self.log.record('a', 1.0, 6.0)
+
+        self.assertTrue(bsg.system.run())
+        self.assertEqual(self.log.durations(), {'a': 5.0})
+        self.assertIsNone(self.log.get('b').start)
+
+    def test_dag_loads_durations(self):
+        bsg = BuildSystemGenerator({'dumb': dummy_function})
+        bsg.check_method = 'force'
+        bsg.ingest([ { 'target': 'a', 'dep': [], 'job': 'dumb', 'args': [1, 2] } ])
+        bsg.finalize()
+
+        self.log.record('a', 1.0, 6.0)
+        self.log.record('other', 1.0, 2.0)
+        bsg.system.log = self.log
+
+        self.assertTrue(bsg.system.run(mode='dag'))
+        self.assertEqual(bsg.system.graph.durations['other'], 1.0)
+        self.assertNotEqual(self.log.get('a').start, 1.0)
+
+class TestDependencyChecksBuildLog(TestCase):
+    @classmethod
+    def setUp(self):
+        self.fn = 'test.buildc_log'
+        self.target = 'test_buildlog_target.txt'
+        self.dep = 'test_buildlog_dep.txt'
+
+        for fn in [ self.dep, self.target ]:
+            with open(fn, 'w') as f:
+                f.write(fn)
+
+        self.log = BuildLog(self.fn)
+        self.checks = DependencyChecks()
+        self.checks.log = self.log
+
+    @classmethod
+    def tearDown(self):
+        self.log.close()
+
+        for fn in [ self.fn, self.target, self.dep ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def test_up_to_date(self):
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc')
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_not_in_log(self):
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_failed_last_build(self):
+        self.log.record(self.target, 1.0, 2.0, 1, 'abc')
+        self.assertTrue(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_changed_job(self):
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc')
+        self.assertTrue(self.checks.check(self.target, [self.dep], 'def'))
+
+    def test_without_fingerprint(self):
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc')
+        self.assertFalse(self.checks.check(self.target, [self.dep]))
+
+    def test_ignore_method(self):
+        self.checks.check_method = 'ignore'
+        self.log.record(self.target, 1.0, 2.0, 1, 'abc')
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_hash_up_to_date(self):
+        self.checks.check_method = 'hash'
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc', inputs=inputs_digest([self.dep]))
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_hash_changed_dependency(self):
+        self.checks.check_method = 'hash'
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc', inputs=inputs_digest([self.dep]))
+
+        with open(self.dep, 'w') as f:
+            f.write('changed')
+
+        self.assertTrue(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_hash_without_inputs(self):
+        self.checks.check_method = 'hash'
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc')
+        self.assertTrue(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_hash_build_then_no_rebuild(self):
+        specs = [ { 'target': self.target, 'dep': [self.dep], 'job': 'dumb', 'args': [1, 2] },
+                  { 'target': self.dep, 'dep': [], 'job': 'dumb', 'args': [3, 4] } ]
+
+        for expected in [ True, False ]:
+            bsg = BuildSystemGenerator({'dumb': dummy_function})
+            bsg.check = self.checks
+            bsg.check_method = 'hash'
+            bsg.ingest(specs)
+            bsg.finalize()
+            bsg.system.log = self.log
+
+            self.assertEqual(self.target in bsg.system.graph, expected)
+            self.assertTrue(bsg.system.run(mode='dag'))
+
+    def age(self, fn, seconds):
+        os.utime(fn, (time.time() - seconds, time.time() - seconds))
+
+    def test_mtime_hash_up_to_date_without_inputs(self):
+        self.checks.check_method = 'mtime+hash'
+        self.age(self.dep, 60)
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc')
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_mtime_hash_touched_dependency(self):
+        self.checks.check_method = 'mtime+hash'
+        self.age(self.target, 60)
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc', inputs=inputs_digest([self.dep]))
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_mtime_hash_changed_dependency(self):
+        self.checks.check_method = 'mtime+hash'
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc', inputs=inputs_digest([self.dep]))
+
+        with open(self.dep, 'w') as f:
+            f.write('changed')
+        self.age(self.target, 60)
+
+        self.assertTrue(self.checks.check(self.target, [self.dep], 'abc'))
+
+    def test_mtime_hash_does_not_hash_up_to_date_targets(self):
+        self.checks.check_method = 'mtime+hash'
+        self.age(self.dep, 60)
+        self.log.record(self.target, 1.0, 2.0, 0, 'abc', inputs=inputs_digest([self.dep]))
+
+        self.assertFalse(self.checks.check(self.target, [self.dep], 'abc'))
+        self.assertEqual(self.checks.digests.hashed, 0)
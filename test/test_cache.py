@@ -0,0 +1,406 @@
+from unittest import TestCase
+from buildcloth.cache import ActionCache, SharedCache, parse_age
+from buildcloth.buildlog import output_signature
+from buildcloth.dependency import DependencyChecks, DigestCache
+from buildcloth.scheduler import BuildGraph
+from buildcloth.system import BuildSystem, BuildSystemGenerator
+from buildcloth.buildc import stages
+from buildcloth.err import StageRunError
+from buildcloth.stages import BuildStage
+from test.utils import dummy_function
+import subprocess
+import shutil
+import time
+import os
+
+class TestActionCache(TestCase):
+    @classmethod
+    def setUp(self):
+        self.path = os.path.abspath('test_cache_dir')
+        self.cache = ActionCache(self.path)
+        self.dep = 'test_cache_dep.txt'
+        self.target = 'test_cache_target.txt'
+
+        with open(self.dep, 'w') as f:
+            f.write('dep')
+
+        with open(self.target, 'w') as f:
+            f.write('output')
+
+    @classmethod
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        for fn in [ self.dep, self.target ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def age_objects(self, seconds, kind='objects'):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, kind)):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                os.utime(path, (time.time() - seconds, time.time() - seconds))
+                paths.append(path)
+
+        return paths
+
+    def read(self, fn):
+        with open(fn, 'r') as f:
+            return f.read()
+
+    def test_key_stable(self):
+        job = (dummy_function, (1, 2))
+        self.assertEqual(self.cache.key(job, [self.dep]), self.cache.key(job, [self.dep]))
+
+    def test_key_job(self):
+        self.assertNotEqual(self.cache.key((dummy_function, (1, 2)), [self.dep]),
+                            self.cache.key((dummy_function, (1, 3)), [self.dep]))
+
+    def test_key_dependency_content(self):
+        job = (dummy_function, (1, 2))
+        key = self.cache.key(job, [self.dep])
+
+        with open(self.dep, 'w') as f:
+            f.write('changed')
+
+        self.assertNotEqual(self.cache.key(job, [self.dep]), key)
+
+    def test_key_uses_digest(self):
+        digested = []
+        cache = ActionCache(self.path, digest=lambda path: digested.append(path) or 'abc')
+
+        self.assertIsNotNone(cache.key((dummy_function, (1, 2)), [self.dep]))
+        self.assertEqual(digested, [self.dep])
+
+    def test_key_shares_digest_cache(self):
+        check = DependencyChecks()
+        check.algorithm = 'sha256'
+        check.digests = DigestCache(os.path.abspath('test_cache_digests'), check.stats, check.algorithm)
+        check._digest(self.dep)
+
+        cache = ActionCache(self.path, digest=check._digest)
+        cache.key((dummy_function, (1, 2)), [self.dep])
+
+        self.assertEqual(check.digests.hashed, 1)
+
+    def test_key_missing_dependency(self):
+        self.assertIsNone(self.cache.key((dummy_function, (1, 2)), ['does-not-exist']))
+
+    def test_restore_miss(self):
+        self.assertFalse(self.cache.restore('0' * 32, self.target))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_store_and_restore(self):
+        os.chmod(self.target, 0o755)
+        self.assertTrue(self.cache.store('abc', self.target))
+        os.remove(self.target)
+
+        self.assertTrue(self.cache.restore('abc', self.target))
+        self.assertEqual(self.read(self.target), 'output')
+        self.assertEqual(os.stat(self.target).st_mode & 0o777, 0o755)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_store_unwritten_target(self):
+        signature = output_signature(self.target)
+        self.assertFalse(self.cache.store('abc', self.target, signature))
+
+    def test_store_missing_target(self):
+        self.assertFalse(self.cache.store('abc', 'does-not-exist'))
+
+    def test_identical_outputs_share_object(self):
+        self.cache.store('abc', self.target)
+        self.cache.store('def', self.target)
+
+        self.assertEqual(self.cache.size(), len('output'))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_size = 10
+        self.cache.store('old', self.target)
+
+        # mtimes are the recency of entries.
+        old = self.age_objects(60)[0]
+
+        with open(self.target, 'w') as f:
+            f.write('new output')
+        self.cache.store('new', self.target)
+
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(self.cache.size(), len('new output'))
+        self.assertFalse(self.cache.restore('old', self.target))
+        self.assertTrue(self.cache.restore('new', self.target))
+
+    def test_trim(self):
+        self.cache.store('abc', self.target)
+
+        self.assertEqual(self.cache.trim(0), 1)
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_sharded_layout(self):
+        self.cache.store('abcdef', self.target)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'actions', 'ab', 'abcdef')))
+        self.assertEqual(len(os.listdir(os.path.join(self.path, 'objects'))), 1)
+
+    def test_no_temporary_files(self):
+        self.cache.store('abcdef', self.target)
+        self.cache.restore('abcdef', self.target)
+
+        self.assertEqual(self.cache._objects(tmp=True), [])
+        self.assertEqual([ fn for fn in os.listdir('.') if fn.endswith('.tmp') ], [])
+
+    def test_gc_age(self):
+        self.cache.store('old', self.target)
+        self.age_objects(7200)
+        self.age_objects(7200, 'actions')
+
+        with open(self.target, 'w') as f:
+            f.write('new output')
+        self.cache.store('new', self.target)
+
+        self.assertEqual(self.cache.gc(max_age=3600), 1)
+        self.assertFalse(os.path.exists(self.cache._path('actions', 'old')))
+        self.assertTrue(self.cache.restore('new', self.target))
+
+    def test_gc_size(self):
+        self.cache.store('old', self.target)
+        self.age_objects(60)
+
+        with open(self.target, 'w') as f:
+            f.write('new output')
+        self.cache.store('new', self.target)
+
+        self.assertEqual(self.cache.gc(max_size=10), 1)
+        self.assertEqual(self.cache.size(), 10)
+        self.assertFalse(os.path.exists(self.cache._path('actions', 'old')))
+
+    def test_gc_abandoned_temporary_files(self):
+        self.cache.store('abc', self.target)
+        tmp = self.cache._tmp(self.cache._path('objects', '0' * 32))
+        os.makedirs(os.path.dirname(tmp))
+
+        with open(tmp, 'w') as f:
+            f.write('partial')
+
+        self.cache.gc()
+        self.assertTrue(os.path.exists(tmp))
+
+        os.utime(tmp, (time.time() - 7200, time.time() - 7200))
+        self.cache.gc()
+        self.assertFalse(os.path.exists(tmp))
+
+class TestSharedCache(TestCase):
+    @classmethod
+    def setUp(self):
+        self.path = os.path.abspath('test_shared_cache_dir')
+        self.target = 'test_cache_target.txt'
+
+        with open(self.target, 'w') as f:
+            f.write('output')
+
+    @classmethod
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        if os.path.exists(self.target):
+            os.remove(self.target)
+
+    def test_shares_outputs(self):
+        SharedCache(self.path).store('abc', self.target)
+        os.remove(self.target)
+
+        self.assertTrue(SharedCache(self.path).restore('abc', self.target))
+
+    def test_store_does_not_evict(self):
+        cache = SharedCache(self.path, 1)
+        cache.store('abc', self.target)
+
+        self.assertEqual(cache.size(), len('output'))
+        self.assertEqual(cache.trim(), 1)
+
+    def test_gc_without_budget(self):
+        cache = SharedCache(self.path)
+        cache.store('abc', self.target)
+
+        self.assertEqual(cache.gc(), 0)
+        self.assertTrue(cache.restore('abc', self.target))
+
+class TestParseAge(TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_age('90'), 90)
+        self.assertEqual(parse_age(90), 90)
+
+    def test_suffixes(self):
+        self.assertEqual(parse_age('2h'), 7200)
+        self.assertEqual(parse_age('7d'), 604800)
+        self.assertEqual(parse_age('1.5m'), 90)
+
+    def test_malformed(self):
+        for value in [ 'soon', '-1', '3y', True, -5 ]:
+            with self.assertRaises(ValueError):
+                parse_age(value)
+
+class TestBuildCache(TestCase):
+    @classmethod
+    def setUp(self):
+        self.path = os.path.abspath('test_cache_dir')
+        self.dep = os.path.abspath('test_cache_dep.txt')
+        self.target = os.path.abspath('test_cache_target.txt')
+        self.runs = os.path.abspath('test_cache_runs.txt')
+
+        with open(self.dep, 'w') as f:
+            f.write('dep')
+
+    @classmethod
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        for fn in [ self.dep, self.target, self.runs ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def job(self):
+        cmd = 'cat {0} > {1}; echo run >> {2}'.format(self.dep, self.target, self.runs)
+        return (subprocess.call, dict(args=['sh', '-c', cmd]))
+
+    def count_runs(self):
+        if not os.path.exists(self.runs):
+            return 0
+
+        with open(self.runs, 'r') as f:
+            return len(f.readlines())
+
+    def run_graph(self):
+        g = BuildGraph()
+        g.cache = ActionCache(self.path)
+        g.add(self.target, *self.job(), dependency=[self.dep])
+
+        self.assertTrue(g.run())
+        return g
+
+    def test_graph_restores_target(self):
+        self.run_graph()
+        os.remove(self.target)
+
+        g = self.run_graph()
+
+        self.assertEqual(self.count_runs(), 1)
+        self.assertEqual(g.cache.hits, 1)
+        self.assertTrue(os.path.exists(self.target))
+        self.assertNotIn(self.target, g.durations)
+
+    def test_graph_changed_dependency(self):
+        self.run_graph()
+
+        with open(self.dep, 'w') as f:
+            f.write('changed')
+
+        self.run_graph()
+
+        self.assertEqual(self.count_runs(), 2)
+        with open(self.target, 'r') as f:
+            self.assertEqual(f.read(), 'changed')
+
+    def test_graph_switch_back(self):
+        self.run_graph()
+
+        with open(self.dep, 'w') as f:
+            f.write('changed')
+        self.run_graph()
+
+        with open(self.dep, 'w') as f:
+            f.write('dep')
+        self.run_graph()
+
+        self.assertEqual(self.count_runs(), 2)
+        with open(self.target, 'r') as f:
+            self.assertEqual(f.read(), 'dep')
+
+    def generate(self):
+        func, args = self.job()
+        bsg = BuildSystemGenerator()
+        bsg.check_method = 'force'
+        bsg.ingest([ { 'target': self.target, 'dep': [self.dep], 'dir': os.getcwd(),
+                       'cmd': 'sh', 'args': args['args'][1:] },
+                     { 'target': self.dep, 'dep': [], 'dir': os.getcwd(), 'cmd': 'true', 'args': [] } ])
+        bsg.finalize()
+        bsg.system.cache = ActionCache(self.path)
+
+        return bsg.system
+
+    def system(self):
+        job = self.job()
+        stage = BuildStage()
+        stage.add(*job)
+
+        bs = BuildSystem()
+        bs.add_stage('build', stage)
+        bs.targets['build'] = [ (self.target, job) ]
+        bs.dependencies[self.target] = [self.dep]
+        bs.cache = ActionCache(self.path)
+        bs.close()
+
+        return bs
+
+    def test_system_stages(self):
+        self.assertTrue(self.system().run())
+        os.remove(self.target)
+
+        system = self.system()
+        self.assertTrue(system.run())
+
+        self.assertEqual(self.count_runs(), 1)
+        self.assertEqual(system.cache.hits, 1)
+        self.assertTrue(os.path.exists(self.target))
+
+    def stage_with_dependency(self):
+        job = self.job()
+        dep_job = (subprocess.call, dict(args=['true']))
+
+        stage = BuildStage()
+        stage.add(*job)
+        stage.add(*dep_job)
+
+        bs = BuildSystem()
+        bs.add_stage('build', stage)
+        bs.targets['build'] = [ (self.target, job), (self.dep, dep_job) ]
+        bs.dependencies[self.target] = [self.dep]
+        bs.dependencies[self.dep] = []
+        bs.cache = ActionCache(self.path)
+        bs.close()
+
+        return bs
+
+    def test_system_stages_dependency_in_stage(self):
+        self.assertTrue(self.stage_with_dependency().run())
+        os.remove(self.target)
+
+        system = self.stage_with_dependency()
+        self.assertTrue(system.run())
+
+        self.assertEqual(self.count_runs(), 2)
+        self.assertEqual(system.cache.hits, 0)
+
+    def test_system_stages_dependency_in_earlier_stage(self):
+        self.assertTrue(self.generate().run())
+        os.remove(self.target)
+
+        system = self.generate()
+        self.assertTrue(system.run())
+
+        self.assertEqual(self.count_runs(), 1)
+        self.assertEqual(system.cache.hits, 1)
+
+    def test_asyncio_engine_rejects_cache(self):
+        with self.assertRaises(StageRunError):
+            stages(2, [], [], 'force', engine='asyncio', cache=ActionCache(self.path))
+
+    def test_system_dag(self):
+        self.assertTrue(self.generate().run(mode='dag'))
+        os.remove(self.target)
+
+        system = self.generate()
+        self.assertTrue(system.run(mode='dag'))
+
+        self.assertEqual(self.count_runs(), 1)
+        self.assertEqual(system.cache.hits, 1)
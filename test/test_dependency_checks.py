@@ -1,5 +1,12 @@
 from buildcloth.err import DependencyCheckError
-from buildcloth.dependency import DependencyChecks
+from buildcloth.dependency import (DependencyChecks, StatCache, DigestCache, DIGEST_HEADER,
+                                   mtime_check, md5_file_check, file_digest, file_signature,
+                                   inputs_digest)
+import buildcloth.dependency
+import hashlib
+from buildcloth.scheduler import BuildGraph
+from buildcloth.system import BuildSystemGenerator
+from test.utils import dummy_function
 from unittest import TestCase, skip
 import sys
 import os
@@ -54,7 +61,7 @@ class TestDependencyChecking(TestCase):
 
     def test_setting_valid_methods(self):
         self.ensure_clean()
-        for method in ['force', 'ignore', 'hash', 'mtime']:
+        for method in ['force', 'ignore', 'hash', 'mtime+hash', 'mtime']:
             self.d.check_method = method
 
             self.assertTrue(self.d.check_method, method)
@@ -136,6 +143,26 @@ class TestDependencyChecking(TestCase):
         self.assertTrue(self.d.check_method, 'hash')
         self.assertTrue(self.d.check(self.fn_a, self.fn_b))
 
+    def test_mtime_hash_rebuild_without_log(self):
+        self.ensure_clean()
+
+        write(self.fn_a, 'aaa')
+        breath()
+        write(self.fn_b, 'aaa')
+
+        self.d.check_method = 'mtime+hash'
+        self.assertTrue(self.d.check(self.fn_a, self.fn_b))
+
+    def test_mtime_hash_no_rebuild(self):
+        self.ensure_clean()
+
+        write(self.fn_b, 'bbb')
+        breath()
+        write(self.fn_a, 'aaa')
+
+        self.d.check_method = 'mtime+hash'
+        self.assertFalse(self.d.check(self.fn_a, [self.fn_b]))
+
     def test_force_non_existing(self):
         self.ensure_clean()
         self.d.check_method = 'force'
@@ -191,3 +218,356 @@ class TestDependencyChecking(TestCase):
         self.d.check_method = 'ignore'
         self.assertTrue(self.d.check_method, 'ignore')
         self.assertFalse(self.d.check(self.fn_a, self.fn_b))
+
+class TestStatCache(TestCase):
+    @classmethod
+    def setUp(self):
+        self.stats = StatCache()
+        self.fn_a = 'fn_a'
+        self.fn_b = 'fn_b'
+
+    @classmethod
+    def tearDown(self):
+        for fn in [ self.fn_a, self.fn_b ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def test_caches_stat(self):
+        touch(self.fn_a)
+        st = self.stats.stat(self.fn_a)
+        os.remove(self.fn_a)
+
+        self.assertEqual(self.stats.stat(self.fn_a), st)
+        self.assertTrue(self.stats.exists(self.fn_a))
+
+    def test_caches_missing(self):
+        self.assertFalse(self.stats.exists(self.fn_a))
+        touch(self.fn_a)
+
+        with self.assertRaises(OSError):
+            self.stats.stat(self.fn_a)
+
+    def test_invalidate(self):
+        self.assertFalse(self.stats.exists(self.fn_a))
+        touch(self.fn_a)
+        self.stats.invalidate(self.fn_a)
+
+        self.assertTrue(self.stats.exists(self.fn_a))
+
+    def test_invalidate_all(self):
+        self.stats.exists(self.fn_a)
+        self.stats.exists(self.fn_b)
+        self.stats.invalidate()
+
+        self.assertEqual(len(self.stats), 0)
+
+    def test_mtime_check(self):
+        touch(self.fn_a)
+        breath()
+        touch(self.fn_b)
+
+        self.assertTrue(mtime_check(self.fn_a, self.fn_b, self.stats))
+        self.assertEqual(len(self.stats), 2)
+
+    def test_checks_share_stats(self):
+        d = DependencyChecks()
+        touch(self.fn_b)
+        breath()
+        touch(self.fn_a)
+
+        self.assertFalse(d.check(self.fn_a, [self.fn_b]))
+        self.assertFalse(d.check(self.fn_b, []))
+        self.assertEqual(len(d.stats), 2)
+
+    def test_graph_invalidates_targets(self):
+        self.stats.exists(self.fn_a)
+
+        g = BuildGraph()
+        g.stats = self.stats
+        g.add(self.fn_a, dummy_function, (1, 2))
+
+        self.assertTrue(g.run())
+        self.assertEqual(len(self.stats), 0)
+
+    def test_generator_shares_stats(self):
+        bsg = BuildSystemGenerator({'dumb': dummy_function})
+        bsg.check_method = 'force'
+        bsg.ingest([ { 'target': self.fn_a, 'dep': [], 'job': 'dumb', 'args': [1, 2] } ])
+        bsg.finalize()
+
+        self.assertIs(bsg.system.stats, bsg.check.stats)
+
+        bsg.check.stats.exists(self.fn_a)
+        self.assertTrue(bsg.system.run())
+        self.assertEqual(len(bsg.check.stats), 0)
+
+class TestDigestCache(TestCase):
+    def setUp(self):
+        self.path = 'test.buildc_digests'
+        self.fn_a = 'fn_a'
+        self.fn_b = 'fn_b'
+
+        for fn in [ self.fn_a, self.fn_b ]:
+            write(fn, fn)
+            self.age(fn)
+
+        self.digests = DigestCache(self.path)
+
+    def tearDown(self):
+        for fn in [ self.fn_a, self.fn_b, self.path ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def age(self, fn):
+        # files modified moments ago are not saved.
+        os.utime(fn, (time.time() - 60, time.time() - 60))
+
+    def reopen(self):
+        digests = DigestCache(self.path)
+        digests.load()
+        return digests
+
+    def test_digest(self):
+        self.assertEqual(self.digests.digest(self.fn_a), md5_file_check(self.fn_a))
+
+    def test_hashes_once(self):
+        self.digests.digest(self.fn_a)
+        self.digests.digest(self.fn_a)
+
+        self.assertEqual(self.digests.hashed, 1)
+
+    def test_persists(self):
+        self.digests.digest(self.fn_a)
+        self.digests.close()
+
+        digests = self.reopen()
+        self.assertEqual(digests.digest(self.fn_a), md5_file_check(self.fn_a))
+        self.assertEqual(digests.hashed, 0)
+
+    def test_rehashes_changed_file(self):
+        self.digests.digest(self.fn_a)
+        self.digests.close()
+
+        write(self.fn_a, 'changed')
+        self.age(self.fn_a)
+
+        digests = self.reopen()
+        self.assertEqual(digests.digest(self.fn_a), md5_file_check(self.fn_a))
+        self.assertEqual(digests.hashed, 1)
+
+    def test_does_not_save_racy_digests(self):
+        write(self.fn_a, 'changed')
+        self.digests.digest(self.fn_a)
+        self.digests.digest(self.fn_b)
+        self.digests.close()
+
+        self.assertEqual(len(self.reopen()), 1)
+
+    def test_prunes_stale_entries(self):
+        self.digests.digest(self.fn_a)
+        self.digests.digest(self.fn_b)
+        self.digests.close()
+
+        os.remove(self.fn_b)
+        write(self.fn_a, 'changed')
+        self.age(self.fn_a)
+
+        digests = self.reopen()
+        digests.digest(self.fn_a)
+        digests.close()
+
+        self.assertEqual(len(self.reopen()), 1)
+
+    def test_keeps_unused_entries(self):
+        self.digests.digest(self.fn_a)
+        self.digests.close()
+
+        digests = self.reopen()
+        digests.digest(self.fn_b)
+        digests.close()
+
+        self.assertEqual(len(self.reopen()), 2)
+
+    def test_no_file_without_new_digests(self):
+        self.digests.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_skips_malformed_records(self):
+        with open(self.path, 'w') as f:
+            f.write(DIGEST_HEADER.format('md5'))
+            f.write('garbage\n')
+            f.write('\t'.join([ str(field) for field in file_signature(os.stat(self.fn_a)) ]
+                              + [ 'abc', self.fn_a ]) + '\n')
+
+        self.assertEqual(self.reopen().digest(self.fn_a), 'abc')
+
+    def test_ignores_unknown_format(self):
+        with open(self.path, 'w') as f:
+            f.write('# something else\n')
+
+        self.assertEqual(len(self.reopen()), 0)
+
+    def test_prefetch(self):
+        self.assertEqual(self.digests.prefetch([self.fn_a, self.fn_b, self.fn_a, 'does-not-exist']), 2)
+        self.assertEqual(self.digests.digest(self.fn_b), md5_file_check(self.fn_b))
+        self.assertEqual(self.digests.hashed, 2)
+
+    def test_prefetch_cached(self):
+        self.digests.digest(self.fn_a)
+        self.assertEqual(self.digests.prefetch([self.fn_a]), 0)
+
+    def test_algorithm(self):
+        digests = DigestCache(self.path, algorithm='blake2b')
+        self.assertEqual(digests.digest(self.fn_a), file_digest(self.fn_a, 'blake2b'))
+
+    def test_invalid_algorithm(self):
+        with self.assertRaises(DependencyCheckError):
+            DigestCache(self.path, algorithm='crc32')
+
+    def test_ignores_other_algorithm(self):
+        self.digests.digest(self.fn_a)
+        self.digests.close()
+
+        digests = DigestCache(self.path, algorithm='sha256')
+        self.assertEqual(len(digests.load()), 0)
+        self.assertEqual(digests.digest(self.fn_a), file_digest(self.fn_a, 'sha256'))
+
+    def test_memory_only(self):
+        digests = DigestCache(None)
+        digests.digest(self.fn_a)
+        digests.digest(self.fn_a)
+        digests.close()
+
+        self.assertEqual(digests.hashed, 1)
+        self.assertEqual(len(digests.load()), 0)
+
+    def test_hash_check_defaults_to_build_cache(self):
+        d = DependencyChecks()
+        d.check_method = 'hash'
+
+        d.check(self.fn_a, [self.fn_b])
+        d.check(self.fn_b, [self.fn_a])
+        self.assertEqual(d.digests.hashed, 2)
+
+    def test_generator_prefetches(self):
+        bsg = BuildSystemGenerator({'dumb': dummy_function})
+        bsg.check_method = 'hash'
+        bsg.check.digests = self.digests
+        bsg.ingest([ { 'target': self.fn_a, 'dep': [self.fn_b], 'job': 'dumb', 'args': [1, 2] },
+                     { 'target': self.fn_b, 'dep': [], 'job': 'dumb', 'args': [3, 4] } ])
+        self.assertEqual(self.digests.hashed, 0)
+
+        bsg.finalize()
+        self.assertEqual(self.digests.hashed, 2)
+
+    def test_hash_check(self):
+        d = DependencyChecks()
+        d.check_method = 'hash'
+        d.digests = self.digests
+
+        self.assertTrue(d.check(self.fn_a, [self.fn_b]))
+        self.assertTrue(d.check(self.fn_b, [self.fn_a]))
+        self.assertEqual(self.digests.hashed, 2)
+
+    def test_check_algorithm(self):
+        d = DependencyChecks()
+        d.check_method = 'hash'
+        d.algorithm = 'blake2b'
+
+        self.assertEqual(d.digests.algorithm, 'blake2b')
+        self.assertFalse(d.check(self.fn_a, [self.fn_a]))
+
+    def test_check_invalid_algorithm(self):
+        d = DependencyChecks()
+
+        with self.assertRaises(DependencyCheckError):
+            d.algorithm = 'crc32'
+
+    def test_check_without_cache(self):
+        d = DependencyChecks()
+        d.digests = None
+        d.algorithm = 'sha256'
+
+        self.assertEqual(d._digest(self.fn_a), file_digest(self.fn_a, 'sha256'))
+
+class TestInputsDigest(TestCase):
+    @classmethod
+    def setUp(self):
+        self.fn_a = 'fn_a'
+        self.fn_b = 'fn_b'
+
+        for fn in [ self.fn_a, self.fn_b ]:
+            write(fn, fn)
+
+    @classmethod
+    def tearDown(self):
+        for fn in [ self.fn_a, self.fn_b ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def test_order_independent(self):
+        self.assertEqual(inputs_digest([self.fn_a, self.fn_b]), inputs_digest([self.fn_b, self.fn_a]))
+
+    def test_single_path(self):
+        self.assertEqual(inputs_digest(self.fn_a), inputs_digest([self.fn_a]))
+
+    def test_changed_content(self):
+        before = inputs_digest([self.fn_a, self.fn_b])
+        write(self.fn_b, 'changed')
+        self.assertNotEqual(inputs_digest([self.fn_a, self.fn_b]), before)
+
+    def test_changed_dependencies(self):
+        self.assertNotEqual(inputs_digest([self.fn_a]), inputs_digest([self.fn_a, self.fn_b]))
+
+    def test_missing_file(self):
+        self.assertNotEqual(inputs_digest([self.fn_a, 'does-not-exist']), inputs_digest([self.fn_a]))
+
+    def test_algorithm(self):
+        digest = inputs_digest([self.fn_a], algorithm='blake2b')
+
+        self.assertTrue(digest.startswith('blake2b:'))
+        self.assertNotEqual(digest, inputs_digest([self.fn_a]))
+
+class TestMd5FileCheck(TestCase):
+    @classmethod
+    def setUp(self):
+        self.fn = 'fn_a'
+        self.threshold = buildcloth.dependency.MMAP_THRESHOLD
+
+    @classmethod
+    def tearDown(self):
+        buildcloth.dependency.MMAP_THRESHOLD = self.threshold
+
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def test_digest(self):
+        write(self.fn, 'abc' * 1000)
+        self.assertEqual(md5_file_check(self.fn), hashlib.md5(b'abc' * 1000).hexdigest())
+
+    def test_mmap(self):
+        buildcloth.dependency.MMAP_THRESHOLD = 1
+        write(self.fn, 'abc' * 1000)
+        self.assertEqual(md5_file_check(self.fn), hashlib.md5(b'abc' * 1000).hexdigest())
+
+    def test_mmap_empty(self):
+        buildcloth.dependency.MMAP_THRESHOLD = 0
+        write(self.fn, '')
+        self.assertEqual(md5_file_check(self.fn), hashlib.md5(b'').hexdigest())
+
+    def test_block_size(self):
+        write(self.fn, 'abc' * 1000)
+        self.assertEqual(md5_file_check(self.fn, block_size=7), hashlib.md5(b'abc' * 1000).hexdigest())
+
+    def test_invalid_block_size(self):
+        write(self.fn, 'abc')
+
+        with self.assertRaises(ValueError):
+            file_digest(self.fn, block_size=0)
+
+    def test_algorithms(self):
+        write(self.fn, 'abc' * 1000)
+
+        for algorithm in buildcloth.dependency.ALGORITHMS:
+            self.assertEqual(file_digest(self.fn, algorithm, 64),
+                             hashlib.new(algorithm, b'abc' * 1000).hexdigest())
@@ -0,0 +1,401 @@
+from unittest import TestCase
+from buildcloth.executors import (WorkerPool, ThreadWorkerPool, Executor, PoolLimits, LoadLimit,
+                                  MemoryLimit, BatchSizer, parse_size, mem_available, measured, run_batch)
+from buildcloth.err import StageRunError
+from multiprocessing import cpu_count
+from test.utils import dummy_function, fail_function, exclusive_command
+import subprocess
+import threading
+import time
+from queue import Queue
+
+class TestWorkerPool(TestCase):
+    @classmethod
+    def setUp(self):
+        self.p = WorkerPool(2)
+
+    @classmethod
+    def tearDown(self):
+        self.p.terminate()
+
+    def test_default_workers(self):
+        self.assertEqual(WorkerPool().workers, cpu_count())
+
+    def test_workers(self):
+        self.assertEqual(self.p.workers, 2)
+
+    def test_lazy_start(self):
+        self.assertFalse(self.p.started)
+        self.p.apply(dummy_function, (1, 2)).wait()
+        self.assertTrue(self.p.started)
+
+    def test_apply_tuple(self):
+        self.assertEqual(self.p.apply(dummy_function, (1, 2)).get(), (1, 2))
+
+    def test_apply_list(self):
+        self.assertEqual(self.p.apply(dummy_function, [1, 2]).get(), (1, 2))
+
+    def test_apply_dict(self):
+        self.assertEqual(self.p.apply(dummy_function, {'b': 2}).get(), (None, 2))
+
+    def test_apply_none(self):
+        self.assertEqual(self.p.apply(dummy_function, None).get(), (None, None))
+
+    def test_callbacks(self):
+        done = Queue()
+        self.p.apply(dummy_function, (1, 2), callback=done.put)
+        self.assertEqual(done.get(timeout=10), (1, 2))
+
+    def test_error_callback(self):
+        done = Queue()
+        self.p.apply(fail_function, (1, 2), callback=done.put, error_callback=done.put)
+        self.assertTrue(isinstance(done.get(timeout=10), ValueError))
+
+    def test_close(self):
+        self.p.apply(dummy_function, (1, 2))
+        self.p.close()
+        self.assertFalse(self.p.started)
+
+    def test_context_manager(self):
+        with WorkerPool(2) as p:
+            p.apply(dummy_function, (1, 2)).wait()
+
+        self.assertFalse(p.started)
+
+class TestThreadWorkerPool(TestCase):
+    @classmethod
+    def setUp(self):
+        self.p = ThreadWorkerPool(2)
+
+    @classmethod
+    def tearDown(self):
+        self.p.terminate()
+
+    def test_default_workers(self):
+        self.assertEqual(ThreadWorkerPool().workers, cpu_count())
+
+    def test_lazy_start(self):
+        self.assertFalse(self.p.started)
+        self.p.apply(dummy_function, (1, 2)).result()
+        self.assertTrue(self.p.started)
+
+    def test_apply_tuple(self):
+        self.assertEqual(self.p.apply(dummy_function, (1, 2)).result(), (1, 2))
+
+    def test_apply_dict(self):
+        self.assertEqual(self.p.apply(dummy_function, {'b': 2}).result(), (None, 2))
+
+    def test_apply_none(self):
+        self.assertEqual(self.p.apply(dummy_function, None).result(), (None, None))
+
+    def test_runs_in_thread(self):
+        self.assertNotEqual(self.p.apply(threading.current_thread, None).result(),
+                            threading.current_thread())
+
+    def test_callbacks(self):
+        done = Queue()
+        self.p.apply(dummy_function, (1, 2), callback=done.put)
+        self.assertEqual(done.get(timeout=10), (1, 2))
+
+    def test_error_callback(self):
+        done = Queue()
+        self.p.apply(fail_function, (1, 2), callback=done.put, error_callback=done.put)
+        self.assertTrue(isinstance(done.get(timeout=10), ValueError))
+
+    def test_shell_job_exit_status(self):
+        done = Queue()
+        self.p.apply(subprocess.call, dict(args=['false']), callback=done.put, error_callback=done.put)
+        self.assertTrue(isinstance(done.get(timeout=10), StageRunError))
+
+    def test_close(self):
+        self.p.apply(dummy_function, (1, 2))
+        self.p.close()
+        self.assertFalse(self.p.started)
+
+    def test_terminate_stops_commands(self):
+        done = Queue()
+        self.p.apply(subprocess.call, dict(args=['sleep', '30']), callback=done.put, error_callback=done.put)
+        self.p.apply(subprocess.call, dict(args=['sleep', '30']), callback=done.put, error_callback=done.put)
+        self.p.apply(subprocess.call, dict(args=['sleep', '30']), callback=done.put, error_callback=done.put)
+
+        time.sleep(0.2)
+        start = time.time()
+        self.p.terminate()
+
+        self.assertTrue(time.time() - start < 10)
+        self.assertFalse(self.p.started)
+
+class TestExecutor(TestCase):
+    @classmethod
+    def setUp(self):
+        self.e = Executor(2)
+
+    @classmethod
+    def tearDown(self):
+        self.e.terminate()
+
+    def test_default_workers(self):
+        self.assertEqual(Executor().workers, cpu_count())
+
+    def test_job_type(self):
+        self.assertEqual(Executor.job_type(subprocess.call), 'shell')
+        self.assertEqual(Executor.job_type(dummy_function), 'python')
+
+    def test_shell_jobs_use_threads(self):
+        self.e.apply(subprocess.call, dict(args=['true'])).result()
+
+        self.assertTrue(self.e.pools['shell'].started)
+        self.assertFalse(self.e.pools['python'].started)
+
+    def test_python_jobs_use_processes(self):
+        self.e.apply(dummy_function, (1, 2)).wait()
+
+        self.assertTrue(self.e.pools['python'].started)
+        self.assertFalse(self.e.pools['shell'].started)
+
+    def test_override_pool(self):
+        e = Executor(2, pools={'python': ThreadWorkerPool(2)})
+
+        with e:
+            self.assertEqual(e.apply(dummy_function, (1, 2)).result(), (1, 2))
+
+    def test_context_manager(self):
+        with Executor(2) as e:
+            e.apply(dummy_function, (1, 2)).wait()
+            e.apply(subprocess.call, dict(args=['true'])).result()
+
+        self.assertFalse(e.started)
+
+    def test_limits_mixed_jobs_to_workers(self):
+        self.e.apply(subprocess.call, dict(args=['sleep', '0.2']))
+        self.e.apply(time.sleep, (0.2,))
+        self.e.apply(subprocess.call, dict(args=['sleep', '0.2']))
+        self.e.apply(time.sleep, (0.2,))
+
+        self.assertEqual(self.e.running, 2)
+        self.assertEqual(len(self.e._held), 2)
+
+class TestPoolLimits(TestCase):
+    @classmethod
+    def setUp(self):
+        self.l = PoolLimits({'link': 2})
+
+    def test_no_pool(self):
+        self.assertTrue(self.l.available(None))
+
+    def test_undeclared_pool(self):
+        self.l.acquire('other')
+        self.assertTrue(self.l.available('other'))
+
+    def test_depth(self):
+        self.l.acquire('link')
+        self.assertTrue(self.l.available('link'))
+
+        self.l.acquire('link')
+        self.assertFalse(self.l.available('link'))
+
+        self.l.release('link')
+        self.assertTrue(self.l.available('link'))
+
+class TestLoadLimit(TestCase):
+    def test_no_limit(self):
+        self.assertTrue(LoadLimit().available(10))
+
+    def test_below_limit(self):
+        l = LoadLimit(4.0)
+        l.load = lambda: 1.0
+
+        self.assertTrue(l.available(1))
+
+    def test_above_limit(self):
+        l = LoadLimit(4.0)
+        l.load = lambda: 4.0
+
+        self.assertFalse(l.available(1))
+
+    def test_idle_above_limit(self):
+        l = LoadLimit(4.0)
+        l.load = lambda: 8.0
+
+        self.assertTrue(l.available(0))
+
+    def test_no_load_average(self):
+        l = LoadLimit(4.0)
+        l.load = lambda: None
+
+        self.assertTrue(l.available(1))
+
+class TestExecutorMaxLoad(TestCase):
+    def run_jobs(self, e, count, lock):
+        done = Queue()
+        for i in range(count):
+            e.apply(subprocess.call, dict(args=exclusive_command(lock)),
+                    callback=lambda r: done.put(True), error_callback=lambda err: done.put(False))
+
+        return [ done.get(timeout=10) for i in range(count) ]
+
+    def test_high_load_runs_one_job(self):
+        with Executor(4, max_load=1.0) as e:
+            e.load.load = lambda: 2.0
+            self.assertEqual(self.run_jobs(e, 4, 'max-load-lock'), [True] * 4)
+            self.assertEqual(e.running, 0)
+
+    def test_limits_to_workers(self):
+        with Executor(2, max_load=8.0) as e:
+            e.load.load = lambda: 0.5
+            e.apply(subprocess.call, dict(args=['sleep', '0.2']))
+            e.apply(subprocess.call, dict(args=['sleep', '0.2']))
+            e.apply(subprocess.call, dict(args=['sleep', '0.2']))
+
+            self.assertEqual(e.running, 2)
+            self.assertEqual(len(e._held), 1)
+
+    def test_close_waits_for_held(self):
+        done = Queue()
+        e = Executor(1, max_load=1.0)
+        e.load.load = lambda: 2.0
+
+        for i in range(4):
+            e.apply(time.sleep, (0.2,), callback=lambda r: done.put(True))
+
+        closer = threading.Thread(target=e.close)
+        closer.start()
+        closer.join(10)
+
+        self.assertFalse(closer.is_alive())
+        self.assertEqual(done.qsize(), 4)
+        self.assertEqual(e.running, 0)
+        self.assertEqual(len(e._held), 0)
+
+    def test_terminate_discards_held(self):
+        e = Executor(2, max_load=1.0)
+        e.load.load = lambda: 2.0
+        e.apply(subprocess.call, dict(args=['sleep', '5']))
+        e.apply(subprocess.call, dict(args=['true']))
+
+        self.assertEqual(len(e._held), 1)
+        e.terminate()
+        self.assertEqual(len(e._held), 0)
+
+class TestParseSize(TestCase):
+    def test_bytes(self):
+        self.assertEqual(parse_size(2048), 2048)
+        self.assertEqual(parse_size('2048'), 2048)
+
+    def test_units(self):
+        self.assertEqual(parse_size('4K'), 4096)
+        self.assertEqual(parse_size('512M'), 512 * 1024 ** 2)
+        self.assertEqual(parse_size('1.5g'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size('2GB'), 2 * 1024 ** 3)
+
+    def test_invalid(self):
+        for value in ['lots', '-1G', True, '']:
+            with self.assertRaises(ValueError):
+                parse_size(value)
+
+class TestMemoryLimit(TestCase):
+    @classmethod
+    def setUp(self):
+        self.l = MemoryLimit(100)
+        self.l.free = lambda: 1000
+
+    def test_mem_available(self):
+        free = mem_available()
+        self.assertTrue(free is None or free > 0)
+
+    def test_no_estimate(self):
+        self.l.acquire(100)
+        self.assertTrue(self.l.available(None))
+
+    def test_idle(self):
+        self.assertTrue(self.l.available(500))
+
+    def test_ceiling(self):
+        self.l.acquire(60)
+        self.assertTrue(self.l.available(40))
+        self.assertFalse(self.l.available(50))
+
+        self.l.release(60)
+        self.assertTrue(self.l.available(50))
+
+    def test_system_memory(self):
+        l = MemoryLimit()
+        l.free = lambda: 100
+        l.acquire(None)
+
+        self.assertTrue(l.available(100))
+        self.assertFalse(l.available(101))
+
+class TestMeasured(TestCase):
+    def test_shell_job(self):
+        status, peak = measured(subprocess.call, dict(args=['sh', '-c', 'exit 3']))
+
+        self.assertEqual(status, 3)
+        self.assertTrue(peak > 0)
+
+    def test_python_job(self):
+        result, peak = measured(dummy_function, (1, 2))
+
+        self.assertEqual(result, (1, 2))
+        self.assertTrue(peak > 0)
+
+    def test_pool_peak_callback(self):
+        peaks = Queue()
+        results = Queue()
+
+        with WorkerPool(2) as p:
+            p.apply(dummy_function, (1, 2), callback=results.put, peak_callback=peaks.put)
+
+            self.assertEqual(results.get(timeout=10), (1, 2))
+            self.assertTrue(peaks.get(timeout=10) > 0)
+
+    def test_executor_shell_peak_callback(self):
+        peaks = Queue()
+        errors = Queue()
+
+        with Executor(2) as e:
+            e.apply(subprocess.call, dict(args=['false']), error_callback=errors.put,
+                    peak_callback=peaks.put)
+
+            self.assertIsInstance(errors.get(timeout=10), StageRunError)
+            self.assertTrue(peaks.get(timeout=10) > 0)
+
+class TestRunBatch(TestCase):
+    def test_results(self):
+        results, elapsed = run_batch([ (dummy_function, (1, 2)), (dummy_function, dict(a=3, b=4)) ])
+
+        self.assertEqual(results, [ (1, 2), (3, 4) ])
+        self.assertTrue(elapsed >= 0)
+
+    def test_failure(self):
+        with self.assertRaises(ValueError):
+            run_batch([ (dummy_function, (1, 2)), (fail_function, (1, 2)) ])
+
+class TestBatchSizer(TestCase):
+    @classmethod
+    def setUp(self):
+        self.s = BatchSizer(0.1)
+
+    def test_initial(self):
+        self.assertEqual(self.s.size(1000, 4), BatchSizer.INITIAL)
+
+    def test_small_stage(self):
+        self.assertEqual(self.s.size(2, 4), 1)
+
+    def test_target(self):
+        self.s.update(10, 0.01)
+        self.assertEqual(self.s.size(100000, 4), 100)
+
+    def test_even_share(self):
+        self.s.update(10, 0.0001)
+        self.assertEqual(self.s.size(1000, 4), 250)
+
+    def test_slow_jobs(self):
+        self.s.update(1, 5)
+        self.assertEqual(self.s.size(1000, 4), 1)
+
+    def test_moving_average(self):
+        self.s.update(10, 0.01)
+        self.s.update(10, 0.02)
+
+        self.assertAlmostEqual(self.s.per_job, 0.0013)
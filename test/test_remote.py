@@ -0,0 +1,202 @@
+from unittest import TestCase
+from buildcloth.remote import RemoteExecutor, RemoteWorker, parse_address, DEFAULT_ADDRESS
+from buildcloth.scheduler import BuildGraph
+from buildcloth.stages import BuildStage
+from buildcloth.system import BuildSystem
+from buildcloth.err import StageRunError
+from test.utils import dummy_function, fail_function, process_running
+from multiprocessing import Process
+import subprocess
+import signal
+import time
+import os
+
+AUTHKEY = 'test-remote'
+
+def run_worker(address):
+    RemoteWorker(address, AUTHKEY, 2).run(timeout=10)
+
+class TestParseAddress(TestCase):
+    def test_host_and_port(self):
+        self.assertEqual(parse_address('example.net:8000'), ('example.net', 8000))
+
+    def test_port(self):
+        self.assertEqual(parse_address('8000'), (DEFAULT_ADDRESS[0], 8000))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            parse_address('example.net:port')
+
+class TestAuthkey(TestCase):
+    def test_requires_authkey(self):
+        env = os.environ.pop('BUILDC_AUTHKEY', None)
+
+        try:
+            with self.assertRaises(StageRunError):
+                RemoteExecutor(2)
+        finally:
+            if env is not None:
+                os.environ['BUILDC_AUTHKEY'] = env
+
+    def test_authkey_from_environment(self):
+        os.environ['BUILDC_AUTHKEY'] = AUTHKEY
+
+        try:
+            self.assertEqual(RemoteWorker().authkey, AUTHKEY.encode('utf-8'))
+        finally:
+            del os.environ['BUILDC_AUTHKEY']
+
+    def test_worker_cannot_connect(self):
+        with self.assertRaises(StageRunError):
+            RemoteWorker(('127.0.0.1', 1), AUTHKEY).connect(timeout=0)
+
+class TestRemoteExecutor(TestCase):
+    @classmethod
+    def setUp(self):
+        self.pool = RemoteExecutor(4, ('127.0.0.1', 0), AUTHKEY)
+        self.pool.start()
+        self.workers = [ Process(target=run_worker, args=(self.pool.address,)) for i in range(2) ]
+
+        for worker in self.workers:
+            worker.start()
+
+        self.fn = os.path.abspath('remote.pids')
+
+    @classmethod
+    def tearDown(self):
+        self.pool.terminate()
+
+        for worker in self.workers:
+            worker.join(10)
+
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def test_started(self):
+        self.assertTrue(self.pool.started)
+        self.assertNotEqual(self.pool.address[1], 0)
+
+    def test_graph(self):
+        g = BuildGraph()
+        g.add('a', dummy_function, (1, 2), ['b'])
+        g.add('b', subprocess.call, dict(args=['true']))
+
+        self.assertTrue(g.run(pool=self.pool))
+        self.assertEqual([ worker for worker, start, end in self.pool.timings if end < start ], [])
+        self.assertEqual(len(self.pool.timings), 2)
+
+    def test_graph_failure(self):
+        g = BuildGraph()
+        g.add('a', dummy_function, (1, 2), ['b'])
+        g.add('b', fail_function, (1, 2))
+
+        self.assertFalse(g.run(pool=self.pool))
+        self.assertFalse(self.pool.started)
+
+    def test_shell_failure(self):
+        g = BuildGraph()
+        g.add('a', subprocess.call, dict(args=['sh', '-c', 'exit 3']))
+
+        self.assertFalse(g.run(pool=self.pool))
+
+    def test_stage_spreads_jobs(self):
+        stage = BuildStage()
+        for i in range(8):
+            stage.add(subprocess.call, dict(args=['sleep', '0.2']))
+
+        self.assertTrue(stage.run(pool=self.pool))
+
+        workers = set(worker for worker, start, end in self.pool.timings)
+        self.assertEqual(len(workers), 2)
+
+    def test_system(self):
+        bs = BuildSystem()
+        bs.workers = 4
+        bs.executor = lambda workers: self.pool
+
+        for name in ['one', 'two']:
+            stage = BuildStage()
+            stage.add(dummy_function, (1, 2))
+            bs.add_stage(name, stage)
+        bs.close()
+
+        self.assertTrue(bs.run())
+        self.assertEqual(len(self.pool.timings), 2)
+
+    def test_close_stops_workers(self):
+        self.pool.apply(dummy_function, (1, 2))
+        self.pool.close()
+
+        for worker in self.workers:
+            worker.join(10)
+            self.assertEqual(worker.exitcode, 0)
+
+    def test_terminate_kills_jobs(self):
+        self.pool.apply(subprocess.call, dict(args=['sh', '-c', 'echo $$ > {0}.tmp; mv {0}.tmp {0}; exec sleep 30'.format(self.fn)]))
+
+        deadline = time.time() + 10
+        while time.time() < deadline and not os.path.exists(self.fn):
+            time.sleep(0.1)
+
+        with open(self.fn, 'r') as f:
+            pid = int(f.read())
+
+        self.pool.terminate()
+
+        for worker in self.workers:
+            worker.join(10)
+
+        self.assertFalse(process_running(pid))
+
+    def wait_for_pids(self, paths):
+        deadline = time.time() + 10
+        while time.time() < deadline and not all(os.path.exists(path) for path in paths):
+            time.sleep(0.1)
+
+        pids = []
+        for path in paths:
+            with open(path, 'r') as f:
+                pids.append(int(f.read()))
+            os.remove(path)
+
+        return pids
+
+    def sleep_job(self, path, seconds):
+        return (subprocess.call, dict(args=['sh', '-c', 'echo $$ > {0}.tmp; mv {0}.tmp {0}; exec sleep {1}'.format(path, seconds)]))
+
+    def test_terminate_kills_jobs_in_full_slots(self):
+        paths = [ '{0}.{1}'.format(self.fn, i) for i in range(4) ]
+
+        # two workers with two slots each: every slot runs a job.
+        for path in paths:
+            self.pool.apply(*self.sleep_job(path, 30))
+
+        pids = self.wait_for_pids(paths)
+        self.pool.terminate()
+
+        for worker in self.workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+
+        self.assertEqual([ pid for pid in pids if process_running(pid) ], [])
+
+    def test_close_fails_jobs_of_lost_worker(self):
+        errors = []
+        self.pool.worker_timeout = 1
+        self.pool.apply(*self.sleep_job(self.fn, 30), error_callback=errors.append)
+
+        pid = self.wait_for_pids([self.fn])[0]
+
+        for worker in self.workers:
+            worker.kill()
+            worker.join(10)
+
+        try:
+            start = time.time()
+            self.pool.close()
+
+            self.assertTrue(time.time() - start < 10)
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(isinstance(errors[0], StageRunError))
+        finally:
+            os.kill(pid, signal.SIGKILL)
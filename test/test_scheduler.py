@@ -0,0 +1,298 @@
+from unittest import TestCase
+from buildcloth.scheduler import BuildGraph
+from buildcloth.err import InvalidJob, StageRunError
+from buildcloth.dependency import md5_file_check
+from multiprocessing import cpu_count
+from test.utils import dump_args_to_json_file_with_newlines, dummy_function, fail_function, exclusive_command
+import subprocess
+import json
+import os
+
+class TestBuildGraph(TestCase):
+    @classmethod
+    def setUp(self):
+        self.g = BuildGraph()
+        self.fn = 'graph.json'
+
+    @classmethod
+    def tearDown(self):
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def read_output(self):
+        with open(self.fn, 'r') as f:
+            return [ json.loads(ln)[0] for ln in f.readlines() ]
+
+    def test_initiated_obj(self):
+        self.assertEqual(self.g.count(), 0)
+        self.assertEqual(self.g.jobs, {})
+        self.assertEqual(self.g.graph, {})
+
+    def test_default_workers(self):
+        self.assertEqual(self.g.workers, cpu_count())
+
+    def test_workers_floor_threshold(self):
+        self.g.workers = 1
+        self.assertEqual(self.g.workers, 2)
+
+    def test_add(self):
+        self.g.add('a', dummy_function, (1, 2), ['b'])
+
+        self.assertEqual(self.g.count(), 1)
+        self.assertTrue('a' in self.g)
+        self.assertEqual(self.g.jobs['a'], (dummy_function, (1, 2)))
+        self.assertEqual(self.g.graph['a'], ['b'])
+
+    def test_add_without_dependency(self):
+        self.g.add('a', dummy_function, (1, 2))
+        self.assertEqual(self.g.graph['a'], [])
+
+    def test_add_duplicate(self):
+        self.g.add('a', dummy_function, (1, 2))
+
+        with self.assertRaises(InvalidJob):
+            self.g.add('a', dummy_function, (1, 2))
+
+    def test_add_invalid(self):
+        with self.assertRaises(InvalidJob):
+            self.g.add('a', None, (1, 2))
+
+    def test_edges_ignore_external_dependencies(self):
+        self.g.add('a', dummy_function, (1, 2), ['b', 'source.txt'])
+        self.g.add('b', dummy_function, (1, 2), ['other.txt'])
+
+        remaining, dependents = self.g._edges()
+
+        self.assertEqual(remaining, {'a': 1, 'b': 0})
+        self.assertEqual(dependents, {'a': [], 'b': ['a']})
+
+    def test_priorities_unweighted(self):
+        self.g.add('a', dummy_function, (1, 2), ['b'])
+        self.g.add('b', dummy_function, (1, 2), ['c'])
+        self.g.add('c', dummy_function, (1, 2))
+        self.g.add('d', dummy_function, (1, 2))
+
+        priority = self.g._priorities(*self.g._edges())
+
+        self.assertEqual(priority, {'a': 1, 'b': 2, 'c': 3, 'd': 1})
+
+    def test_priorities_weighted(self):
+        self.g.add('a', dummy_function, (1, 2), ['b'])
+        self.g.add('b', dummy_function, (1, 2))
+        self.g.add('c', dummy_function, (1, 2))
+        self.g.durations = {'a': 1, 'b': 2, 'c': 10}
+
+        priority = self.g._priorities(*self.g._edges())
+
+        self.assertEqual(priority, {'a': 1, 'b': 3, 'c': 10})
+
+    def test_priorities_default_duration(self):
+        self.g.add('a', dummy_function, (1, 2))
+        self.g.add('b', dummy_function, (1, 2))
+        self.g.durations = {'a': 4, 'other': 2}
+
+        self.assertEqual(self.g._priorities(*self.g._edges())['b'], 3)
+
+    def test_run_longest_path_first(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn))
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn))
+        self.g.add('y', dump_args_to_json_file_with_newlines, ('y', None, self.fn), ['z'])
+        self.g.add('z', dump_args_to_json_file_with_newlines, ('z', None, self.fn))
+
+        self.assertTrue(self.g.run(workers=1))
+        self.assertEqual(self.read_output()[0], 'z')
+
+    def test_run_slowest_first(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn))
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn))
+        self.g.durations = {'a': 1, 'b': 5}
+
+        self.assertTrue(self.g.run(workers=1))
+        self.assertEqual(self.read_output(), ['b', 'a'])
+
+    def test_add_with_pool(self):
+        self.g.add('a', dummy_function, (1, 2), pool='link')
+        self.g.add('b', dummy_function, (1, 2))
+
+        self.assertEqual(self.g.job_pools, {'a': 'link'})
+
+    def test_run_pool_depth(self):
+        self.g.pools = {'link': 1}
+        for target in ['a', 'b', 'c', 'd']:
+            self.g.add(target, subprocess.call, dict(args=exclusive_command('graph-link-lock')), pool='link')
+        self.g.add('e', dummy_function, (1, 2))
+
+        self.assertTrue(self.g.run(workers=4))
+        self.assertEqual(len(self.g.durations), 5)
+
+    def test_run_pool_depth_small_jobs_fill_slots(self):
+        self.g.pools = {'link': 1}
+        self.g.add('a', subprocess.call, dict(args=['sleep', '0.3']), pool='link')
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn), pool='link')
+        self.g.add('c', dump_args_to_json_file_with_newlines, ('c', None, self.fn))
+        self.g.durations = {'a': 10, 'b': 5, 'c': 1}
+
+        # b waits for a, and c runs on the free worker in the meantime.
+        self.assertTrue(self.g.run(workers=2))
+        self.assertEqual(self.read_output(), ['c', 'b'])
+
+    def test_add_with_mem(self):
+        self.g.add('a', dummy_function, (1, 2), mem=1024)
+        self.g.add('b', dummy_function, (1, 2))
+
+        self.assertEqual(self.g.job_memory, {'a': 1024})
+
+    def test_run_mem_ceiling(self):
+        self.g.mem_ceiling = 100
+        for target in ['a', 'b', 'c']:
+            self.g.add(target, subprocess.call, dict(args=exclusive_command('graph-mem-lock')), mem=60)
+        self.g.add('d', dummy_function, (1, 2))
+
+        self.assertTrue(self.g.run(workers=4))
+        self.assertEqual(len(self.g.durations), 4)
+
+    def test_run_records_durations(self):
+        self.g.add('a', dummy_function, (1, 2))
+        self.g.add('b', dummy_function, (1, 2), ['a'])
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(sorted(self.g.durations), ['a', 'b'])
+        self.assertTrue(self.g.durations['a'] >= 0)
+
+    def test_run_empty(self):
+        self.assertTrue(self.g.run())
+
+    def test_run_order_chain(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), ['b'])
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn), ['c'])
+        self.g.add('c', dump_args_to_json_file_with_newlines, ('c', None, self.fn))
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['c', 'b', 'a'])
+
+    def test_run_order_diamond(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), ['b', 'c'])
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn), ['d'])
+        self.g.add('c', dump_args_to_json_file_with_newlines, ('c', None, self.fn), ['d'])
+        self.g.add('d', dump_args_to_json_file_with_newlines, ('d', None, self.fn))
+
+        self.assertTrue(self.g.run())
+
+        output = self.read_output()
+        self.assertEqual(len(output), 4)
+        self.assertEqual(output[0], 'd')
+        self.assertEqual(output[-1], 'a')
+
+    def test_run_keyword_args(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, {'a': 'a', 'fn': self.fn})
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['a'])
+
+    def test_run_cycle(self):
+        self.g.add('a', dummy_function, (1, 2), ['b'])
+        self.g.add('b', dummy_function, (1, 2), ['a'])
+
+        with self.assertRaises(StageRunError):
+            self.g.run()
+
+    def test_run_partial_cycle(self):
+        self.g.add('a', dummy_function, (1, 2), ['b'])
+        self.g.add('b', dummy_function, (1, 2), ['a'])
+        self.g.add('c', dummy_function, (1, 2))
+
+        with self.assertRaises(StageRunError):
+            self.g.run()
+
+    def test_run_failure_stops_dependents(self):
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), ['b'])
+        self.g.add('b', fail_function, (1, 2))
+
+        self.assertFalse(self.g.run())
+        self.assertFalse(os.path.exists(self.fn))
+
+class TestBuildGraphRestat(TestCase):
+    def setUp(self):
+        self.g = BuildGraph()
+        self.fn = 'graph.json'
+        self.out = 'graph_restat.txt'
+        self.checked = []
+
+        with open(self.out, 'w') as f:
+            f.write('same')
+        os.utime(self.out, (1000000000, 1000000000))
+
+        self.g.add('a', dump_args_to_json_file_with_newlines, ('a', None, self.fn), [self.out])
+        self.g.stale.add(self.out)
+        self.g.check = self.check
+
+    def tearDown(self):
+        for fn in [ self.fn, self.out ]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def check(self, target):
+        self.checked.append(target)
+        return False
+
+    def read_output(self):
+        with open(self.fn, 'r') as f:
+            return [ json.loads(ln)[0] for ln in f.readlines() ]
+
+    def rewrite(self, content):
+        return (subprocess.call, dict(args=['sh', '-c', 'printf {0} > {1}'.format(content, self.out)]))
+
+    def test_add_restat(self):
+        self.g.add(self.out, dummy_function, (1, 2), restat=True)
+        self.assertEqual(self.g.restat, set([self.out]))
+
+    def test_prunes_unchanged_output(self):
+        self.g.add(self.out, dummy_function, (1, 2), restat=True)
+
+        self.assertTrue(self.g.run())
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertEqual(self.checked, ['a'])
+
+    def test_runs_after_changed_output(self):
+        job = self.rewrite('changed')
+        self.g.add(self.out, job[0], job[1], restat=True)
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['a'])
+        self.assertEqual(self.checked, [])
+
+    def test_runs_stale_dependents(self):
+        self.g.add(self.out, dummy_function, (1, 2), restat=True)
+        self.g.stale.add('a')
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['a'])
+
+    def test_runs_without_restat(self):
+        self.g.add(self.out, dummy_function, (1, 2))
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['a'])
+
+    def test_rewritten_output_without_digest(self):
+        job = self.rewrite('same')
+        self.g.add(self.out, job[0], job[1], restat=True)
+
+        self.assertTrue(self.g.run())
+        self.assertEqual(self.read_output(), ['a'])
+
+    def test_rewritten_output_with_digest(self):
+        job = self.rewrite('same')
+        self.g.add(self.out, job[0], job[1], restat=True)
+        self.g.digest = md5_file_check
+
+        self.assertTrue(self.g.run())
+        self.assertFalse(os.path.exists(self.fn))
+
+    def test_prunes_transitively(self):
+        self.g.add(self.out, dummy_function, (1, 2), restat=True)
+        self.g.add('b', dump_args_to_json_file_with_newlines, ('b', None, self.fn), ['a'])
+
+        self.assertTrue(self.g.run())
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertEqual(self.checked, ['a', 'b'])
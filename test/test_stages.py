@@ -1,9 +1,12 @@
 from unittest import TestCase
-from buildcloth.stages import BuildSteps, BuildStage, BuildSequence
+from buildcloth.stages import BuildSteps, BuildStage, BuildSequence, BATCH_MIN_JOBS
 from buildcloth.err import InvalidStage, StageClosed
 from multiprocessing import cpu_count
-from test.utils import dump_args_to_json_file, dummy_function
+from buildcloth.executors import WorkerPool
+from test.utils import dump_args_to_json_file, dummy_function, fail_function, process_running, exclusive_command
+import subprocess
 import json
+import time
 import os
 
 
@@ -211,6 +214,145 @@ class TestStagesBuildStage(StagesBuildStepTests, TestCase):
 
         self.assertEqual(sorted(self.result), sorted(jsn))
 
+    def test_running_shared_pool(self):
+        for arg in self.args:
+            self.b.add(dump_args_to_json_file, [arg[0], arg[1]])
+
+        with WorkerPool(2) as pool:
+            self.assertTrue(self.b.run(pool=pool))
+            self.assertTrue(pool.started)
+
+        with open('t', 'r') as f:
+            jsn = f.read()
+
+        self.assertEqual(sorted(self.result), sorted(jsn))
+
+    def test_running_empty(self):
+        self.assertTrue(self.b.run())
+
+    def test_running_nested_sequence(self):
+        seq = BuildSequence()
+        for arg in self.args:
+            seq.add(dump_args_to_json_file, [arg[0], arg[1]])
+
+        self.b.add(seq.run, None)
+
+        with WorkerPool(2) as pool:
+            self.assertTrue(self.b.run(pool=pool))
+
+        with open('t', 'r') as f:
+            jsn = f.read()
+
+        self.assertEqual(self.result, jsn)
+
+    def test_running_collects_results(self):
+        self.b.add(dummy_function, (1, 2))
+        self.b.add(dummy_function, (3, 4))
+
+        self.assertTrue(self.b.run())
+        self.assertEqual(sorted([ result for job, result in self.b.results ]), [(1, 2), (3, 4)])
+
+    def test_running_collects_exit_status(self):
+        self.b.add(subprocess.call, dict(cwd='/tmp', args=['true']))
+
+        self.assertTrue(self.b.run())
+        self.assertEqual(self.b.results[0][1], 0)
+
+    def test_running_failed_job(self):
+        self.b.add(dummy_function, (1, 2))
+        self.b.add(fail_function, (1, 2))
+
+        self.assertFalse(self.b.run())
+
+    def test_running_failed_command(self):
+        self.b.add(subprocess.call, dict(cwd='/tmp', args=['false']))
+
+        self.assertFalse(self.b.run())
+
+    def test_running_failure_stops_running_commands(self):
+        pid_fn = os.path.abspath('pid')
+        self.b.add(subprocess.call, dict(cwd='/tmp',
+                                         args=['sh', '-c', 'echo $$ > {0}; exec sleep 30'.format(pid_fn)]))
+        self.b.add(subprocess.call, dict(cwd='/tmp',
+                                         args=['sh', '-c', 'sleep 0.5; exit 2']))
+
+        start = time.time()
+        self.assertFalse(self.b.run(workers=2))
+        self.assertTrue(time.time() - start < 10)
+
+        with open(pid_fn, 'r') as f:
+            pid = int(f.read())
+        os.remove(pid_fn)
+
+        time.sleep(0.1)
+        self.assertFalse(process_running(pid))
+
+    def test_add_with_pool(self):
+        self.b.add(dummy_function, (1, 2))
+        self.b.add(dummy_function, (1, 2), pool='db')
+
+        self.assertEqual(self.b.job_pools, {1: 'db'})
+
+    def test_running_pool_depth(self):
+        self.b.pools = {'db': 1}
+        for i in range(4):
+            self.b.add(subprocess.call, dict(args=exclusive_command('stage-db-lock')), pool='db')
+        self.b.add(dummy_function, (1, 2))
+
+        self.assertTrue(self.b.run(workers=4))
+        self.assertEqual(len(self.b.results), 5)
+
+    def test_batch_default(self):
+        self.b.grow(dummy_function, [ (i, i) for i in range(BATCH_MIN_JOBS - 1) ])
+        self.assertEqual(self.b._batched(), [])
+
+        self.b.add(dummy_function, (1, 2))
+        self.assertEqual(len(self.b._batched()), BATCH_MIN_JOBS)
+
+    def test_batch_skips_jobs(self):
+        self.b.batch = True
+        self.b.add(dummy_function, (1, 2))
+        self.b.add(subprocess.call, dict(args=['true']))
+        self.b.add(dummy_function, (1, 2), pool='db')
+        self.b.add(dummy_function, (1, 2), mem=1024)
+
+        self.assertEqual(self.b._batched(), [0])
+
+        self.b.batch = False
+        self.assertEqual(self.b._batched(), [])
+
+    def test_running_batched(self):
+        self.b.batch = True
+        self.b.grow(dummy_function, [ (i, i) for i in range(500) ])
+        self.b.add(subprocess.call, dict(args=['true']))
+
+        self.assertTrue(self.b.run(workers=2))
+        self.assertEqual(len(self.b.results), 501)
+        self.assertEqual(sorted(r for job, r in self.b.results if job[0] is dummy_function),
+                         [ (i, i) for i in range(500) ])
+
+    def test_running_batched_failure(self):
+        self.b.batch = True
+        self.b.grow(dummy_function, [ (i, i) for i in range(100) ])
+        self.b.add(fail_function, (1, 2))
+
+        self.assertFalse(self.b.run(workers=2))
+
+    def test_add_with_mem(self):
+        self.b.add(dummy_function, (1, 2), mem=1024)
+        self.b.add(dummy_function, (1, 2))
+
+        self.assertEqual(self.b.job_memory, {0: 1024})
+
+    def test_running_mem_ceiling(self):
+        self.b.mem_ceiling = 100
+        for i in range(3):
+            self.b.add(subprocess.call, dict(args=exclusive_command('stage-mem-lock')), mem=60)
+        self.b.add(dummy_function, (1, 2))
+
+        self.assertTrue(self.b.run(workers=4))
+        self.assertEqual(len(self.b.results), 4)
+
     @classmethod
     def tearDown(self):
         if os.path.exists('t'):
@@ -233,6 +375,50 @@ class TestStagesBuildSequence(StagesBuildStepTests, TestCase):
         self.b.run()
         self.assertEqual(self.results, self.args)
 
+    def test_running_shared_pool(self):
+        for arg in self.args:
+            self.b.add(dump_args_to_json_file, [arg[0], arg[1]])
+
+        with WorkerPool(2) as pool:
+            self.assertTrue(self.b.run(pool=pool))
+
+        with open('t', 'r') as f:
+            jsn = f.read()
+
+        self.assertEqual(''.join([ json.dumps(list(arg)) for arg in self.args ]), jsn)
+
+    def test_running_collects_results(self):
+        self.b.add(dummy_function, (1, 2))
+        self.b.add(dummy_function, (3, 4))
+
+        self.assertTrue(self.b.run())
+        self.assertEqual([ result for job, result in self.b.results ], [(1, 2), (3, 4)])
+
+    def test_running_failed_command(self):
+        self.b.add(subprocess.call, dict(cwd='/tmp', args=['false']))
+        self.b.add(dump_args_to_json_file, (1, 2))
+
+        self.assertFalse(self.b.run())
+        self.assertFalse(os.path.exists('t'))
+
+    def test_running_failed_command_shared_pool(self):
+        self.b.add(subprocess.call, dict(cwd='/tmp', args=['false']))
+        self.b.add(dump_args_to_json_file, (1, 2))
+
+        with WorkerPool(2) as pool:
+            self.assertFalse(self.b.run(pool=pool))
+
+        self.assertFalse(os.path.exists('t'))
+
+    def test_add_nested_sequence(self):
+        seq = BuildSequence()
+        self.assertTrue(self.b.add(seq.run, None))
+
+    @classmethod
+    def tearDown(self):
+        if os.path.exists('t'):
+            os.remove('t')
+
 class StagesBuildStepMultiAddTests(object):
     def test_valid_test_harness(self):
         self.assertEqual( self.jobs[0][1], self.args[0] )
@@ -1,8 +1,10 @@
 from buildcloth.system import BuildSystem, BuildSystemGenerator, narrow_buildsystem
 from buildcloth.stages import BuildStage, BuildSequence, BuildSteps
 from buildcloth.dependency import DependencyChecks
-from buildcloth.err import InvalidStage, StageClosed, InvalidSystem, StageRunError, InvalidJob
-from test.utils import dummy_function, dump_args_to_json_file, dump_args_to_json_file_with_newlines
+from buildcloth.buildlog import BuildLog
+from buildcloth.err import InvalidStage, StageClosed, InvalidSystem, StageRunError, InvalidJob, TargetError, DependencyCycleError
+from test.utils import dummy_function, fail_function, dump_args_to_json_file, dump_args_to_json_file_with_newlines, dump_pid_to_file
+from multiprocessing import cpu_count
 from unittest import TestCase, skip
 import subprocess
 import json
@@ -418,6 +420,62 @@ class TestSystemRunPart_Suite_2(ComplexSystem):
         self.assertTrue(os.path.exists(self.fn_three))
         self.assertFalse(os.path.exists(self.fn_four))
 
+class TestSystemSharedPool(ComplexSystem):
+    def test_default_workers(self):
+        self.assertEqual(self.bs.workers, cpu_count())
+
+    def test_workers_floor_threshold(self):
+        self.bs.workers = 1
+        self.assertEqual(self.bs.workers, 2)
+
+    def test_one_pool_per_build(self):
+        self.bs.workers = 2
+
+        for name in self.bs.get_order():
+            self.bs.stages[name].add(dump_pid_to_file, ('pids',))
+
+        self.bs.close()
+        self.assertTrue(self.bs.run())
+
+        with open('pids', 'r') as f:
+            pids = set(f.read().split())
+
+        os.remove('pids')
+
+        self.assertTrue(len(pids) <= 2)
+
+    def test_max_load(self):
+        self.bs.max_load = 64.0
+        self.bs.close()
+
+        with self.bs._executor() as pool:
+            self.assertEqual(pool.load.max_load, 64.0)
+
+        self.assertTrue(self.bs.run())
+
+    def test_no_max_load(self):
+        with self.bs._executor() as pool:
+            self.assertEqual(pool.load.max_load, None)
+
+class TestSystemRunFailure(ComplexSystem):
+    def test_failed_stage_stops_build_strict(self):
+        self.bs.stages['two'].add(fail_function, (self.a, self.b))
+        self.bs.close()
+
+        with self.assertRaises(StageRunError):
+            self.bs.run(strict=True)
+
+        self.assertTrue(os.path.exists(self.fn_one))
+        self.assertFalse(os.path.exists(self.fn_three))
+        self.assertFalse(os.path.exists(self.fn_four))
+
+    def test_failed_command_stops_build(self):
+        self.bs.stages['one'].add(subprocess.call, dict(cwd='/tmp', args=['false']))
+        self.bs.close()
+
+        self.assertFalse(self.bs.run(strict=False))
+        self.assertFalse(os.path.exists(self.fn_two))
+
 class TestSystemRunAllTestOutput(ComplexSystem):
     def result_assertion(self, fn, result):
         self.assertEqual([ item.items() for item in self.unwind_json_from_outputs(fn)].sort(),
@@ -989,6 +1047,9 @@ class TestBuildSystemGenerator(TestCase):
                  'msg': 'alpha' }
 
         self.bsg._process_dependency(spec)
+        self.assertIsNone(self.bsg._process_jobs[spec['target']][1])
+
+        self.bsg.finalize()
         self.assertTrue(self.bsg._process_jobs[spec['target']][1])
 
     def test_process_dependency_rebuild_not_needed(self):
@@ -1006,6 +1067,7 @@ class TestBuildSystemGenerator(TestCase):
                  'msg': 'alpha' }
 
         self.bsg._process_dependency(spec)
+        self.bsg.finalize()
         self.assertFalse(self.bsg._process_jobs[spec['target']][1])
 
     def test_job_processing_dep_target(self):
@@ -1219,6 +1281,16 @@ class TestBuildSystemGeneratorFunctional(TestCase):
 
         self.assertEqual(self.bsg._process, ['a', 'f', 'b', 'c', 'l', 'r'])
 
+    def test_dependency_cycle(self):
+        self.complex_jobs[3]['dep'] = ['a']
+        self.complex_system()
+
+        with self.assertRaises(DependencyCycleError) as cm:
+            self.bsg.finalize()
+
+        self.assertEqual(len(cm.exception.cycles), 1)
+        self.assertEqual(set(cm.exception.cycles[0]), set(['a', 'b', 'c', 'r']))
+
     def test_dependency_ordering_complex_comp(self):
         self.complex_system()
         self.bsg.finalize()
@@ -1258,6 +1330,290 @@ class TestBuildSystemGeneratorFunctional(TestCase):
 
         self.assertTrue(self.bsg.system.run())
 
+    def test_build_graph_complex(self):
+        self.complex_system()
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.graph.count(), 6)
+        self.assertEqual(self.bsg.system.graph.graph['a'], ['b', 'f', 'r'])
+
+    def test_build_graph_partial_rebuild(self):
+        self.bsg.check_method = 'ignore'
+        self.simple_system()
+        self.bsg._process_jobs['c'] = (self.bsg._process_jobs['c'][0], True)
+        self.bsg.finalize()
+
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['a', 'b', 'c'])
+
+    def record_checks(self, result):
+        checked = []
+
+        def check(target, dependency, fingerprint=None):
+            checked.append(target)
+            return result(target)
+
+        self.bsg.check.check = check
+        return checked
+
+    def test_checks_at_finalize(self):
+        checked = self.record_checks(lambda target: False)
+        self.complex_system()
+        self.assertEqual(checked, [])
+
+        self.bsg.finalize()
+        self.assertEqual(sorted(checked), ['a', 'b', 'c', 'f', 'l', 'r'])
+
+    def test_checks_dependencies_first(self):
+        checked = self.record_checks(lambda target: False)
+        self.simple_system()
+        self.bsg.finalize()
+
+        self.assertEqual(checked, ['c', 'b', 'a'])
+
+    def test_no_checks_below_rebuilt_targets(self):
+        checked = self.record_checks(lambda target: target == 'c')
+        self.simple_system()
+        self.bsg.finalize()
+
+        self.assertEqual(checked, ['c'])
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['a', 'b', 'c'])
+
+    def test_reverse_tree(self):
+        self.complex_system()
+        self.bsg.finalize()
+
+        tree = self.bsg._tree
+        dependents = lambda target: sorted(tree.targets[node] for node in tree.dependents(tree.ids[target]))
+
+        self.assertEqual(dependents('r'), ['a', 'c'])
+        self.assertEqual(dependents('l'), ['b', 'c'])
+        self.assertEqual(dependents('a'), [])
+
+    def test_stage_levels(self):
+        self.complex_system()
+        self.bsg.finalize()
+
+        order = self.bsg.system.get_order()
+        levels = [ sorted(target for target, job in self.bsg.system.targets[name]) for name in order ]
+
+        self.assertEqual(levels, [ ['f', 'l', 'r'], ['c'], ['b'], ['a'] ])
+
+    def test_rebuilds_only_dependents(self):
+        self.record_checks(lambda target: target == 'f')
+        self.complex_system()
+        self.bsg.finalize()
+
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['a', 'f'])
+
+        targets = [ target for stage in self.bsg.system.targets.values() for target, job in stage ]
+        self.assertEqual(sorted(targets), ['a', 'f'])
+        self.assertTrue(self.bsg.system.run())
+
+    def test_rebuilds_transitive_dependents(self):
+        self.record_checks(lambda target: target == 'l')
+        self.complex_system()
+        self.bsg.finalize()
+
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['a', 'b', 'c', 'l'])
+
+        targets = [ target for stage in self.bsg.system.targets.values() for target, job in stage ]
+        self.assertEqual(sorted(targets), ['a', 'b', 'c', 'l'])
+
+    def test_restat(self):
+        self.record_checks(lambda target: target == 'c')
+        self.bsg.ingest([ { 'target': 'a', 'dep': 'b', 'job': 'dumb', 'args': [None, None] },
+                          { 'target': 'b', 'dep': 'c', 'job': 'dumb', 'args': [None, None], 'restat': True },
+                          { 'target': 'c', 'dep': [], 'job': 'dumb', 'args': [None, None] } ])
+        self.bsg.finalize()
+
+        graph = self.bsg.system.graph
+        self.assertEqual(graph.restat, set(['b']))
+        self.assertEqual(graph.stale, set(['c']))
+        self.assertEqual(sorted(graph.jobs), ['a', 'b', 'c'])
+        self.assertFalse(graph.check('a'))
+
+    def test_goals(self):
+        checked = self.record_checks(lambda target: True)
+        self.complex_system()
+        self.bsg._process_job({'stage': 'after', 'job': 'dumb', 'args': [None, None]})
+        self.bsg.finalize(['c'])
+
+        self.assertEqual(sorted(checked), ['l', 'r'])
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['c', 'l', 'r'])
+        self.assertNotIn('after', self.bsg.system.get_order())
+        self.assertTrue(self.bsg.system.run(mode='dag'))
+
+    def test_goals_with_stage(self):
+        self.complex_system()
+        self.bsg._process_job({'stage': 'after', 'job': 'dumb', 'args': [None, None]})
+        self.bsg.finalize(['f', 'after'])
+
+        self.assertEqual(sorted(self.bsg.system.graph.jobs), ['f'])
+        self.assertEqual(self.bsg.system.get_order().count('after'), 1)
+
+    def test_goals_only_stages(self):
+        self.complex_system()
+        self.bsg._process_job({'stage': 'after', 'job': 'dumb', 'args': [None, None]})
+        self.bsg.finalize(['after'])
+
+        self.assertEqual(self.bsg.system.get_order(), ['after'])
+        self.assertIsNone(self.bsg.system.graph)
+
+    def test_unknown_goal(self):
+        self.simple_system()
+
+        with self.assertRaises(TargetError):
+            self.bsg.finalize(['nonextant'])
+
+    def test_file_dependencies(self):
+        self.bsg.check_method = 'force'
+        self.bsg.ingest([ { 'target': 'a', 'dep': ['b', 'a.c'], 'job': 'dumb', 'args': [None, None] },
+                          { 'target': 'b', 'dep': ['b.c', 'a.h'], 'job': 'dumb', 'args': [None, None] } ])
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg._process, ['a', 'b'])
+        self.assertEqual(self.bsg.system.graph.graph['b'], ['b.c', 'a.h'])
+
+    def test_build_graph_no_rebuild(self):
+        self.bsg.check_method = 'ignore'
+        self.simple_system()
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.graph.count(), 0)
+
+    def test_run_dag_complex(self):
+        self.complex_system()
+        self.bsg.finalize()
+
+        self.assertTrue(self.bsg.system.run(mode='dag'))
+
+    def test_run_dag_combined_with_stages(self):
+        self.complex_system()
+        self.bsg._process_job({'stage': 'after', 'job': 'dumb', 'args': [None, None]})
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.get_order().count('after'), 1)
+        self.assertTrue(self.bsg.system.run(mode='dag'))
+
+    def test_run_async_dag_complex(self):
+        import asyncio
+
+        self.complex_system()
+        self.bsg.finalize()
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertTrue(loop.run_until_complete(self.bsg.system.run_async(mode='dag')))
+        finally:
+            loop.close()
+
+    def test_pools_declaration(self):
+        self.bsg.ingest([{ 'pools': { 'link': 2, 'db': 1 } }])
+        self.assertEqual(self.bsg.pools, { 'link': 2, 'db': 1 })
+
+    def test_pools_invalid_depth(self):
+        with self.assertRaises(InvalidJob):
+            self.bsg.ingest([{ 'pools': { 'link': 0 } }])
+
+    def test_pools_malformed(self):
+        with self.assertRaises(InvalidJob):
+            self.bsg.ingest([{ 'pools': ['link'] }])
+
+    def test_pools_with_job(self):
+        with self.assertRaises(InvalidJob):
+            self.bsg.ingest([{ 'pools': { 'link': 2 }, 'target': 'a', 'job': 'dumb', 'args': [1, 2] }])
+
+        self.assertEqual(self.bsg.pools, {})
+
+    def test_pool_target_jobs(self):
+        self.bsg.ingest([ { 'target': 'a', 'dep': ['b'], 'job': 'dumb', 'args': [1, 2], 'pool': 'link' },
+                          { 'target': 'b', 'dep': [], 'job': 'dumb', 'args': [1, 2] },
+                          { 'pools': { 'link': 1 } } ])
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.graph.job_pools, { 'a': 'link' })
+        self.assertEqual(self.bsg.system.graph.pools, { 'link': 1 })
+        for stage in self.bsg.system.stages.values():
+            self.assertEqual(stage.pools, { 'link': 1 })
+        self.assertEqual(sum(len(stage.job_pools) for stage in self.bsg.system.stages.values()), 1)
+        self.assertTrue(self.bsg.system.run(mode='dag'))
+
+    def test_pool_stage_jobs(self):
+        self.bsg.ingest([ { 'pools': { 'db': 1 } },
+                          { 'stage': 'one', 'job': 'dumb', 'args': [1, 2], 'pool': 'db' },
+                          { 'stage': 'one', 'job': 'dumb', 'args': [1, 2], 'pool': 'db' } ])
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.stages['one'].job_pools, { 0: 'db', 1: 'db' })
+        self.assertTrue(self.bsg.system.run())
+
+    def test_mem_target_jobs(self):
+        self.bsg.ingest([ { 'target': 'a', 'dep': ['b'], 'job': 'dumb', 'args': [1, 2], 'mem': '2G' },
+                          { 'target': 'b', 'dep': [], 'job': 'dumb', 'args': [1, 2] } ])
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.graph.job_memory, { 'a': 2 * 1024 ** 3 })
+        self.assertEqual(sum(len(stage.job_memory) for stage in self.bsg.system.stages.values()), 1)
+
+    def test_mem_stage_jobs(self):
+        self.bsg.ingest([ { 'stage': 'one', 'job': 'dumb', 'args': [1, 2], 'mem': 4096 } ])
+        self.bsg.finalize()
+
+        self.assertEqual(self.bsg.system.stages['one'].job_memory, { 0: 4096 })
+
+    def test_mem_invalid(self):
+        with self.assertRaises(InvalidJob):
+            self.bsg.ingest([ { 'stage': 'one', 'job': 'dumb', 'args': [1, 2], 'mem': 'lots' } ])
+
+    def test_mem_recorded_peak(self):
+        log = BuildLog('test.buildc_log')
+        log.record('a', 1.0, 2.0, 1, peak=512)
+        self.bsg.check.log = log
+
+        try:
+            self.bsg.ingest([ { 'target': 'a', 'dep': [], 'job': 'dumb', 'args': [1, 2], 'mem': '2G' },
+                              { 'target': 'b', 'dep': [], 'job': 'dumb', 'args': [1, 2] } ])
+            self.bsg.finalize()
+        finally:
+            log.close()
+            os.remove('test.buildc_log')
+
+        self.assertEqual(self.bsg.system.graph.job_memory, { 'a': 512 })
+
+    def test_run_mem_ceiling(self):
+        self.bsg.ingest([ { 'target': 'a', 'dep': [], 'job': 'dumb', 'args': [1, 2], 'mem': 60 } ])
+        self.bsg.finalize()
+        self.bsg.system.mem_ceiling = 100
+
+        self.assertTrue(self.bsg.system.run(mode='dag'))
+        self.assertEqual(self.bsg.system.graph.mem_ceiling, 100)
+
+    def test_pool_undeclared(self):
+        self.bsg.ingest([ { 'stage': 'one', 'job': 'dumb', 'args': [1, 2], 'pool': 'db' } ])
+
+        with self.assertRaises(InvalidSystem):
+            self.bsg.finalize()
+
+    def test_run_invalid_mode(self):
+        self.simple_system()
+        self.bsg.finalize()
+
+        with self.assertRaises(StageRunError):
+            self.bsg.system.run(mode='magic')
+
+    def test_run_generated_sequence(self):
+        self.bsg.ingest([{ 'stage': 'seq',
+                           'tasks': [ { 'job': 'dump', 'args': [1, 2] },
+                                      { 'job': 'dump', 'args': [3, 4] } ] }])
+        self.bsg.finalize()
+
+        self.assertTrue(self.bsg.system.run())
+
+        with open('t', 'r') as f:
+            self.assertEqual(f.read(), '[1, 2][3, 4]')
+
+        os.remove('t')
+
     def test_ingestion_simple(self):
         self.simple_system()
         self.bsg.finalize()
@@ -0,0 +1,85 @@
+from buildcloth.tree import DependencyTree
+from buildcloth.err import DependencyCycleError
+from unittest import TestCase
+
+class TestDependencyTree(TestCase):
+    def setUp(self):
+        self.tree = DependencyTree({
+            'a': ['b', 'f', 'r'],
+            'b': ['c', 'l', 'b.c'],
+            'c': ['r', 'l', 'r'],
+            'r': [],
+            'f': [],
+            'l': ['l.c']
+        })
+
+    def names(self, nodes):
+        return [ self.tree.targets[node] for node in nodes ]
+
+    def test_interned_targets(self):
+        self.assertEqual(self.tree.targets, ['a', 'b', 'c', 'r', 'f', 'l'])
+        self.assertEqual(self.tree.ids['c'], 2)
+        self.assertEqual(len(self.tree), 6)
+        self.assertTrue('a' in self.tree)
+        self.assertFalse('b.c' in self.tree)
+
+    def test_dependencies(self):
+        self.assertEqual(self.names(self.tree.dependencies(0)), ['b', 'f', 'r'])
+        self.assertEqual(self.names(self.tree.dependencies(1)), ['c', 'l'])
+        self.assertEqual(self.names(self.tree.dependencies(5)), [])
+        self.assertEqual(list(self.tree.offsets), [0, 3, 5, 8, 8, 8, 8])
+
+    def test_dependents(self):
+        self.tree.reverse()
+
+        self.assertEqual(self.names(self.tree.dependents(3)), ['a', 'c'])
+        self.assertEqual(self.names(self.tree.dependents(5)), ['b', 'c'])
+        self.assertEqual(self.names(self.tree.dependents(0)), [])
+
+    def test_dependents_without_self(self):
+        tree = DependencyTree({'a': ['a', 'b'], 'b': []})
+        tree.reverse()
+
+        self.assertEqual(list(tree.dependents(0)), [])
+        self.assertEqual(list(tree.dependents(1)), [0])
+
+    def test_sort(self):
+        self.assertEqual(self.names(self.tree.sort()), ['a', 'f', 'b', 'c', 'l', 'r'])
+
+    def test_sort_cycle(self):
+        tree = DependencyTree({'a': ['b'], 'b': ['a'], 'c': []})
+
+        with self.assertRaises(DependencyCycleError) as cm:
+            tree.sort()
+
+        self.assertEqual(sorted(cm.exception.cycles[0]), ['a', 'b'])
+
+    def test_narrow(self):
+        tree = self.tree.narrow([self.tree.ids['c']])
+
+        self.assertEqual(tree.targets, ['c', 'r', 'l'])
+        self.assertEqual([ tree.targets[node] for node in tree.dependencies(0) ], ['r', 'l', 'r'])
+        self.assertEqual(len(tree.dependencies(1)), 0)
+
+    def test_narrow_several_goals(self):
+        tree = self.tree.narrow([self.tree.ids['f'], self.tree.ids['l']])
+
+        self.assertEqual(tree.targets, ['f', 'l'])
+
+    def test_levels(self):
+        levels = self.tree.levels(reversed(self.tree.sort()))
+
+        self.assertEqual([ self.names(level) for level in levels ],
+                         [ ['r', 'l', 'f'], ['c'], ['b'], ['a'] ])
+
+    def test_levels_subset(self):
+        nodes = [ self.tree.ids[target] for target in ('f', 'c', 'a') ]
+        levels = self.tree.levels(nodes)
+
+        self.assertEqual([ self.names(level) for level in levels ], [ ['f', 'c'], ['a'] ])
+
+    def test_empty_tree(self):
+        tree = DependencyTree({})
+
+        self.assertEqual(len(tree.sort()), 0)
+        self.assertEqual(tree.levels([]), [])
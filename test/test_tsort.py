@@ -0,0 +1,76 @@
+from buildcloth.tsort import tsort, topological_sort
+from buildcloth.err import DependencyCycleError, InvalidSystem
+from unittest import TestCase
+
+class TestTopologicalSort(TestCase):
+    def setUp(self):
+        self.graph = {
+            'a': ['b', 'f', 'r'],
+            'b': ['c', 'l'],
+            'c': ['r', 'l'],
+            'r': [],
+            'f': [],
+            'l': []
+        }
+
+    def test_simple_order(self):
+        self.assertEqual(tsort({'a': ['b'], 'b': ['c'], 'c': []}), ['a', 'b', 'c'])
+
+    def test_complex_order(self):
+        result = tsort(self.graph)
+
+        self.assertEqual(len(result), len(self.graph))
+        for node, successors in self.graph.items():
+            for successor in successors:
+                self.assertTrue(result.index(node) < result.index(successor))
+
+    def test_empty_graph(self):
+        self.assertEqual(tsort({}), [])
+        self.assertEqual(topological_sort({}), [])
+
+    def test_unknown_successors(self):
+        self.assertEqual(tsort({'a': ['b', 'a.txt'], 'b': ['b.txt']}), ['a', 'b'])
+
+    def test_self_dependency(self):
+        self.assertEqual(tsort({'a': ['a', 'b'], 'b': []}), ['a', 'b'])
+
+    def test_components(self):
+        graph = {'a': ['b'], 'b': ['c'], 'c': ['b', 'd'], 'd': []}
+        result = topological_sort(graph)
+
+        self.assertEqual(result[0], ('a',))
+        self.assertEqual(set(result[1]), set(['b', 'c']))
+        self.assertEqual(result[2], ('d',))
+
+    def test_cycle(self):
+        graph = {'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['e'], 'e': ['d'], 'f': []}
+
+        with self.assertRaises(DependencyCycleError) as cm:
+            tsort(graph)
+
+        cycles = sorted(sorted(cycle) for cycle in cm.exception.cycles)
+        self.assertEqual(cycles, [['a', 'b', 'c'], ['d', 'e']])
+        self.assertTrue(isinstance(cm.exception, InvalidSystem))
+
+    def test_cycle_message(self):
+        with self.assertRaises(DependencyCycleError) as cm:
+            tsort({'a': ['b'], 'b': ['a']})
+
+        self.assertTrue('a' in str(cm.exception))
+        self.assertTrue('b' in str(cm.exception))
+
+    def test_long_chain(self):
+        size = 200000
+        graph = dict((i, [i + 1]) for i in range(size - 1))
+        graph[size - 1] = []
+
+        self.assertEqual(tsort(graph), list(range(size)))
+
+    def test_long_cycle(self):
+        size = 200000
+        graph = dict((i, [(i + 1) % size]) for i in range(size))
+
+        with self.assertRaises(DependencyCycleError) as cm:
+            tsort(graph)
+
+        self.assertEqual(len(cm.exception.cycles[0]), size)
@@ -1,4 +1,5 @@
 import json
+import os
 
 def dump_args_to_json_file(a=None, b=None, fn='t'):
     with open(fn, 'a') as f:
@@ -11,3 +12,22 @@ def dump_args_to_json_file_with_newlines(a=None, b=None, fn='t'):
 
 def dummy_function(a=None, b=None):
     return a, b
+
+def fail_function(a=None, b=None):
+    raise ValueError(a, b)
+
+def dump_pid_to_file(fn='t'):
+    with open(fn, 'a') as f:
+        f.write(str(os.getpid()) + '\n')
+
+def process_running(pid):
+    # killed processes may remain as zombies until their parent reaps them.
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'r') as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+def exclusive_command(lock):
+    # fails if another exclusive_command with the same lock is running.
+    return ['sh', '-c', 'mkdir {0} || exit 1; sleep 0.1; rmdir {0}'.format(lock)]